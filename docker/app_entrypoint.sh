@@ -18,6 +18,11 @@ case "${SERVICE}" in
         echo "Starting Celery Worker"
         exec ./run_worker.sh
         ;;
+    consumer)
+        echo "Starting Data Queue Consumer"
+        cd ..
+        exec ./docker/run_consumer.sh "$@"
+        ;;
     map)
         echo "Creating datamaps image tiles."
         cd ..
@@ -38,6 +43,6 @@ case "${SERVICE}" in
         fi
         ;;
     *)
-        echo "Usage: $0 {scheduler|web|worker|shell}"
+        echo "Usage: $0 {scheduler|web|worker|consumer|shell}"
         exit 1
 esac
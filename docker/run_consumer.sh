@@ -0,0 +1,3 @@
+#!/bin/sh
+
+exec python ./ichnaea/scripts/consumer.py "$@"
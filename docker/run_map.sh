@@ -1,3 +1,6 @@
 #!/bin/sh
 
-python ./ichnaea/scripts/datamap.py --create --upload
+# The output folder keeps the points and tiles of the previous run, so only
+# the changed tiles are rendered. Mount a volume there to keep it between
+# containers, otherwise all tiles are rendered.
+python ./ichnaea/scripts/datamap.py --create --upload --output "${DATAMAP_OUTPUT:-/tmp/datamap}"
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+Compare the geocalc array functions with loops over the scalar functions.
+
+Run it after installing geocalc, for example in the docker image::
+
+    $ python geocalclib/benchmark.py --size 10000
+"""
+
+import argparse
+from timeit import Timer
+
+import numpy
+
+import geocalc
+
+
+def loop_distance_one(lat, lon, lats, lons):
+    return numpy.array(
+        [geocalc.distance(lat, lon, lat2, lon2) for lat2, lon2 in zip(lats, lons)]
+    )
+
+
+def loop_distance_pairs(lats1, lons1, lats2, lons2):
+    return numpy.array(
+        [
+            geocalc.distance(lat1, lon1, lat2, lon2)
+            for lat1, lon1, lat2, lon2 in zip(lats1, lons1, lats2, lons2)
+        ]
+    )
+
+
+def loop_bbox(lats, lons, meters):
+    return [
+        geocalc.bbox(lat, lon, meter) for lat, lon, meter in zip(lats, lons, meters)
+    ]
+
+
+def loop_circle_radius(lats, lons, max_lats, max_lons, min_lats, min_lons):
+    return numpy.array(
+        [
+            geocalc.circle_radius(*values)
+            for values in zip(lats, lons, max_lats, max_lons, min_lats, min_lons)
+        ]
+    )
+
+
+def loop_grouped_max_distance(lats, lons, points, starts):
+    ends = list(starts[1:]) + [len(points)]
+    return numpy.array(
+        [
+            geocalc.max_distance(lat, lon, points[start:end])
+            for lat, lon, start, end in zip(lats, lons, starts, ends)
+        ]
+    )
+
+
+def cases(size, seed=42):
+    """Return a list of (name, scalar loop, array function) for the inputs."""
+    rng = numpy.random.default_rng(seed)
+    lats1 = rng.uniform(-60.0, 60.0, size)
+    lons1 = rng.uniform(-180.0, 180.0, size)
+    lats2 = lats1 + rng.uniform(-0.5, 0.5, size)
+    lons2 = lons1 + rng.uniform(-0.5, 0.5, size)
+    meters = rng.uniform(100.0, 50000.0, size)
+    spread = rng.uniform(0.0, 0.1, (4, size))
+    max_lats, min_lats = lats1 + spread[0], lats1 - spread[1]
+    max_lons, min_lons = lons1 + spread[2], lons1 - spread[3]
+    group_size = 10
+    points = numpy.column_stack(
+        (numpy.repeat(lats2, group_size), numpy.repeat(lons2, group_size))
+    )
+    starts = numpy.arange(0, size * group_size, group_size)
+
+    lat, lon = float(lats1[0]), float(lons1[0])
+    return [
+        (
+            "distance, one to many",
+            lambda: loop_distance_one(lat, lon, lats2, lons2),
+            lambda: geocalc.distance_array(lat, lon, lats2, lons2),
+        ),
+        (
+            "distance, pairwise",
+            lambda: loop_distance_pairs(lats1, lons1, lats2, lons2),
+            lambda: geocalc.distance_array(lats1, lons1, lats2, lons2),
+        ),
+        (
+            "bbox",
+            lambda: loop_bbox(lats1, lons1, meters),
+            lambda: geocalc.bbox_array(lats1, lons1, meters),
+        ),
+        (
+            "circle_radius",
+            lambda: loop_circle_radius(
+                lats1, lons1, max_lats, max_lons, min_lats, min_lons
+            ),
+            lambda: geocalc.circle_radius_array(
+                lats1, lons1, max_lats, max_lons, min_lats, min_lons
+            ),
+        ),
+        (
+            f"max_distance, groups of {group_size}",
+            lambda: loop_grouped_max_distance(lats1, lons1, points, starts),
+            lambda: geocalc.grouped_max_distance(
+                lats1, lons1, points[:, 0], points[:, 1], starts
+            ),
+        ),
+    ]
+
+
+def best_time(func, repeat):
+    timer = Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--size", type=int, default=10000, help="Values per call (default 10000)"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Timing repeats (default 5)"
+    )
+    args = parser.parse_args(argv)
+
+    print(f"{'function':<32} {'scalar loop':>12} {'array':>12} {'speedup':>8}")
+    for name, scalar, vectorized in cases(args.size):
+        scalar_s = best_time(scalar, args.repeat)
+        array_s = best_time(vectorized, args.repeat)
+        print(
+            f"{name:<32} {scalar_s * 1000:>10.2f}ms {array_s * 1000:>10.2f}ms"
+            f" {scalar_s / array_s:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
 # cython: language_level=3, emit_code_comments=False
 
-from libc.math cimport asin, atan, atan2, cos
-from libc.math cimport fmax, fmin, M_PI, sin, sqrt, tan
+from libc.math cimport asin, atan, atan2, cos, fabs
+from libc.math cimport fmax, fmin, M_PI, rint, sin, sqrt, tan
+from libc.stdint cimport int64_t
 from numpy cimport double_t, ndarray
 cimport cython
 
@@ -78,12 +79,13 @@ cdef double* RANDOM_LON = [
     0.8279, 0.7611, 0.8101, 0.9157, 0.004, 0.9844, 0.3872, 0.7046,
 ]
 
-cdef inline double deg2rad(double degrees):
+@cython.cdivision(True)
+cdef inline double deg2rad(double degrees) nogil:
     return degrees * M_PI / 180.0
 
 
 @cython.cdivision(True)
-cdef inline double rad2deg(double radians):
+cdef inline double rad2deg(double radians) nogil:
     return radians * 180.0 / M_PI
 
 
@@ -125,10 +127,7 @@ cpdef double distance(double lat1, double lon1,
                       double lat2, double lon2):
     # Default to Vincenty distance, falling back to Haversine if
     # Vincenty doesn't converge in VINCENTY_ITERATIONS iterations.
-    try:
-        return vincenty_distance(lat1, lon1, lat2, lon2)
-    except ValueError:
-        return haversine_distance(lat1, lon1, lat2, lon2)
+    return _distance(lat1, lon1, lat2, lon2)
 
 
 cpdef double haversine_distance(double lat1, double lon1,
@@ -152,17 +151,7 @@ cpdef double haversine_distance(double lat1, double lon1,
     equator, though generally below 0.3%, depending on latitude and
     direction of travel.
     """
-    cdef double a, c, dLat, dLon
-
-    dLat = deg2rad(lat2 - lat1) / 2.0
-    dLon = deg2rad(lon2 - lon1) / 2.0
-
-    lat1 = deg2rad(lat1)
-    lat2 = deg2rad(lat2)
-
-    a = sin(dLat) ** 2 + cos(lat1) * cos(lat2) * sin(dLon) ** 2
-    c = asin(fmin(1, sqrt(a)))
-    return 1000.0 * 2.0 * EARTH_RADIUS * c
+    return _haversine(lat1, lon1, lat2, lon2)
 
 
 cpdef double vincenty_distance(double lat1, double lon1,
@@ -176,6 +165,62 @@ cpdef double vincenty_distance(double lat1, double lon1,
       * http://www.movable-type.co.uk/scripts/latlong-vincenty.html
       * https://github.com/geopy/geopy/blob/master/geopy/distance.py
     """
+    cdef bint failed = False
+    cdef double result = _vincenty(lat1, lon1, lat2, lon2, &failed)
+    if failed:
+        raise ValueError("Vincenty formula failed to converge!")
+    return result
+
+
+cpdef tuple destination(double lat1, double lon1,
+                        double bearing, double distance):
+    """
+    Given an initial point, a bearing and a distance in meters,
+    compute the destination point using the Vincenty formula.
+
+    References:
+      * https://en.wikipedia.org/wiki/Vincenty's_formulae
+      * http://www.movable-type.co.uk/scripts/latlong-vincenty.html
+      * https://github.com/geopy/geopy/blob/master/geopy/distance.py
+    """
+    cdef double lat2, lon2
+
+    if _destination(lat1, lon1, bearing, distance, &lat2, &lon2) < 0:
+        raise ValueError("Vincenty formula failed to converge!")
+    return (lat2, lon2)
+
+
+# The C implementations don't hold the GIL, so they can be used in the
+# array functions. They signal a failure to converge instead of raising.
+
+cdef inline double _distance(double lat1, double lon1,
+                             double lat2, double lon2) nogil:
+    cdef bint failed = False
+    cdef double result = _vincenty(lat1, lon1, lat2, lon2, &failed)
+    if failed:
+        return _haversine(lat1, lon1, lat2, lon2)
+    return result
+
+
+@cython.cdivision(True)
+cdef double _haversine(double lat1, double lon1,
+                       double lat2, double lon2) nogil:
+    cdef double a, c, dLat, dLon
+
+    dLat = deg2rad(lat2 - lat1) / 2.0
+    dLon = deg2rad(lon2 - lon1) / 2.0
+
+    lat1 = deg2rad(lat1)
+    lat2 = deg2rad(lat2)
+
+    a = sin(dLat) ** 2 + cos(lat1) * cos(lat2) * sin(dLon) ** 2
+    c = asin(fmin(1, sqrt(a)))
+    return 1000.0 * 2.0 * EARTH_RADIUS * c
+
+
+@cython.cdivision(True)
+cdef double _vincenty(double lat1, double lon1,
+                      double lat2, double lon2, bint* failed) nogil:
     cdef double delta_lon, reduced_lat1, reduced_lat2
     cdef double sin_reduced1, cos_reduced1, sin_reduced2, cos_reduced2
     cdef double lambda_lon, lambda_prime
@@ -203,7 +248,7 @@ cpdef double vincenty_distance(double lat1, double lon1,
     lambda_prime = 2.0 * M_PI
 
     i = 0
-    while (abs(lambda_lon - lambda_prime) > VINCENTY_CUTOFF and
+    while (fabs(lambda_lon - lambda_prime) > VINCENTY_CUTOFF and
            i <= VINCENTY_ITERATIONS):
         i += 1
 
@@ -252,7 +297,8 @@ cpdef double vincenty_distance(double lat1, double lon1,
         )
 
     if i > VINCENTY_ITERATIONS:
-        raise ValueError("Vincenty formula failed to converge!")
+        failed[0] = True
+        return 0.0
 
     u_sq = (
         cos_sq_alpha *
@@ -285,22 +331,15 @@ cpdef double vincenty_distance(double lat1, double lon1,
     return 1000.0 * EARTH_MINOR_RADIUS * A * (sigma - delta_sigma)
 
 
-cpdef tuple destination(double lat1, double lon1,
-                        double bearing, double distance):
-    """
-    Given an initial point, a bearing and a distance in meters,
-    compute the destination point using the Vincenty formula.
-
-    References:
-      * https://en.wikipedia.org/wiki/Vincenty's_formulae
-      * http://www.movable-type.co.uk/scripts/latlong-vincenty.html
-      * https://github.com/geopy/geopy/blob/master/geopy/distance.py
-    """
+@cython.cdivision(True)
+cdef int _destination(double lat1, double lon1,
+                      double bearing, double distance,
+                      double* lat2_out, double* lon2_out) nogil:
     cdef int i
     cdef double tan_reduced1, cos_reduced1, sin_bearing, cos_bearing
-    cdef double sigma1, sin_alpha, cos_sq_alpha, u_sq, A, B, C
+    cdef double sin_reduced1, sigma1, sin_alpha, cos_sq_alpha, u_sq, A, B, C
     cdef double sigma, sigma_prime, cos2_sigma_m, sin_sigma, cos_sigma
-    cdef double delta_sigma, lat2, lon2, lambda_lon, delta_lon
+    cdef double delta_sigma, lat2, lambda_lon, delta_lon
 
     lat1 = deg2rad(lat1)
     lon1 = deg2rad(lon1)
@@ -338,7 +377,7 @@ cpdef tuple destination(double lat1, double lon1,
     sigma_prime = 2 * M_PI
 
     i = 0
-    while (abs(sigma - sigma_prime) > VINCENTY_CUTOFF and
+    while (fabs(sigma - sigma_prime) > VINCENTY_CUTOFF and
            i <= VINCENTY_ITERATIONS):
         i += 1
 
@@ -360,7 +399,7 @@ cpdef tuple destination(double lat1, double lon1,
         sigma = distance / (EARTH_MINOR_RADIUS * A) + delta_sigma
 
     if i > VINCENTY_ITERATIONS:
-        raise ValueError("Vincenty formula failed to converge!")
+        return -1  # Failed to converge
 
     sin_sigma = sin(sigma)
     cos_sigma = cos(sigma)
@@ -391,11 +430,9 @@ cpdef tuple destination(double lat1, double lon1,
                     (-1.0 + 2.0 * cos2_sigma_m ** 2)))
     )
 
-    lon2 = lon1 + delta_lon
-    lat2 = rad2deg(lat2)
-    lon2 = rad2deg(lon2)
-
-    return (lat2, lon2)
+    lat2_out[0] = rad2deg(lat2)
+    lon2_out[0] = rad2deg(lon1 + delta_lon)
+    return 0
 
 
 cpdef double latitude_add(double lat, double lon, double distance):
@@ -477,3 +514,237 @@ cpdef list random_points(long lat, long lon, int num):
             (lon_d + RANDOM_LON[lon_random + i]) / 1000.0))
 
     return result
+
+
+@cython.cdivision(True)
+cdef inline int64_t floor_mod(int64_t value, int64_t divisor) nogil:
+    # The modulo with the sign of the divisor, like in Python.
+    cdef int64_t result = value % divisor
+    if result < 0:
+        result += divisor
+    return result
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def random_points_array(lat, lon, num):
+    """
+    Given arrays of the scaled latitudes, longitudes and ages of
+    datamap rows, return a tuple of arrays of the latitudes and
+    longitudes of all their points.
+
+    The points are the same as those returned by
+    :func:`random_points`, in the order of the rows.
+    """
+    cdef const int64_t[::1] lat_v = numpy.ascontiguousarray(lat, dtype=numpy.int64)
+    cdef const int64_t[::1] lon_v = numpy.ascontiguousarray(lon, dtype=numpy.int64)
+    cdef const int64_t[::1] num_v = numpy.ascontiguousarray(num, dtype=numpy.int64)
+    cdef Py_ssize_t rows = lat_v.shape[0]
+    cdef Py_ssize_t i, j, total = 0, pos = 0
+    cdef int64_t row_lat, row_lon, lat_random, lon_random
+    cdef double[::1] lat_out, lon_out
+
+    if lon_v.shape[0] != rows or num_v.shape[0] != rows:
+        raise ValueError("The lat, lon and num arrays must have the same length.")
+
+    multiplier = numpy.empty(rows, dtype=numpy.int64)
+    cdef int64_t[::1] multiplier_v = multiplier
+
+    with nogil:
+        for i in range(rows):
+            multiplier_v[i] = min(max(13 - num_v[i], 0), 13) // 2
+            total += multiplier_v[i]
+
+    lats = numpy.empty(total, dtype=numpy.double)
+    lons = numpy.empty(total, dtype=numpy.double)
+    lat_out = lats
+    lon_out = lons
+
+    with nogil:
+        for i in range(rows):
+            row_lat = lat_v[i]
+            row_lon = lon_v[i]
+            lat_random = floor_mod(floor_mod(row_lon * (row_lat * 17), 1021), 179)
+            lon_random = floor_mod(floor_mod(row_lat * (row_lon * 11), 1913), 181)
+            for j in range(multiplier_v[i]):
+                lat_out[pos] = (row_lat + RANDOM_LAT[lat_random + j]) / 1000.0
+                lon_out[pos] = (row_lon + RANDOM_LON[lon_random + j]) / 1000.0
+                pos += 1
+
+    return (lats, lons)
+
+
+# Array functions, which release the GIL while looping over the values.
+
+cdef inline double _latitude_add(double lat, double lon, double distance,
+                                 bint* failed) nogil:
+    cdef double lat1, lon1
+
+    if _destination(lat, lon, 0.0, distance, &lat1, &lon1) < 0:
+        failed[0] = True
+    return fmax(MIN_LAT, fmin(lat1, MAX_LAT))
+
+
+cdef inline double _longitude_add(double lat, double lon, double distance,
+                                  bint* failed) nogil:
+    cdef double lat1, lon1
+
+    if _destination(lat, lon, 90.0, distance, &lat1, &lon1) < 0:
+        failed[0] = True
+    return fmax(MIN_LON, fmin(lon1, MAX_LON))
+
+
+def _broadcast(*values):
+    """
+    Broadcast the values against each other like numpy arrays, and
+    return the common shape and a flat double array for each value.
+    """
+    arrays = numpy.broadcast_arrays(
+        *[numpy.asarray(value, dtype=numpy.double) for value in values])
+    return arrays[0].shape, [
+        numpy.ascontiguousarray(array.ravel()) for array in arrays]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def distance_array(lat1, lon1, lat2, lon2):
+    """
+    Return an array of the distances in meters between pairs of
+    points, calculated like :func:`distance`.
+
+    The arguments are broadcast against each other, so one point can
+    be compared to an array of points, or two arrays of points
+    pairwise. Passing ``lat1[:, None]`` and ``lon1[:, None]`` returns
+    the matrix of the distances between all points of both arrays.
+    """
+    cdef const double[::1] lat1_v, lon1_v, lat2_v, lon2_v
+    cdef double[::1] out
+    cdef Py_ssize_t i
+
+    shape, arrays = _broadcast(lat1, lon1, lat2, lon2)
+    lat1_v, lon1_v, lat2_v, lon2_v = arrays
+    result = numpy.empty(lat1_v.shape[0], dtype=numpy.double)
+    out = result
+
+    with nogil:
+        for i in range(out.shape[0]):
+            out[i] = _distance(lat1_v[i], lon1_v[i], lat2_v[i], lon2_v[i])
+
+    return result.reshape(shape)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def bbox_array(lat, lon, meters):
+    """
+    Return a tuple of arrays (max_lat, min_lat, max_lon, min_lon) of
+    the bounding boxes around positions, calculated like :func:`bbox`.
+
+    The arguments are broadcast against each other.
+    """
+    cdef const double[::1] lat_v, lon_v, meters_v
+    cdef double[::1] max_lat_v, min_lat_v, max_lon_v, min_lon_v
+    cdef Py_ssize_t i
+    cdef bint failed = False
+
+    shape, arrays = _broadcast(lat, lon, meters)
+    lat_v, lon_v, meters_v = arrays
+    results = [
+        numpy.empty(lat_v.shape[0], dtype=numpy.double) for i in range(4)]
+    max_lat_v, min_lat_v, max_lon_v, min_lon_v = results
+
+    with nogil:
+        for i in range(lat_v.shape[0]):
+            max_lat_v[i] = _latitude_add(lat_v[i], lon_v[i], meters_v[i], &failed)
+            min_lat_v[i] = _latitude_add(lat_v[i], lon_v[i], -meters_v[i], &failed)
+            max_lon_v[i] = _longitude_add(lat_v[i], lon_v[i], meters_v[i], &failed)
+            min_lon_v[i] = _longitude_add(lat_v[i], lon_v[i], -meters_v[i], &failed)
+
+    if failed:
+        raise ValueError("Vincenty formula failed to converge!")
+    return tuple(result.reshape(shape) for result in results)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def circle_radius_array(lat, lon, max_lat, max_lon, min_lat, min_lon):
+    """
+    Return an integer array of the maximum distances in meters from
+    positions to the corners of their bounding boxes, calculated like
+    :func:`circle_radius`.
+
+    The arguments are broadcast against each other.
+    """
+    cdef const double[::1] lat_v, lon_v, max_lat_v, max_lon_v, min_lat_v, min_lon_v
+    cdef int64_t[::1] out
+    cdef double radius
+    cdef Py_ssize_t i
+
+    shape, arrays = _broadcast(lat, lon, max_lat, max_lon, min_lat, min_lon)
+    lat_v, lon_v, max_lat_v, max_lon_v, min_lat_v, min_lon_v = arrays
+    result = numpy.empty(lat_v.shape[0], dtype=numpy.int64)
+    out = result
+
+    with nogil:
+        for i in range(out.shape[0]):
+            radius = fmax(0.0, _distance(
+                lat_v[i], lon_v[i], min_lat_v[i], min_lon_v[i]))
+            radius = fmax(radius, _distance(
+                lat_v[i], lon_v[i], min_lat_v[i], max_lon_v[i]))
+            radius = fmax(radius, _distance(
+                lat_v[i], lon_v[i], max_lat_v[i], min_lon_v[i]))
+            radius = fmax(radius, _distance(
+                lat_v[i], lon_v[i], max_lat_v[i], max_lon_v[i]))
+            # Round half to even, like round() in circle_radius
+            out[i] = <int64_t>rint(radius)
+
+    return result.reshape(shape)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def grouped_max_distance(lat, lon, points_lat, points_lon, starts):
+    """
+    Return an array of the maximum distances in meters from each of
+    the lat/lon positions to a group of points, like
+    :func:`max_distance`.
+
+    The points of all groups are passed in as flat arrays, sorted by
+    group, and ``starts`` holds the index of the first point of each
+    group, like for ``numpy.ufunc.reduceat``.
+    """
+    cdef const double[::1] lat_v, lon_v, points_lat_v, points_lon_v
+    cdef const int64_t[::1] starts_v
+    cdef double[::1] out
+    cdef Py_ssize_t i, j, end, groups, points
+    cdef double result_i
+
+    lat_v = numpy.ascontiguousarray(lat, dtype=numpy.double)
+    lon_v = numpy.ascontiguousarray(lon, dtype=numpy.double)
+    points_lat_v = numpy.ascontiguousarray(points_lat, dtype=numpy.double)
+    points_lon_v = numpy.ascontiguousarray(points_lon, dtype=numpy.double)
+    starts_v = numpy.ascontiguousarray(starts, dtype=numpy.int64)
+    groups = starts_v.shape[0]
+    points = points_lat_v.shape[0]
+    if lat_v.shape[0] != groups or lon_v.shape[0] != groups:
+        raise ValueError("There must be one lat/lon position per group.")
+    if points_lon_v.shape[0] != points:
+        raise ValueError("The points_lat and points_lon arrays must have the same length.")
+    for i in range(groups):
+        end = starts_v[i + 1] if i + 1 < groups else points
+        if not 0 <= starts_v[i] <= end <= points:
+            raise ValueError("The group starts must be sorted indices into the points.")
+
+    result = numpy.zeros(groups, dtype=numpy.double)
+    out = result
+
+    with nogil:
+        for i in range(groups):
+            end = starts_v[i + 1] if i + 1 < groups else points
+            result_i = 0.0
+            for j in range(starts_v[i], end):
+                result_i = fmax(result_i, _distance(
+                    lat_v[i], lon_v[i], points_lat_v[j], points_lon_v[j]))
+            out[i] = result_i
+
+    return result
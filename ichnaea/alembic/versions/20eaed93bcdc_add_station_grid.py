@@ -0,0 +1,65 @@
+"""Add spatial grid column to station tables
+
+Revision ID: 20eaed93bcdc
+Revises: 6ec824122610
+Create Date: 2026-10-19 10:05:12.518274
+"""
+
+import logging
+import re
+
+from alembic import op
+import sqlalchemy as sa
+
+
+log = logging.getLogger("alembic.migration")
+revision = "20eaed93bcdc"
+down_revision = "6ec824122610"
+
+# Include the shard tables of re-sharded layouts.
+STATION_TABLE = re.compile(r"^((blue|wifi)_shard_[0-9a-f]{1,2}|cell_(gsm|wcdma|lte))$")
+
+# Matches ichnaea.models.station.station_grid, with 10 grid cells per degree.
+GRID_KEY = (
+    "LEAST(GREATEST(FLOOR((`lat` + 90.0) * 10), 0), 1800) * 3601 + "
+    "LEAST(GREATEST(FLOOR((`lon` + 180.0) * 10), 0), 3600)"
+)
+
+
+def station_tables():
+    inspector = sa.inspect(op.get_bind())
+    return sorted(
+        name for name in inspector.get_table_names() if STATION_TABLE.match(name)
+    )
+
+
+def upgrade():
+    for table in station_tables():
+        log.info("Add grid column to %s table.", table)
+        op.execute(
+            sa.text(
+                "ALTER TABLE {table} "
+                "ADD COLUMN `grid` INT(10) UNSIGNED DEFAULT NULL, "
+                "ADD INDEX `{table}_grid_idx` (`grid`)".format(table=table)
+            )
+        )
+        op.execute(
+            sa.text(
+                "UPDATE {table} SET `grid` = {key} "
+                "WHERE `lat` IS NOT NULL AND `lon` IS NOT NULL".format(
+                    table=table, key=GRID_KEY
+                )
+            )
+        )
+
+
+def downgrade():
+    for table in station_tables():
+        log.info("Drop grid column from %s table.", table)
+        op.execute(
+            sa.text(
+                "ALTER TABLE {table} "
+                "DROP KEY `{table}_grid_idx`, "
+                "DROP COLUMN `grid`".format(table=table)
+            )
+        )
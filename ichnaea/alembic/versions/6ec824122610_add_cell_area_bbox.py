@@ -0,0 +1,42 @@
+"""Add bounding box columns to cell_area
+
+Revision ID: 6ec824122610
+Revises: 3be4004781bc
+Create Date: 2026-10-19 09:12:41.206913
+"""
+
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+log = logging.getLogger("alembic.migration")
+revision = "6ec824122610"
+down_revision = "3be4004781bc"
+
+
+def upgrade():
+    log.info("Add bounding box columns to cell_area table.")
+    op.execute(
+        sa.text(
+            "ALTER TABLE cell_area "
+            "ADD COLUMN `max_lat` DOUBLE DEFAULT NULL AFTER `lon`, "
+            "ADD COLUMN `min_lat` DOUBLE DEFAULT NULL AFTER `max_lat`, "
+            "ADD COLUMN `max_lon` DOUBLE DEFAULT NULL AFTER `min_lat`, "
+            "ADD COLUMN `min_lon` DOUBLE DEFAULT NULL AFTER `max_lon`"
+        )
+    )
+
+
+def downgrade():
+    log.info("Drop bounding box columns from cell_area table.")
+    op.execute(
+        sa.text(
+            "ALTER TABLE cell_area "
+            "DROP COLUMN `max_lat`, "
+            "DROP COLUMN `min_lat`, "
+            "DROP COLUMN `max_lon`, "
+            "DROP COLUMN `min_lon`"
+        )
+    )
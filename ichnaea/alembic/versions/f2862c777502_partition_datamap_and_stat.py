@@ -0,0 +1,112 @@
+"""Partition datamap and stat tables by month
+
+Revision ID: f2862c777502
+Revises: 20eaed93bcdc
+Create Date: 2026-10-19 14:21:40.613020
+"""
+
+from datetime import date, timedelta
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+log = logging.getLogger("alembic.migration")
+revision = "f2862c777502"
+down_revision = "20eaed93bcdc"
+
+DATAMAP_SHARDS = ("ne", "nw", "se", "sw")
+
+# Matches ichnaea.data.partition, the first partition also holds all
+# older rows, the cleanup tasks add new partitions ahead of time.
+MONTHS_AHEAD = 3
+
+
+def next_month(day):
+    if day.month == 12:
+        return date(day.year + 1, 1, 1)
+    return date(day.year, day.month + 1, 1)
+
+
+def partitions(retention_days):
+    today = date.today()
+    month = (today - timedelta(days=retention_days)).replace(day=1)
+    last = today.replace(day=1)
+    for i in range(MONTHS_AHEAD):
+        last = next_month(last)
+
+    definitions = []
+    while month <= last:
+        upper = next_month(month)
+        definitions.append(
+            "PARTITION p{name} VALUES LESS THAN ('{upper}')".format(
+                name=month.strftime("%Y%m"), upper=upper.isoformat()
+            )
+        )
+        month = upper
+    definitions.append("PARTITION pmax VALUES LESS THAN (MAXVALUE)")
+    return ",\n".join(definitions)
+
+
+def upgrade():
+    for shard_id in DATAMAP_SHARDS:
+        table = "datamap_" + shard_id
+        log.info("Partition %s table.", table)
+        op.execute(
+            sa.text(
+                "UPDATE {table} SET `modified` = COALESCE(`created`, CURDATE()) "
+                "WHERE `modified` IS NULL".format(table=table)
+            )
+        )
+        op.execute(
+            sa.text(
+                "ALTER TABLE {table} "
+                "MODIFY `modified` DATE NOT NULL, "
+                "DROP PRIMARY KEY, "
+                "ADD PRIMARY KEY (`grid`, `modified`)".format(table=table)
+            )
+        )
+        op.execute(
+            sa.text(
+                "ALTER TABLE {table} PARTITION BY RANGE COLUMNS(`modified`) "
+                "(\n{partitions}\n)".format(table=table, partitions=partitions(365))
+            )
+        )
+
+    log.info("Partition stat table.")
+    op.execute(
+        sa.text(
+            "ALTER TABLE stat PARTITION BY RANGE COLUMNS(`time`) "
+            "(\n{partitions}\n)".format(partitions=partitions(365 * 2))
+        )
+    )
+
+
+def downgrade():
+    log.info("Remove partitioning of stat table.")
+    op.execute(sa.text("ALTER TABLE stat REMOVE PARTITIONING"))
+
+    for shard_id in DATAMAP_SHARDS:
+        table = "datamap_" + shard_id
+        log.info("Remove partitioning of %s table.", table)
+        op.execute(
+            sa.text("ALTER TABLE {table} REMOVE PARTITIONING".format(table=table))
+        )
+        # Keep the most recent row of each grid.
+        op.execute(
+            sa.text(
+                "DELETE old FROM {table} old JOIN {table} new "
+                "ON old.`grid` = new.`grid` AND old.`modified` < new.`modified`".format(
+                    table=table
+                )
+            )
+        )
+        op.execute(
+            sa.text(
+                "ALTER TABLE {table} "
+                "DROP PRIMARY KEY, "
+                "ADD PRIMARY KEY (`grid`), "
+                "MODIFY `modified` DATE DEFAULT NULL".format(table=table)
+            )
+        )
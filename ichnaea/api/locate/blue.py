@@ -35,6 +35,7 @@ class BluePositionMixin(object):
     raven_client = None
     result_list = PositionResultList
     result_type = Position
+    snapshot = None
 
     def should_search_blue(self, query, results):
         return bool(query.blue)
@@ -42,7 +43,9 @@ class BluePositionMixin(object):
     def search_blue(self, query):
         results = self.result_list()
 
-        blues = query_macs(query, query.blue, self.raven_client, BlueShard)
+        blues = query_macs(
+            query, query.blue, self.raven_client, BlueShard, snapshot=self.snapshot
+        )
         for cluster in cluster_networks(
             blues,
             query.blue,
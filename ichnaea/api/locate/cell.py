@@ -20,7 +20,7 @@ from ichnaea.api.locate.result import (
     RegionResultList,
 )
 from ichnaea.api.locate.score import area_score, station_score
-from geocalc import distance
+from geocalc import distance_array
 from ichnaea.geocode import GEOCODER
 from ichnaea.models import (
     area_id,
@@ -164,16 +164,13 @@ def aggregate_cell_position(networks, min_accuracy, max_accuracy):
 
     # Guess the accuracy as the 95th percentile of the distances
     # from the lat/lon to the positions of all networks.
-    distances = numpy.array(
-        [distance(lat, lon, net["lat"], net["lon"]) for net in networks],
-        dtype=numpy.double,
-    )
+    distances = distance_array(lat, lon, networks["lat"], networks["lon"])
     accuracy = min(max(numpy.percentile(distances, 95), min_accuracy), max_accuracy)
 
     return (float(lat), float(lon), float(accuracy), float(score))
 
 
-def query_cells(query, lookups, model, raven_client):
+def query_cells(query, lookups, model, raven_client, snapshot=None):
     # Given a location query and a list of lookup instances, query the
     # database and return a list of model objects.
     cellids = [lookup.cellid for lookup in lookups]
@@ -204,16 +201,20 @@ def query_cells(query, lookups, model, raven_client):
             shards[model.shard_model(lookup.radioType)].append(lookup.cellid)
 
         for shard, shard_cellids in shards.items():
-            columns = shard.__table__.c
-            fields = [getattr(columns, f) for f in load_fields]
-            rows = (
-                query.session.execute(
-                    select(fields)
-                    .where(columns.lat.isnot(None))
-                    .where(columns.lon.isnot(None))
-                    .where(columns.cellid.in_(shard_cellids))
-                )
-            ).fetchall()
+            rows = None
+            if snapshot is not None:
+                rows = snapshot.fetch(shard.__tablename__, shard_cellids)
+            if rows is None:
+                columns = shard.__table__.c
+                fields = [getattr(columns, f) for f in load_fields]
+                rows = (
+                    query.session.execute(
+                        select(fields)
+                        .where(columns.lat.isnot(None))
+                        .where(columns.lon.isnot(None))
+                        .where(columns.cellid.in_(shard_cellids))
+                    )
+                ).fetchall()
 
             result.extend([row for row in rows if not station_blocked(row, today)])
     except Exception:
@@ -222,7 +223,7 @@ def query_cells(query, lookups, model, raven_client):
     return result
 
 
-def query_areas(query, lookups, model, raven_client):
+def query_areas(query, lookups, model, raven_client, snapshot=None):
     areaids = [lookup.areaid for lookup in lookups]
     if not areaids:
         return []
@@ -241,6 +242,11 @@ def query_areas(query, lookups, model, raven_client):
         "last_seen",
     )
     try:
+        if snapshot is not None:
+            rows = snapshot.fetch(model.__tablename__, areaids)
+            if rows is not None:
+                return rows
+
         columns = model.__table__.c
         fields = [getattr(columns, f) for f in load_fields]
         rows = (
@@ -267,6 +273,7 @@ class CellPositionMixin(object):
     area_model = CellArea
     result_list = PositionResultList
     result_type = Position
+    snapshot = None
 
     def should_search_cell(self, query, results):
         if not (query.cell or query.cell_area):
@@ -277,7 +284,13 @@ class CellPositionMixin(object):
         results = self.result_list()
 
         if query.cell:
-            cells = query_cells(query, query.cell, self.cell_model, self.raven_client)
+            cells = query_cells(
+                query,
+                query.cell,
+                self.cell_model,
+                self.raven_client,
+                snapshot=self.snapshot,
+            )
             if cells:
                 for cluster in cluster_cells(cells, query.cell):
                     lat, lon, accuracy, score = aggregate_cell_position(
@@ -304,7 +317,11 @@ class CellPositionMixin(object):
 
         if query.cell_area:
             areas = query_areas(
-                query, query.cell_area, self.area_model, self.raven_client
+                query,
+                query.cell_area,
+                self.area_model,
+                self.raven_client,
+                snapshot=self.snapshot,
             )
             if areas:
                 for cluster in cluster_areas(areas, query.cell_area):
@@ -3,8 +3,10 @@
 from ichnaea.api.locate.blue import BluePositionMixin, BlueRegionMixin
 from ichnaea.api.locate.cell import CellPositionMixin, CellRegionMixin
 from ichnaea.api.locate.constants import DataSource
+from ichnaea.api.locate.snapshot import StationSnapshot
 from ichnaea.api.locate.source import PositionSource, RegionSource
 from ichnaea.api.locate.wifi import WifiPositionMixin, WifiRegionMixin
+from ichnaea.conf import settings
 
 
 class BaseInternalSource(object):
@@ -50,6 +52,12 @@ class InternalPositionSource(
 ):
     """A position source based on our own crowd-sourced internal data."""
 
+    def __init__(self, *args, **kwargs):
+        super(InternalPositionSource, self).__init__(*args, **kwargs)
+        snapshot_path = settings("locate_snapshot_path")
+        if snapshot_path:
+            self.snapshot = StationSnapshot(snapshot_path)
+
     def _store_query(self, query, results):
         best_result = results.best()
         if not best_result:
@@ -2,15 +2,13 @@
 
 from base64 import b64decode
 from collections import defaultdict
-import itertools
-import math
 
 import numpy
 from scipy.cluster import hierarchy
 from scipy.optimize import leastsq
 from sqlalchemy import select
 
-from geocalc import distance
+from geocalc import distance, distance_array
 from ichnaea.api.locate.score import station_score
 from ichnaea.models import decode_mac, encode_mac, station_blocked
 from ichnaea import util
@@ -91,9 +89,15 @@ def cluster_networks(
     # We avoid the special cases for length < 2 with the above checks.
     # See scipy.spatial.distance.squareform and
     # https://stackoverflow.com/questions/13079563
-    dist_matrix = numpy.zeros(length * (length - 1) // 2, dtype=numpy.double)
-    for i, (a, b) in enumerate(itertools.combinations(positions, 2)):
-        dist_matrix[i] = distance(a[0], a[1], b[0], b[1])
+    # The upper triangle indices are in the same order as
+    # itertools.combinations(positions, 2).
+    first, second = numpy.triu_indices(length, 1)
+    dist_matrix = distance_array(
+        positions["lat"][first],
+        positions["lon"][first],
+        positions["lat"][second],
+        positions["lon"][second],
+    )
 
     link_matrix = hierarchy.linkage(dist_matrix, method="complete")
     assignments = hierarchy.fcluster(
@@ -115,14 +119,14 @@ def cluster_networks(
 def aggregate_mac_position(networks, minimum_accuracy):
     # Idea based on https://gis.stackexchange.com/questions/40660
 
+    age_factors = numpy.minimum(numpy.sqrt(2000.0 / networks["age"]), 1.0)
+    signal_squares = numpy.square(networks["signalStrength"], dtype=numpy.double)
+
     def func(point, points):
-        return numpy.array(
-            [
-                distance(p["lat"], p["lon"], point[0], point[1])
-                * min(math.sqrt(2000.0 / p["age"]), 1.0)
-                / math.pow(p["signalStrength"], 2)
-                for p in points
-            ]
+        return (
+            distance_array(points["lat"], points["lon"], point[0], point[1])
+            * age_factors
+            / signal_squares
         )
 
     # Guess initial position as the weighted mean over all networks.
@@ -130,15 +134,7 @@ def aggregate_mac_position(networks, minimum_accuracy):
         [(net["lat"], net["lon"]) for net in networks], dtype=numpy.double
     )
 
-    weights = numpy.array(
-        [
-            net["score"]
-            * min(math.sqrt(2000.0 / net["age"]), 1.0)
-            / math.pow(net["signalStrength"], 2)
-            for net in networks
-        ],
-        dtype=numpy.double,
-    )
+    weights = networks["score"] * age_factors / signal_squares
 
     initial = numpy.average(points, axis=0, weights=weights)
 
@@ -152,10 +148,7 @@ def aggregate_mac_position(networks, minimum_accuracy):
 
     # Guess the accuracy as the 95th percentile of the distances
     # from the lat/lon to the positions of all networks.
-    distances = numpy.array(
-        [distance(lat, lon, net["lat"], net["lon"]) for net in networks],
-        dtype=numpy.double,
-    )
+    distances = distance_array(lat, lon, networks["lat"], networks["lon"])
     accuracy = max(numpy.percentile(distances, 95), minimum_accuracy)
 
     return (float(lat), float(lon), float(accuracy))
@@ -191,7 +184,7 @@ def aggregate_cluster_position(
     )
 
 
-def query_macs(query, lookups, raven_client, db_model):
+def query_macs(query, lookups, raven_client, db_model, snapshot=None):
     macs = [lookup.mac for lookup in lookups]
     if not macs:
         return []
@@ -220,16 +213,20 @@ def query_macs(query, lookups, raven_client, db_model):
             shards[db_model.shard_model(mac)].append(mac)
 
         for shard, shard_macs in shards.items():
-            columns = shard.__table__.c
-            fields = [getattr(columns, f) for f in load_fields]
-            rows = (
-                query.session.execute(
-                    select(fields)
-                    .where(columns.lat.isnot(None))
-                    .where(columns.lon.isnot(None))
-                    .where(columns.mac.in_(shard_macs))
-                )
-            ).fetchall()
+            rows = None
+            if snapshot is not None:
+                rows = snapshot.fetch(shard.__tablename__, shard_macs)
+            if rows is None:
+                columns = shard.__table__.c
+                fields = [getattr(columns, f) for f in load_fields]
+                rows = (
+                    query.session.execute(
+                        select(fields)
+                        .where(columns.lat.isnot(None))
+                        .where(columns.lon.isnot(None))
+                        .where(columns.mac.in_(shard_macs))
+                    )
+                ).fetchall()
 
             result.extend([row for row in rows if not station_blocked(row, today)])
     except Exception:
@@ -0,0 +1,267 @@
+"""
+A read-optimized snapshot of the station tables for the locate path.
+
+A snapshot is a directory with one file per station table. Each file
+holds fixed-width records, sorted by the packed MAC address, cell id
+or cell area id. Web workers memory-map the files and find stations by
+binary search, without querying the database.
+
+The snapshot is rebuilt periodically by ``ichnaea/scripts/snapshot.py``.
+Each file is written under a temporary name and renamed into place, so
+readers either see the old or the new file. Readers check for a new
+file at most once per ``check_interval`` seconds.
+"""
+
+import calendar
+from collections import namedtuple
+from datetime import date, datetime, timedelta, timezone
+import itertools
+import logging
+import os
+import os.path
+import time
+
+import numpy
+
+from ichnaea.models import BlueShard, CellArea, CellShard, WifiShard
+from ichnaea.models.cell import decode_cellarea, decode_cellid
+from ichnaea.models.mac import decode_mac
+
+LOGGER = logging.getLogger(__name__)
+
+EPOCH = date(1970, 1, 1)
+
+NULL = -1
+"""Stored for NULL integers, timestamps and dates."""
+
+STATION_FIELDS = (
+    "lat",
+    "lon",
+    "radius",
+    "region",
+    "samples",
+    "created",
+    "modified",
+    "last_seen",
+    "block_last",
+    "block_count",
+)
+
+STATION_DTYPE = [
+    ("lat", numpy.double),
+    ("lon", numpy.double),
+    ("radius", numpy.int32),
+    ("region", "S2"),
+    ("samples", numpy.int64),
+    ("created", numpy.int64),
+    ("modified", numpy.int64),
+    ("last_seen", numpy.int32),
+    ("block_last", numpy.int32),
+    ("block_count", numpy.int32),
+]
+
+AREA_FIELDS = (
+    "lat",
+    "lon",
+    "radius",
+    "region",
+    "num_cells",
+    "created",
+    "modified",
+    "last_seen",
+)
+
+AREA_DTYPE = [
+    ("lat", numpy.double),
+    ("lon", numpy.double),
+    ("radius", numpy.int32),
+    ("region", "S2"),
+    ("num_cells", numpy.int64),
+    ("created", numpy.int64),
+    ("modified", numpy.int64),
+    ("last_seen", numpy.int32),
+]
+
+
+class SnapshotType(object):
+    """The record layout and row type of one kind of station table."""
+
+    def __init__(self, name, key, key_size, fields, dtype, decode):
+        self.key = key
+        self.fields = fields
+        self.columns = (key,) + fields
+        self.dtype = numpy.dtype([("key", "S%s" % key_size)] + dtype)
+        self.row_type = namedtuple(name, self.columns)
+        self.decode = decode
+
+
+MAC_TYPE = SnapshotType("MacRow", "mac", 6, STATION_FIELDS, STATION_DTYPE, decode_mac)
+CELL_TYPE = SnapshotType(
+    "CellRow", "cellid", 11, STATION_FIELDS, STATION_DTYPE, decode_cellid
+)
+AREA_TYPE = SnapshotType(
+    "AreaRow", "areaid", 7, AREA_FIELDS, AREA_DTYPE, decode_cellarea
+)
+
+
+def snapshot_tables():
+    """Return a dict of table names to their snapshot type."""
+    tables = {CellArea.__tablename__: AREA_TYPE}
+    for shard_model, snapshot_type in (
+        (BlueShard, MAC_TYPE),
+        (CellShard, CELL_TYPE),
+        (WifiShard, MAC_TYPE),
+    ):
+        for shard in shard_model.shards().values():
+            tables[shard.__tablename__] = snapshot_type
+    return tables
+
+
+def _encode_value(name, value):
+    if value is None:
+        return b"" if name == "region" else NULL
+    if name == "region":
+        return value.encode("ascii")
+    if isinstance(value, datetime):
+        # Naive datetimes from the database are in UTC.
+        return calendar.timegm(value.timetuple())
+    if isinstance(value, date):
+        return (value - EPOCH).days
+    return value
+
+
+def _decode_value(name, value):
+    if name in ("lat", "lon"):
+        return float(value)
+    if name == "region":
+        return value.decode("ascii") or None
+    value = int(value)
+    if value == NULL:
+        return None
+    if name in ("created", "modified"):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    if name in ("last_seen", "block_last"):
+        return EPOCH + timedelta(days=value)
+    return value
+
+
+def encode_records(rows, snapshot_type):
+    """Convert raw database rows into an array of snapshot records."""
+    return numpy.array(
+        [
+            tuple(
+                [row[0]]
+                + [
+                    _encode_value(name, value)
+                    for name, value in zip(snapshot_type.fields, row[1:])
+                ]
+            )
+            for row in rows
+        ],
+        dtype=snapshot_type.dtype,
+    )
+
+
+def write_table(path, table_name, snapshot_type, batches):
+    """
+    Write the batches of raw database rows, ordered by their key, into
+    the snapshot file of a table and return the number of records.
+    """
+    filename = os.path.join(path, table_name + ".bin")
+    tmp_filename = "%s.%s.tmp" % (filename, os.getpid())
+    count = 0
+    with open(tmp_filename, "wb") as fd:
+        for rows in batches:
+            encode_records(rows, snapshot_type).tofile(fd)
+            count += len(rows)
+    os.replace(tmp_filename, filename)
+    return count
+
+
+class SnapshotTable(object):
+    """A memory-mapped snapshot file of one station table."""
+
+    def __init__(self, filename, snapshot_type):
+        self.snapshot_type = snapshot_type
+        stat = os.stat(filename)
+        self.inode = (stat.st_dev, stat.st_ino)
+        if stat.st_size:
+            self.records = numpy.memmap(filename, dtype=snapshot_type.dtype, mode="r")
+        else:
+            self.records = numpy.zeros(0, dtype=snapshot_type.dtype)
+        self.keys = self.records["key"]
+
+    def fetch(self, keys):
+        """Return the rows for the packed keys found in the table."""
+        snapshot_type = self.snapshot_type
+        keys = sorted(set(keys))
+        if not keys or not len(self.keys):
+            return []
+
+        needles = numpy.array(keys, dtype=self.keys.dtype)
+        positions = numpy.searchsorted(self.keys, needles)
+        inside = positions < len(self.keys)
+        # Compare as numpy arrays, bytes values lose trailing null bytes.
+        found = numpy.zeros(len(keys), dtype=bool)
+        found[inside] = self.keys[positions[inside]] == needles[inside]
+
+        rows = []
+        for key, position in zip(itertools.compress(keys, found), positions[found]):
+            record = self.records[position]
+            rows.append(
+                snapshot_type.row_type(
+                    snapshot_type.decode(key),
+                    *[
+                        _decode_value(name, record[name])
+                        for name in snapshot_type.fields
+                    ],
+                )
+            )
+        return rows
+
+
+class StationSnapshot(object):
+    """
+    Serve station lookups from a snapshot directory.
+
+    Tables without a snapshot file return None, so the caller can fall
+    back to the database.
+    """
+
+    def __init__(self, path, check_interval=60.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.types = snapshot_tables()
+        self._tables = {}
+        self._checked = {}
+
+    def _table(self, table_name):
+        now = time.monotonic()
+        table = self._tables.get(table_name)
+        checked = self._checked.get(table_name)
+        if checked is not None and now - checked < self.check_interval:
+            return table
+
+        self._checked[table_name] = now
+        filename = os.path.join(self.path, table_name + ".bin")
+        try:
+            stat = os.stat(filename)
+            if table is None or table.inode != (stat.st_dev, stat.st_ino):
+                table = SnapshotTable(filename, self.types[table_name])
+        except FileNotFoundError:
+            table = None
+        except (OSError, ValueError):
+            LOGGER.exception("Failed to open snapshot file %s.", filename)
+            table = None
+        self._tables[table_name] = table
+        return table
+
+    def fetch(self, table_name, keys):
+        """
+        Return the rows for the packed keys found in the snapshot of the
+        table, or None if there is no snapshot for the table.
+        """
+        table = self._table(table_name)
+        if table is None:
+            return None
+        return table.fetch(keys)
@@ -0,0 +1,132 @@
+import os
+from unittest import mock
+
+from ichnaea.api.locate.internal import InternalPositionSource
+from ichnaea.api.locate.snapshot import StationSnapshot
+from ichnaea.api.locate.tests.base import BaseSourceTest
+from ichnaea.models import (
+    CellArea,
+    CellShard,
+    WifiShard,
+    encode_cellarea,
+    encode_cellid,
+    encode_mac,
+)
+from ichnaea.scripts.snapshot import build_snapshot
+from ichnaea.tests.factories import (
+    CellAreaFactory,
+    CellShardFactory,
+    WifiShardFactory,
+)
+from ichnaea import util
+
+
+class TestStationSnapshot(object):
+    def _check_row(self, row, model, fields):
+        for field in fields:
+            assert getattr(row, field) == getattr(model, field), field
+
+    def test_wifi(self, session):
+        wifis = WifiShardFactory.create_batch(3, block_count=1)
+        no_position = WifiShardFactory(lat=None, lon=None)
+        session.flush()
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            counts = build_snapshot(session, temp_dir)
+            assert sum(counts.values()) == 3
+            snapshot = StationSnapshot(temp_dir)
+            for wifi in wifis + [no_position]:
+                table = WifiShard.shard_model(wifi.mac).__tablename__
+                rows = snapshot.fetch(table, [encode_mac(wifi.mac)])
+                if wifi is no_position:
+                    assert rows == []
+                    continue
+                assert len(rows) == 1
+                self._check_row(
+                    rows[0],
+                    wifi,
+                    ("mac", "lat", "lon", "region", "samples"),
+                )
+                assert rows[0].block_count == 1
+                assert rows[0].created.date() == wifi.created.date()
+                assert rows[0].last_seen == wifi.last_seen
+
+    def test_cell(self, session):
+        cell = CellShardFactory()
+        area = CellAreaFactory()
+        session.flush()
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            build_snapshot(session, temp_dir)
+            snapshot = StationSnapshot(temp_dir)
+
+            table = CellShard.shard_model(cell.radio).__tablename__
+            rows = snapshot.fetch(table, [encode_cellid(*cell.cellid)])
+            assert len(rows) == 1
+            self._check_row(rows[0], cell, ("cellid", "lat", "lon", "region"))
+
+            rows = snapshot.fetch(
+                CellArea.__tablename__, [encode_cellarea(*area.areaid)]
+            )
+            assert len(rows) == 1
+            self._check_row(rows[0], area, ("areaid", "lat", "lon", "num_cells"))
+
+    def test_missing(self):
+        with util.selfdestruct_tempdir() as temp_dir:
+            snapshot = StationSnapshot(temp_dir)
+            assert snapshot.fetch("wifi_shard_0", [encode_mac("00aa00bb00cc")]) is None
+
+    def test_swap(self, session):
+        wifi = WifiShardFactory()
+        session.flush()
+        table = WifiShard.shard_model(wifi.mac).__tablename__
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            build_snapshot(session, temp_dir)
+            snapshot = StationSnapshot(temp_dir, check_interval=0.0)
+            assert len(snapshot.fetch(table, [encode_mac(wifi.mac)])) == 1
+
+            session.query(WifiShard.shard_model(wifi.mac)).delete()
+            session.flush()
+            build_snapshot(session, temp_dir)
+            assert snapshot.fetch(table, [encode_mac(wifi.mac)]) == []
+            assert not [name for name in os.listdir(temp_dir) if ".tmp" in name]
+
+
+class TestSnapshotSource(BaseSourceTest):
+
+    Source = InternalPositionSource
+
+    def test_wifi(self, geoip_db, http_session, session, source):
+        wifi = WifiShardFactory(radius=5, samples=50)
+        wifi2 = WifiShardFactory(
+            lat=wifi.lat, lon=wifi.lon + 0.00001, radius=5, samples=100
+        )
+        session.flush()
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            build_snapshot(session, temp_dir)
+            # Remove the stations from the database, to read them
+            # from the snapshot.
+            for model in (wifi, wifi2):
+                session.delete(model)
+            session.flush()
+
+            query = self.model_query(
+                geoip_db, http_session, session, wifis=[wifi, wifi2]
+            )
+            with mock.patch.object(source, "snapshot", StationSnapshot(temp_dir)):
+                results = source.search(query)
+            assert abs(results.best().lat - wifi.lat) < 0.0001
+
+    def test_setting(self, data_queues, geoip_db, raven_client, redis_client):
+        with mock.patch(
+            "ichnaea.api.locate.internal.settings", return_value="/tmp/snapshot"
+        ):
+            source = self.Source(
+                geoip_db=geoip_db,
+                raven_client=raven_client,
+                redis_client=redis_client,
+                data_queues=data_queues,
+            )
+        assert source.snapshot.path == "/tmp/snapshot"
@@ -35,6 +35,7 @@ class WifiPositionMixin(object):
     raven_client = None
     result_list = PositionResultList
     result_type = Position
+    snapshot = None
 
     def should_search_wifi(self, query, results):
         return bool(query.wifi)
@@ -42,7 +43,9 @@ class WifiPositionMixin(object):
     def search_wifi(self, query):
         results = self.result_list()
 
-        wifis = query_macs(query, query.wifi, self.raven_client, WifiShard)
+        wifis = query_macs(
+            query, query.wifi, self.raven_client, WifiShard, snapshot=self.snapshot
+        )
         for cluster in cluster_networks(
             wifis,
             query.wifi,
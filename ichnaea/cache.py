@@ -11,10 +11,11 @@ from redis.exceptions import RedisError
 from ichnaea.conf import settings
 
 
-def configure_redis(cache_url=None, _client=None):
+def configure_redis(cache_url=None, _client=None, max_connections=20):
     """
     Configure and return a :class:`~ichnaea.cache.RedisClient` instance.
 
+    :param max_connections: Size of the connection pool.
     :param _client: Test-only hook to provide a pre-configured client.
     """
     cache_url = settings("redis_uri") if cache_url is None else cache_url
@@ -34,7 +35,7 @@ def configure_redis(cache_url=None, _client=None):
     else:
         db = 0
     pool = redis.ConnectionPool(
-        max_connections=20,
+        max_connections=max_connections,
         host=host,
         port=port,
         db=db,
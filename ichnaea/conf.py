@@ -19,6 +19,13 @@ def logging_level_parser(value):
     return value
 
 
+def shard_ids_parser(value):
+    """Parses a comma-separated list of shard ids."""
+    return tuple(
+        shard_id.strip().lower() for shard_id in value.split(",") if shard_id.strip()
+    )
+
+
 class AppComponent:
     """Everett component for configuring Ichnaea"""
 
@@ -84,6 +91,66 @@ class AppComponent:
             doc="the number of concurrent Celery worker processes executing tasks",
             parser=int,
         )
+        station_skip_locked = Option(
+            doc=(
+                "Whether station update tasks skip (True) or wait for (False)"
+                " station rows locked by other tasks. Observations for"
+                " skipped rows are put back into their queue. Requires MySQL 8."
+            ),
+            default="false",
+            parser=bool,
+        )
+        data_consumer = Option(
+            doc=(
+                "Whether the data queues are processed by the long-running"
+                " location_consumer process (True) instead of scheduled"
+                " Celery tasks (False)."
+            ),
+            default="false",
+            parser=bool,
+        )
+        blue_shards = Option(
+            doc=(
+                "Comma-separated list of Bluetooth shard ids. Each shard id is"
+                " a prefix of one or two hex characters, starting at the fifth"
+                " hex character of the MAC address."
+            ),
+            default="0,1,2,3,4,5,6,7,8,9,a,b,c,d,e,f",
+            parser=shard_ids_parser,
+        )
+        blue_shards_next = Option(
+            doc=(
+                "Comma-separated list of Bluetooth shard ids to re-shard to."
+                " While set, station updates are also written to these shards."
+            ),
+            default="",
+            parser=shard_ids_parser,
+        )
+        wifi_shards = Option(
+            doc=(
+                "Comma-separated list of WiFi shard ids. Each shard id is"
+                " a prefix of one or two hex characters, starting at the fifth"
+                " hex character of the MAC address."
+            ),
+            default="0,1,2,3,4,5,6,7,8,9,a,b,c,d,e,f",
+            parser=shard_ids_parser,
+        )
+        wifi_shards_next = Option(
+            doc=(
+                "Comma-separated list of WiFi shard ids to re-shard to."
+                " While set, station updates are also written to these shards."
+            ),
+            default="",
+            parser=shard_ids_parser,
+        )
+        locate_snapshot_path = Option(
+            doc=(
+                "Directory of the station snapshot built by"
+                " ``ichnaea/scripts/snapshot.py``. If set, position searches"
+                " read stations from the snapshot instead of the database."
+            ),
+            default="",
+        )
         mapbox_token = Option(
             doc=(
                 "Mapbox API key; if you do not provide this, then parts of the "
@@ -11,3 +11,11 @@ def _cell_export_enabled():
 
 def _map_content_enabled():
     return bool(settings("mapbox_token"))
+
+
+def _data_queue_tasks_enabled():
+    return not settings("data_consumer")
+
+
+def _map_content_queue_tasks_enabled():
+    return _map_content_enabled() and _data_queue_tasks_enabled()
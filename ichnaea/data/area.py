@@ -1,51 +1,286 @@
+import base64
 from collections import defaultdict
+from datetime import date, datetime
+import time
 
 import numpy
-from sqlalchemy import delete, select
+from sqlalchemy import delete, select, tuple_
+from sqlalchemy.dialects.mysql import insert
 
-from geocalc import circle_radius
-from ichnaea.db import retry_on_mysql_lock_fail
+from geocalc import circle_radius, circle_radius_array
+from ichnaea.db import is_mysql_lock_error, retry_on_mysql_lock_fail
 from ichnaea.geocode import GEOCODER
-from ichnaea.models import decode_cellarea, CellArea, CellShard
+from ichnaea.models import decode_cellarea, encode_cellarea, CellArea, CellShard
 from ichnaea import util
 
 
+AREA_DELTA_FIELDS = (
+    "lat",
+    "lon",
+    "max_lat",
+    "min_lat",
+    "max_lon",
+    "min_lon",
+    "radius",
+    "region",
+)
+"""Cell fields sent from the station updater as incremental area updates."""
+
+
 class CellAreaUpdater(object):
 
     area_table = CellArea.__table__
     cell_model = CellShard
     queue_name = "update_cellarea"
+    delta_queue_name = "update_cellarea_delta"
+
+    # Area columns needed to apply deltas
+    delta_columns = (
+        "lat",
+        "lon",
+        "max_lat",
+        "min_lat",
+        "max_lon",
+        "min_lon",
+        "region",
+        "avg_cell_radius",
+        "num_cells",
+        "last_seen",
+        "modified",
+    )
+
+    # Cell columns needed to recompute an area
+    cell_columns = (
+        "lat",
+        "lon",
+        "radius",
+        "region",
+        "last_seen",
+        "max_lat",
+        "max_lon",
+        "min_lat",
+        "min_lon",
+    )
+
+    # Area columns written on each update
+    update_columns = (
+        "modified",
+        "lat",
+        "lon",
+        "max_lat",
+        "min_lat",
+        "max_lon",
+        "min_lon",
+        "radius",
+        "region",
+        "avg_cell_radius",
+        "num_cells",
+        "last_seen",
+    )
 
     def __init__(self, task):
         self.task = task
         self.queue = self.task.app.data_queues[self.queue_name]
+        self.delta_queue = self.task.app.data_queues[self.delta_queue_name]
         self.utcnow = util.utcnow()
+        self.lock_errors = 0
 
     def __call__(self):
-        areaids = self.queue.dequeue()
-        self.update_areas(areaids)
-        if self.queue.ready():
+        batch = self.queue.current_batch()
+        delta_batch = self.delta_queue.current_batch()
+        areaids = self.queue.dequeue(batch=batch)
+        deltas = self.delta_queue.dequeue(batch=delta_batch)
+        if not (areaids or deltas):
+            # Empty runs are input for the adaptive batch controller, too.
+            with self.task.redis_pipeline() as pipe:
+                self.queue.record_batch(0, 0.0, 0, pipe=pipe)
+                self.delta_queue.record_batch(0, 0.0, 0, pipe=pipe)
+            return
+
+        start = time.time()
+        try:
+            self.update_areas(areaids, deltas)
+        finally:
+            # Feed the adaptive batch controller, also on failure.
+            duration = (time.time() - start) * 1000.0
+            with self.task.redis_pipeline() as pipe:
+                self.queue.record_batch(
+                    len(areaids), duration, self.lock_errors, pipe=pipe
+                )
+                self.delta_queue.record_batch(
+                    len(deltas), duration, self.lock_errors, pipe=pipe
+                )
+        if self.queue.ready(batch=batch) or self.delta_queue.ready(batch=delta_batch):
             self.task.apply_async()
 
     @retry_on_mysql_lock_fail(
         metric="data.station.dberror", metric_tags=["type:cellarea"]
     )
-    def update_areas(self, areaids):
-        """Update the cell areas based on cell station records."""
+    def update_areas(self, areaids, deltas=()):
+        """
+        Update the cell areas based on cell station records.
+
+        Areas in ``areaids`` are recomputed from all their cells, the
+        ``deltas`` of new and moved cells are applied incrementally.
+        """
+        try:
+            self._update_areas(areaids, deltas)
+        except Exception as exc:
+            if is_mysql_lock_error(exc):
+                self.lock_errors += 1
+            raise
+
+    def _update_areas(self, areaids, deltas):
         areaid_set = set(areaids)
+        area_deltas = defaultdict(list)
+        for delta in deltas:
+            areaid = base64.b64decode(delta["areaid"])
+            if areaid not in areaid_set:
+                area_deltas[areaid].append(delta)
+
         with self.task.db_session() as session:
             # Fetch and lock existing cellarea rows
             rows = session.execute(
-                select([self.area_table.c.areaid])
-                .where(self.area_table.c.areaid.in_(areaid_set))
+                select(
+                    [self.area_table.c.areaid]
+                    + [getattr(self.area_table.c, f) for f in self.delta_columns]
+                )
+                .where(self.area_table.c.areaid.in_(areaid_set | set(area_deltas)))
                 .with_for_update()
             ).fetchall()
-            existing_areas = set(row[0] for row in rows)
+            existing_areas = {encode_cellarea(*row.areaid): row for row in rows}
+
+            # Apply cell deltas where possible, otherwise fall back
+            # to a full recompute
+            area_values = {}
+            for areaid, cell_deltas in area_deltas.items():
+                values = None
+                if areaid in existing_areas:
+                    values = self.apply_deltas(existing_areas[areaid], cell_deltas)
+                if values is None:
+                    areaid_set.add(areaid)
+                else:
+                    area_values[areaid] = values
+
+            # Recompute the remaining cellarea rows from cell tables. The
+            # recompute time is taken after reading the cells, so deltas
+            # produced before it are never applied on top of it.
+            cells = self.query_cells(session, areaid_set)
+            area_values.update(self.aggregate_areas(cells, modified=util.utcnow()))
+
+            # If there are no more underlying cells, delete the area entry
+            removed = areaid_set.intersection(existing_areas).difference(cells)
+            if removed:
+                session.execute(
+                    delete(self.area_table).where(self.area_table.c.areaid.in_(removed))
+                )
+
+            if area_values:
+                self.upsert_areas(session, area_values)
+
+    def apply_deltas(self, area, deltas):
+        """
+        Apply the deltas of new and moved cells to an existing area.
+
+        The running sums are derived from the stored averages. The area
+        ``modified`` time is kept as the time of the last full recompute.
+
+        Returns the new area values, or None if a full recompute is
+        required, because the area wasn't recomputed yet today, has no
+        bounding box, a delta was produced before the last recompute
+        and might already be included in it, a moved cell was on the
+        edge of the bounding box, or a cell changes its region.
+        """
+        if (
+            area.modified is None
+            or area.modified.date() < self.utcnow.date()
+            or not area.num_cells
+            or area.avg_cell_radius is None
+            or None in (area.max_lat, area.min_lat, area.max_lon, area.min_lon)
+        ):
+            return None
+        recomputed = area.modified.replace(tzinfo=None)
+
+        num_cells = area.num_cells
+        sum_lat = area.lat * num_cells
+        sum_lon = area.lon * num_cells
+        sum_radius = area.avg_cell_radius * num_cells
+        max_lat, min_lat = area.max_lat, area.min_lat
+        max_lon, min_lon = area.max_lon, area.min_lon
+        last_seen = area.last_seen
+
+        for delta in deltas:
+            # Deltas queued by older versions have no timestamp.
+            modified = delta.get("modified")
+            if (
+                modified is None
+                or datetime.fromisoformat(modified).replace(tzinfo=None) <= recomputed
+            ):
+                return None
+
+            old = delta["old"]
+            new = delta["new"]
+            if new["region"] != area.region or (
+                old is not None and old["region"] != area.region
+            ):
+                return None
+
+            if old is not None:
+                # The bounding box can only grow, unless it is recomputed.
+                if self.on_bbox_edge(area, old):
+                    return None
+                num_cells -= 1
+                sum_lat -= old["lat"]
+                sum_lon -= old["lon"]
+                sum_radius -= old["radius"] or 0
+
+            num_cells += 1
+            sum_lat += new["lat"]
+            sum_lon += new["lon"]
+            sum_radius += new["radius"] or 0
+            if new["max_lat"] is not None:
+                max_lat = max(max_lat, new["max_lat"])
+                max_lon = max(max_lon, new["max_lon"])
+            if new["min_lat"] is not None:
+                min_lat = min(min_lat, new["min_lat"])
+                min_lon = min(min_lon, new["min_lon"])
+
+            cell_last_seen = date.fromisoformat(delta["last_seen"])
+            if last_seen is None or cell_last_seen > last_seen:
+                last_seen = cell_last_seen
 
-            # Update each cellarea row from cell tables
-            for areaid in areaid_set:
-                area_is_new = decode_cellarea(areaid) not in existing_areas
-                self.update_area(session, areaid, area_is_new)
+        ctr_lat = sum_lat / num_cells
+        ctr_lon = sum_lon / num_cells
+        return {
+            "modified": area.modified,
+            "lat": ctr_lat,
+            "lon": ctr_lon,
+            "max_lat": max_lat,
+            "min_lat": min_lat,
+            "max_lon": max_lon,
+            "min_lon": min_lon,
+            "radius": circle_radius(
+                ctr_lat, ctr_lon, max_lat, max_lon, min_lat, min_lon
+            ),
+            "region": area.region,
+            "avg_cell_radius": int(round(sum_radius / num_cells)),
+            "num_cells": num_cells,
+            "last_seen": last_seen,
+        }
+
+    def on_bbox_edge(self, area, cell):
+        """Check if the cell box touches the edge of the area box."""
+        lat, lon = cell["lat"], cell["lon"]
+        max_lat = lat if cell.get("max_lat") is None else cell["max_lat"]
+        min_lat = lat if cell.get("min_lat") is None else cell["min_lat"]
+        max_lon = lon if cell.get("max_lon") is None else cell["max_lon"]
+        min_lon = lon if cell.get("min_lon") is None else cell["min_lon"]
+        return (
+            max(lat, max_lat, min_lat) >= area.max_lat
+            or min(lat, max_lat, min_lat) <= area.min_lat
+            or max(lon, max_lon, min_lon) >= area.max_lon
+            or min(lon, max_lon, min_lon) <= area.min_lon
+        )
 
     def region(self, ctr_lat, ctr_lon, mcc, cells):
         region = None
@@ -76,120 +311,145 @@ class CellAreaUpdater(object):
 
         return region
 
-    def update_area(self, session, areaid, area_is_new):
-        # Select all cells in this area and derive a bounding box for them
-        radio, mcc, mnc, lac = decode_cellarea(areaid)
-        load_fields = (
-            "cellid",
-            "lat",
-            "lon",
-            "radius",
-            "region",
-            "last_seen",
-            "max_lat",
-            "max_lon",
-            "min_lat",
-            "min_lon",
-        )
+    def query_cells(self, session, areaids):
+        """
+        Select all positioned cells in the given areas, with one query
+        per radio shard. Returns a dict of area ids to lists of cells.
+        """
+        shard_areas = defaultdict(list)
+        for areaid in areaids:
+            radio, mcc, mnc, lac = decode_cellarea(areaid)
+            shard_areas[self.cell_model.shard_model(radio)].append(
+                (radio, mcc, mnc, lac)
+            )
 
-        shard = self.cell_model.shard_model(radio)
-        fields = [getattr(shard.__table__.c, f) for f in load_fields]
+        cells = defaultdict(list)
+        for shard, cellareas in shard_areas.items():
+            table = shard.__table__
+            area_columns = (table.c.radio, table.c.mcc, table.c.mnc, table.c.lac)
+            rows = session.execute(
+                select(
+                    list(area_columns)
+                    + [getattr(table.c, f) for f in self.cell_columns]
+                )
+                .where(tuple_(*area_columns).in_(cellareas))
+                .where(table.c.lat.isnot(None))
+                .where(table.c.lon.isnot(None))
+            ).fetchall()
+            for row in rows:
+                areaid = encode_cellarea(row.radio, row.mcc, row.mnc, row.lac)
+                cells[areaid].append(row)
+        return cells
 
-        cells = session.execute(
-            select(fields)
-            .where(shard.__table__.c.radio == radio)
-            .where(shard.__table__.c.mcc == mcc)
-            .where(shard.__table__.c.mnc == mnc)
-            .where(shard.__table__.c.lac == lac)
-            .where(shard.__table__.c.lat.isnot(None))
-            .where(shard.__table__.c.lon.isnot(None))
-        ).fetchall()
+    def aggregate_areas(self, cells, modified=None):
+        """
+        Derive the area values from the cells of many areas at once.
 
-        if len(cells) == 0:
-            # If there are no more underlying cells, delete the area entry
-            session.execute(
-                delete(self.area_table).where(self.area_table.c.areaid == areaid)
+        The cells of all areas are concatenated into flat arrays,
+        and reduced per area.
+        """
+        if not cells:
+            return {}
+
+        areaids = list(cells.keys())
+        all_cells = [cell for areaid in areaids for cell in cells[areaid]]
+        counts = numpy.array([len(cells[areaid]) for areaid in areaids])
+        starts = numpy.cumsum(counts) - counts
+
+        def column(name):
+            return numpy.array(
+                [
+                    numpy.nan if getattr(cell, name) is None else getattr(cell, name)
+                    for cell in all_cells
+                ],
+                dtype=numpy.double,
             )
-            return
 
-        # Otherwise update the area entry based on all the cells
-        cell_extremes = numpy.array(
-            [
-                (
-                    numpy.nan if cell.max_lat is None else cell.max_lat,
-                    numpy.nan if cell.max_lon is None else cell.max_lon,
-                )
-                for cell in cells
-            ]
-            + [
-                (
-                    numpy.nan if cell.min_lat is None else cell.min_lat,
-                    numpy.nan if cell.min_lon is None else cell.min_lon,
-                )
-                for cell in cells
-            ],
-            dtype=numpy.double,
+        ctr_lat = numpy.add.reduceat(column("lat"), starts) / counts
+        ctr_lon = numpy.add.reduceat(column("lon"), starts) / counts
+
+        # The area box covers all cell box extremes, missing values are
+        # ignored by fmax / fmin.
+        max_lats = column("max_lat")
+        min_lats = column("min_lat")
+        max_lons = column("max_lon")
+        min_lons = column("min_lon")
+        max_lat = numpy.fmax(
+            numpy.fmax.reduceat(max_lats, starts), numpy.fmax.reduceat(min_lats, starts)
+        )
+        min_lat = numpy.fmin(
+            numpy.fmin.reduceat(max_lats, starts), numpy.fmin.reduceat(min_lats, starts)
+        )
+        max_lon = numpy.fmax(
+            numpy.fmax.reduceat(max_lons, starts), numpy.fmax.reduceat(min_lons, starts)
+        )
+        min_lon = numpy.fmin(
+            numpy.fmin.reduceat(max_lons, starts), numpy.fmin.reduceat(min_lons, starts)
         )
 
-        max_lat, max_lon = numpy.nanmax(cell_extremes, axis=0)
-        min_lat, min_lon = numpy.nanmin(cell_extremes, axis=0)
+        cell_radii = column("radius")
+        has_radius = ~numpy.isnan(cell_radii)
+        radius_sums = numpy.add.reduceat(numpy.where(has_radius, cell_radii, 0), starts)
+        radius_counts = numpy.add.reduceat(has_radius.astype(numpy.intp), starts)
 
-        ctr_lat, ctr_lon = numpy.array(
-            [(c.lat, c.lon) for c in cells], dtype=numpy.double
-        ).mean(axis=0)
-        ctr_lat = float(ctr_lat)
-        ctr_lon = float(ctr_lon)
+        radii = circle_radius_array(
+            ctr_lat, ctr_lon, max_lat, max_lon, min_lat, min_lon
+        )
 
-        radius = circle_radius(ctr_lat, ctr_lon, max_lat, max_lon, min_lat, min_lon)
+        def nan_none(value):
+            return None if numpy.isnan(value) else float(value)
 
-        cell_radii = numpy.array(
-            [(numpy.nan if cell.radius is None else cell.radius) for cell in cells],
-            dtype=numpy.int32,
-        )
-        avg_cell_radius = int(round(numpy.nanmean(cell_radii)))
-        num_cells = len(cells)
-        region = self.region(ctr_lat, ctr_lon, mcc, cells)
+        area_values = {}
+        for i, areaid in enumerate(areaids):
+            area_cells = cells[areaid]
+            lat = float(ctr_lat[i])
+            lon = float(ctr_lon[i])
+            avg_cell_radius = None
+            if radius_counts[i]:
+                avg_cell_radius = int(round(radius_sums[i] / radius_counts[i]))
 
-        last_seen = None
-        cell_last_seen = set(
-            [cell.last_seen for cell in cells if cell.last_seen is not None]
-        )
-        if cell_last_seen:
-            last_seen = max(cell_last_seen)
-
-        if area_is_new:
-            session.execute(
-                self.area_table.insert().values(
-                    areaid=areaid,
-                    radio=radio,
-                    mcc=mcc,
-                    mnc=mnc,
-                    lac=lac,
-                    created=self.utcnow,
-                    modified=self.utcnow,
-                    lat=ctr_lat,
-                    lon=ctr_lon,
-                    radius=radius,
-                    region=region,
-                    avg_cell_radius=avg_cell_radius,
-                    num_cells=num_cells,
-                    last_seen=last_seen,
-                )
-                # If there was an unexpected insert, log warning instead of error
-                .prefix_with("IGNORE", dialect="mysql")
-            )
-        else:
-            session.execute(
-                self.area_table.update()
-                .where(self.area_table.c.areaid == areaid)
-                .values(
-                    modified=self.utcnow,
-                    lat=ctr_lat,
-                    lon=ctr_lon,
-                    radius=radius,
-                    region=region,
-                    avg_cell_radius=avg_cell_radius,
-                    num_cells=num_cells,
-                    last_seen=last_seen,
-                )
+            last_seen = None
+            cell_last_seen = [
+                cell.last_seen for cell in area_cells if cell.last_seen is not None
+            ]
+            if cell_last_seen:
+                last_seen = max(cell_last_seen)
+
+            area_values[areaid] = {
+                "modified": modified or self.utcnow,
+                "lat": lat,
+                "lon": lon,
+                "max_lat": nan_none(max_lat[i]),
+                "min_lat": nan_none(min_lat[i]),
+                "max_lon": nan_none(max_lon[i]),
+                "min_lon": nan_none(min_lon[i]),
+                "radius": int(radii[i]),
+                "region": self.region(lat, lon, area_cells[0].mcc, area_cells),
+                "avg_cell_radius": avg_cell_radius,
+                "num_cells": int(counts[i]),
+                "last_seen": last_seen,
+            }
+        return area_values
+
+    def upsert_areas(self, session, area_values):
+        """Insert or update all changed areas in one statement."""
+        rows = []
+        for areaid, values in sorted(area_values.items()):
+            radio, mcc, mnc, lac = decode_cellarea(areaid)
+            row = {
+                "areaid": areaid,
+                "radio": radio,
+                "mcc": mcc,
+                "mnc": mnc,
+                "lac": lac,
+                "created": self.utcnow,
+            }
+            row.update(values)
+            rows.append(row)
+
+        stmt = insert(self.area_table).values(rows)
+        session.execute(
+            stmt.on_duplicate_key_update(
+                **{name: stmt.inserted[name] for name in self.update_columns}
             )
+        )
@@ -0,0 +1,190 @@
+"""
+A long-running consumer for the data queues.
+
+Instead of Celery beat starting a task for each data queue every
+30 to 50 seconds, the consumer blocks on the data queues in Redis and
+processes new data as soon as it arrives. It runs the same updaters as
+the Celery tasks, with one or more threads per data queue.
+"""
+
+from functools import partial
+import logging
+import threading
+
+import markus
+
+from ichnaea.data import _map_content_enabled, area, datamap, export, station
+from ichnaea.models import BlueShard, CellShard, DataMap, WifiShard
+
+METRICS = markus.get_metrics()
+LOGGER = logging.getLogger(__name__)
+
+
+class ConsumerTask:
+    """
+    Wraps a Celery task for use by an updater inside the consumer.
+
+    The updaters reschedule their task if the data queue holds more
+    data. The consumer loop already does this, so rescheduling is a
+    no-op.
+    """
+
+    def __init__(self, task):
+        self._task = task
+
+    def __getattr__(self, name):
+        return getattr(self._task, name)
+
+    def apply_async(self, *args, **kwargs):
+        pass
+
+    def apply_countdown(self, *args, **kwargs):
+        pass
+
+
+def _run_updater(updater_class, task, **kwargs):
+    # Updaters capture the current time on creation, use a new one per batch.
+    return updater_class(task, **kwargs)()
+
+
+def _run_leased(updater_class, task, shard_id):
+    # Hold the per-shard lease of the Celery task, so only one update of
+    # a shard runs at a time, across consumer threads and Celery workers.
+    with task.shard_lease(shard_id) as acquired:
+        if not acquired:
+            return False
+        return _run_updater(updater_class, task, shard_id=shard_id)
+
+
+def _run_incoming(task, export_task):
+    return export.IncomingQueue(task)(export_task)
+
+
+def queue_runners():
+    """
+    Return a dict of data queue names to callables, each processing
+    one batch of the data queue.
+    """
+    # The tasks module needs the configured Celery app.
+    from ichnaea.data import tasks
+
+    runners = {
+        "update_incoming": partial(
+            _run_incoming, ConsumerTask(tasks.update_incoming), tasks.export_reports
+        )
+    }
+
+    for updater_class, task, shard_model in (
+        (station.BlueUpdater, tasks.update_blue, BlueShard),
+        (station.CellUpdater, tasks.update_cell, CellShard),
+        (station.WifiUpdater, tasks.update_wifi, WifiShard),
+    ):
+        consumer_task = ConsumerTask(task)
+        for shard_id in shard_model.queue_shards().keys():
+            runners[updater_class.queue_prefix + shard_id] = partial(
+                _run_leased, updater_class, consumer_task, shard_id
+            )
+
+    # Both cell area queues are processed by the same updater.
+    area_task = ConsumerTask(tasks.update_cellarea)
+    for name in (
+        area.CellAreaUpdater.queue_name,
+        area.CellAreaUpdater.delta_queue_name,
+    ):
+        runners[name] = partial(_run_updater, area.CellAreaUpdater, area_task)
+
+    if _map_content_enabled():
+        datamap_task = ConsumerTask(tasks.update_datamap)
+        for shard_id in DataMap.shards().keys():
+            runners["update_datamap_" + shard_id] = partial(
+                _run_leased, datamap.DataMapUpdater, datamap_task, shard_id
+            )
+
+    return runners
+
+
+class DataQueueConsumer:
+    """
+    Process data queues in a loop, until stopped.
+
+    Each data queue gets ``concurrency`` threads. A thread blocks on its
+    data queue for up to ``timeout`` seconds, and runs one batch as soon
+    as there is data. At most ``max_active`` batches run at the same time,
+    which bounds the number of database connections in use. Sharded
+    queues hold the per-shard lease of their task while a batch runs, so
+    their threads take turns.
+
+    A batch which doesn't shrink its queue, for example because another
+    thread holds the lease, or the updater deferred the data back into
+    the queue, is followed by a short backoff.
+    """
+
+    error_backoff = 5.0  # Seconds to wait after a failed batch.
+    idle_backoff = 1.0  # Seconds to wait after a batch without progress.
+
+    def __init__(self, app, runners, concurrency=1, timeout=5, max_active=10):
+        self.app = app
+        self.runners = runners
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.active = threading.BoundedSemaphore(max_active)
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def wait(self, key):
+        """
+        Block until the data queue holds data, and return True, or
+        return False after the timeout.
+
+        The wait doesn't remove any data from the queue.
+        """
+        return self.app.data_queues[key].wait(self.timeout)
+
+    def run_batch(self, key):
+        """
+        Process one batch of the data queue. Return True if the queue
+        shrank, or False if the batch made no progress.
+        """
+        queue = self.app.data_queues[key]
+        size = queue.size()
+        with self.active:
+            with METRICS.timer("data.consumer.timing", tags=["queue:" + key]):
+                if self.runners[key]() is False:
+                    return False
+        return queue.size() < size
+
+    def consume(self, key):
+        """Process a data queue until the consumer is stopped."""
+        while not self.stopping.is_set():
+            try:
+                if self.wait(key) and not self.run_batch(key):
+                    METRICS.incr("data.consumer.idle", tags=["queue:" + key])
+                    self.stopping.wait(self.idle_backoff)
+            except Exception:
+                LOGGER.exception("Failed to process data queue %s.", key)
+                self.app.raven_client.captureException()
+                METRICS.incr("data.consumer.error", tags=["queue:" + key])
+                self.stopping.wait(self.error_backoff)
+
+    def start(self):
+        for key in sorted(self.runners):
+            for i in range(self.concurrency):
+                thread = threading.Thread(
+                    target=self.consume, args=(key,), name="%s-%s" % (key, i)
+                )
+                thread.start()
+                self.threads.append(thread)
+
+    def stop(self):
+        """
+        Ask all threads to stop. Batches in progress are completed,
+        blocked threads stop after at most ``timeout`` seconds.
+        """
+        self.stopping.set()
+
+    def join(self, timeout=1.0):
+        """Wait for all threads to stop."""
+        # Join with a timeout, to let the main thread handle signals.
+        while any(thread.is_alive() for thread in self.threads):
+            for thread in self.threads:
+                thread.join(timeout)
@@ -1,11 +1,41 @@
 from datetime import timedelta
 
-from sqlalchemy import delete, select
+from sqlalchemy import select
 
+from ichnaea.data.partition import add_partitions, expire_partitions
 from ichnaea.db import retry_on_mysql_lock_fail
-from ichnaea.models.content import DataMap, encode_datamap_grid
+from ichnaea.models.content import (
+    DataMap,
+    decode_datamap_grid,
+    encode_datamap_grid,
+)
 from ichnaea import util
 
+SEEN_BLOCK = 128
+"""Grids per side of the square blocks of the seen grid bitmaps."""
+
+SEEN_TTL = 2 * 86400
+"""Seconds to keep the seen grid bitmaps."""
+
+
+def seen_grid_bit(grid, day):
+    """
+    Return the Redis key and bit offset marking an encoded datamap grid
+    as seen on a day.
+
+    A bitmap of all grids would exceed the maximum size of a Redis
+    string, so the grids are split into blocks, with one bitmap each.
+    """
+    lat, lon = decode_datamap_grid(grid)
+    lat += 90000
+    lon += 180000
+    key = "datamap_seen:%s:%d:%d" % (
+        day.strftime("%Y%m%d"),
+        lat // SEEN_BLOCK,
+        lon // SEEN_BLOCK,
+    )
+    return key, (lat % SEEN_BLOCK) * SEEN_BLOCK + lon % SEEN_BLOCK
+
 
 class DataMapCleaner(object):
     def __init__(self, task, shard_id=None):
@@ -18,14 +48,12 @@ class DataMapCleaner(object):
         one_year = today - timedelta(days=365)
 
         table = self.shard.__table__
-        result = session.execute(delete(table).where(table.c.modified < one_year))
-        return result
+        add_partitions(session, table, today)
+        return expire_partitions(session, table, "modified", one_year)
 
     def __call__(self):
-        deleted_rows = 0
         with self.task.db_session() as session:
-            deleted_rows = self._cleanup_shards(session)
-        return deleted_rows
+            return self._cleanup_shards(session)
 
 
 class DataMapUpdater(object):
@@ -41,53 +69,92 @@ class DataMapUpdater(object):
             self._update_shards_with_session(session, grids)
 
     def _update_shards_with_session(self, session, grids):
+        """
+        Upsert one row per grid, with a modified date of today.
+
+        The primary key is (grid, modified), as the tables are partitioned
+        by the modified date, so a grid can have rows for several days,
+        for example after concurrent updates around midnight. A touched
+        grid has all its older rows replaced by a single row for today,
+        which keeps the earliest created date.
+        """
         today = util.utcnow().date()
 
         rows = session.execute(
-            select([self.shard_table.c.grid, self.shard_table.c.modified])
+            select(
+                [
+                    self.shard_table.c.grid,
+                    self.shard_table.c.created,
+                    self.shard_table.c.modified,
+                ]
+            )
             .where(self.shard_table.c.grid.in_(grids))
             .with_for_update()
         ).fetchall()
 
+        created = {}
+        current = set()
         outdated = set()
-        skip = set()
         for row in rows:
             grid = encode_datamap_grid(*row.grid)
             if row.modified == today:
-                skip.add(grid)
+                current.add(grid)
             else:
                 outdated.add(grid)
+            if row.created is not None:
+                created[grid] = min(created.get(grid, row.created), row.created)
 
-        new_values = []
-        update_values = []
-        for grid in grids:
-            if grid in skip:
-                continue
-            elif grid in outdated:
-                update_values.append({"grid": grid, "modified": today})
-            else:
-                new_values.append({"grid": grid, "created": today, "modified": today})
+        if outdated:
+            # The modified date is part of the primary key, so instead of
+            # moving each row to another partition, old rows are replaced.
+            session.execute(
+                self.shard_table.delete()
+                .where(self.shard_table.c.grid.in_(sorted(outdated)))
+                .where(self.shard_table.c.modified < today)
+            )
 
+        new_values = [
+            {"grid": grid, "created": created.get(grid, today), "modified": today}
+            for grid in sorted(set(grids) - current)
+        ]
         if new_values:
             # do a batch insert of new grids
             session.execute(
-                self.shard.__table__.insert().values(new_values)
+                self.shard_table.insert().values(new_values)
                 # If there was an unexpected insert, log warning instead of error
                 .prefix_with("IGNORE", dialect="mysql")
             )
 
-        if update_values:
-            # do a batch update of grids
-            session.bulk_update_mappings(self.shard, update_values)
+    def _filter_seen(self, grids, today):
+        """Return the grids which weren't updated today."""
+        with self.task.redis_client.pipeline(transaction=False) as pipe:
+            for grid in grids:
+                pipe.getbit(*seen_grid_bit(grid, today))
+            seen = pipe.execute()
+        return [grid for grid, bit in zip(grids, seen) if not bit]
+
+    def _mark_seen(self, grids, today):
+        keys = set()
+        with self.task.redis_pipeline() as pipe:
+            for grid in grids:
+                key, offset = seen_grid_bit(grid, today)
+                pipe.setbit(key, offset, 1)
+                keys.add(key)
+            for key in keys:
+                pipe.expire(key, SEEN_TTL)
 
     def __call__(self):
         queue = self.task.app.data_queues["update_datamap_" + self.shard_id]
         grids = queue.dequeue()
-        grids = list(set(grids))
         if not grids or not self.shard:
             return 0
 
-        self._update_shards(grids)
+        # Skip the database for grids already updated today.
+        today = util.utcnow().date()
+        unseen = self._filter_seen(grids, today)
+        if unseen:
+            self._update_shards(unseen)
+            self._mark_seen(unseen, today)
 
         if queue.ready():
             self.task.apply_countdown(kwargs={"shard_id": self.shard_id})
@@ -1,16 +1,22 @@
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import json
+import os
+from random import randint
 import re
-import time
+import threading
 from urllib.parse import urlparse
 import uuid
 
 import boto3
 import boto3.exceptions
 import botocore.exceptions
+from cachetools import TTLCache
 import markus
 import redis.exceptions
 import requests
+import requests.adapters
 import requests.exceptions
 from sqlalchemy import select
 import sqlalchemy.exc
@@ -32,6 +38,7 @@ from ichnaea.models import (
     WifiShard,
 )
 from ichnaea.models.content import encode_datamap_grid
+from ichnaea.queue import ready_queues
 from ichnaea import util
 
 
@@ -40,6 +47,57 @@ WHITESPACE = re.compile(r"\s", flags=re.UNICODE)
 METRICS = markus.get_metrics()
 
 
+@lru_cache(maxsize=None)
+def s3_client():
+    """
+    Return a S3 client shared by all exports of the process. Unlike
+    boto3 resources, clients can be used from multiple threads.
+    """
+    return boto3.client("s3")
+
+
+@lru_cache(maxsize=None)
+def http_session(name):
+    """
+    Return a HTTP session for the named export target. The session
+    keeps connections alive between batches and exports.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=GeosubmitExporter.workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+# Forked worker processes create their own clients and sessions.
+os.register_at_fork(after_in_child=s3_client.cache_clear)
+os.register_at_fork(after_in_child=http_session.cache_clear)
+
+# Five minutes +/- 10% cache timeout, in case the export config table
+# is changed without incrementing its version.
+EXPORT_CONFIG_CACHE_TIMEOUT = 300 + randint(-30, 30)
+EXPORT_CONFIG_CACHE = TTLCache(maxsize=4, ttl=EXPORT_CONFIG_CACHE_TIMEOUT)
+EXPORT_CONFIG_CACHE_LOCK = threading.Lock()
+
+
+def export_configs(task):
+    """
+    Return a dict of export config names to detached export configs.
+
+    The configs are cached per process, until the export config version
+    in Redis changes or the cache times out.
+    """
+    version = ExportConfig.version(task.redis_client)
+    with EXPORT_CONFIG_CACHE_LOCK:
+        configs = EXPORT_CONFIG_CACHE.get(version)
+    if configs is None:
+        with task.db_session(commit=False) as session:
+            configs = {config.name: config for config in ExportConfig.all(session)}
+        with EXPORT_CONFIG_CACHE_LOCK:
+            EXPORT_CONFIG_CACHE[version] = configs
+    return configs
+
+
 class IncomingQueue(object):
     """
     The incoming queue contains the data collected in the web application. It
@@ -66,46 +124,70 @@ class IncomingQueue(object):
                 {"api_key": item["api_key"], "report": item["report"]}
             )
 
-        with self.task.db_session(commit=False) as session:
-            export_configs = ExportConfig.all(session)
+        configs = list(export_configs(self.task).values())
 
         with self.task.redis_pipeline() as pipe:
             for (api_key, source), items in grouped.items():
-                for config in export_configs:
+                for config in configs:
                     if config.allowed(api_key, source):
                         queue_key = config.queue_key(api_key, source)
                         queue = config.queue(queue_key, redis_client)
                         queue.enqueue(items, pipe=pipe)
+                        config.add_partition(queue_key, pipe)
 
-        for config in export_configs:
-            # Check all queues if they now contain enough data or
-            # old enough data to be ready for processing.
+        # Check all queues if they now contain enough data or
+        # old enough data to be ready for processing.
+        partitions = {}
+        for config in configs:
             for queue_key in config.partitions(redis_client):
-                queue = config.queue(queue_key, redis_client)
-                if queue.ready():
-                    export_task.delay(config.name, queue_key)
+                partitions[queue_key] = config
+        queues = [
+            config.queue(queue_key, redis_client)
+            for queue_key, config in partitions.items()
+        ]
+        ready, missing = ready_queues(redis_client, queues)
+        for queue in ready:
+            export_task.delay(partitions[queue.key].name, queue.key)
+
+        # Forget partitions whose queues were exported and expired.
+        missing_keys = defaultdict(list)
+        for queue in missing:
+            missing_keys[partitions[queue.key]].append(queue.key)
+        for config, queue_keys in missing_keys.items():
+            config.remove_partitions(queue_keys, redis_client)
 
         if data_queue.ready():
             self.task.apply_countdown()
 
 
 class ReportExporter(object):
+    """
+    Export batches of reports from an export queue.
+
+    Failed batches aren't retried inside the task. They are moved into
+    a retry queue and exported by a new task after a countdown, until
+    the batch failed ``_retries`` times.
+    """
 
     _retriable = (IOError,)
     _retries = 3
-    _retry_wait = 1.0
+    _retry_wait = 10.0
+
+    workers = 1  # Batches sent concurrently by one export task.
 
     def __init__(self, task, config, queue_key):
         self.task = task
         self.config = config
         self.queue_key = queue_key
         self.queue = config.queue(queue_key, task.redis_client)
+        self.retry_queue = config.queue("retry_" + queue_key, task.redis_client)
         self.stats_tags = ["key:" + self.config.name]
 
     @staticmethod
-    def export(task, name, queue_key):
-        with task.db_session(commit=False) as session:
-            config = ExportConfig.get(session, name)
+    def export(task, name, queue_key, retry=0):
+        config = export_configs(task).get(name)
+        if config is None:
+            return
 
         exporter_types = {
             "dummy": DummyExporter,
@@ -115,31 +197,61 @@ class ReportExporter(object):
         }
         exporter_type = exporter_types.get(config.schema)
         if exporter_type is not None:
-            exporter_type(task, config, queue_key)()
-
-    def __call__(self):
-        queue_items = self.queue.dequeue()
-        if not queue_items:
+            exporter_type(task, config, queue_key)(retry=retry)
+
+    def __call__(self, retry=0):
+        if retry:
+            batches = [self.retry_queue.dequeue()]
+        else:
+            batches = self.dequeue_batches()
+        batches = [queue_items for queue_items in batches if queue_items]
+        if not batches:
             return
 
-        success = False
-        for i in range(self._retries):
-            try:
-                with METRICS.timer("data.export.upload.timing", tags=self.stats_tags):
-                    self.send(queue_items)
-
-                success = True
-            except self._retriable:
-                success = False
-                time.sleep(self._retry_wait * (i**2 + 1))
-
-            if success:
-                METRICS.incr("data.export.batch", tags=self.stats_tags)
-                break
+        if len(batches) == 1:
+            self.attempt(batches[0], retry)
+        else:
+            with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+                list(executor.map(self.attempt, batches, [retry] * len(batches)))
 
-        if success and self.queue.ready():
+        if not retry and self.queue.ready():
             self.task.apply_countdown(args=[self.config.name, self.queue_key])
 
+    def dequeue_batches(self):
+        """
+        Dequeue one batch, or up to ``workers`` full batches if the
+        queue holds them.
+        """
+        batch = self.config.batch
+        num = 1
+        if self.workers > 1 and batch:
+            num = min(self.workers, max(self.queue.size() // batch, 1))
+        queue_items = self.queue.dequeue(batch=(batch or 0) * num)
+        if not batch:
+            return [queue_items]
+        return [queue_items[i : i + batch] for i in range(0, len(queue_items), batch)]
+
+    def attempt(self, queue_items, retry):
+        """
+        Send a batch, and schedule a retry if it failed.
+        Returns whether the batch was sent.
+        """
+        try:
+            with METRICS.timer("data.export.upload.timing", tags=self.stats_tags):
+                self.send(queue_items)
+        except self._retriable:
+            if retry + 1 < self._retries:
+                self.retry_queue.enqueue(queue_items)
+                self.task.apply_async(
+                    args=[self.config.name, self.queue_key],
+                    kwargs={"retry": retry + 1},
+                    countdown=self._retry_wait * (retry**2 + 1),
+                )
+            return False
+
+        METRICS.incr("data.export.batch", tags=self.stats_tags)
+        return True
+
     def send(self, queue_items):
         raise NotImplementedError()
 
@@ -153,6 +265,8 @@ class GeosubmitExporter(ReportExporter):
 
     _retriable = (IOError, requests.exceptions.RequestException)
 
+    workers = 4
+
     def send(self, queue_items):
         # ignore metadata
         reports = [item["report"] for item in queue_items]
@@ -163,7 +277,7 @@ class GeosubmitExporter(ReportExporter):
             "User-Agent": "ichnaea",
         }
 
-        response = requests.post(
+        response = http_session(self.config.name).post(
             self.config.url,
             data=util.encode_gzip(
                 json.dumps({"items": reports}).encode(), compresslevel=5
@@ -173,7 +287,7 @@ class GeosubmitExporter(ReportExporter):
         )
 
         # log upload_status and trigger exception for bad responses
-        # this causes the task to be re-tried
+        # this causes the batch to be re-tried
         METRICS.incr(
             "data.export.upload",
             tags=self.stats_tags + ["status:%s" % response.status_code],
@@ -182,17 +296,88 @@ class GeosubmitExporter(ReportExporter):
 
 
 class S3Exporter(ReportExporter):
+    """
+    Export reports as gzipped JSON objects into a S3 bucket.
+
+    Small batches are coalesced into fewer, larger objects. The first
+    export of a config claims a window of ``coalesce_window`` seconds,
+    other exports during the window leave their data queued. The
+    claiming export takes up to ``max_batches`` batches out of each
+    ready partition, merges partitions with the same object path and
+    uploads the objects concurrently. The data of failed uploads is put
+    back into its partitions and retried in the next window.
+    """
 
     _retriable = (
         IOError,
         boto3.exceptions.Boto3Error,
         botocore.exceptions.BotoCoreError,
+        botocore.exceptions.ClientError,
     )
 
-    def send(self, queue_items):
-        # ignore metadata
-        reports = [item["report"] for item in queue_items]
+    coalesce_window = 60  # Seconds between coalesced exports of a config.
+    max_batches = 20  # Maximum number of batches per partition and object.
+    workers = 8  # Threads uploading objects concurrently.
+
+    def window_key(self):
+        return "export_window_" + self.config.name
+
+    def __call__(self, retry=0):
+        redis_client = self.task.redis_client
+        window_key = self.window_key()
+        if not redis_client.set(window_key, 1, nx=True, ex=self.coalesce_window):
+            return
+
+        objects, queues = self.coalesce()
+        failed = False
+        if objects:
+            with ThreadPoolExecutor(
+                max_workers=min(self.workers, len(objects))
+            ) as executor:
+                results = list(
+                    executor.map(self.upload, objects.keys(), objects.values())
+                )
+            with self.task.redis_pipeline() as pipe:
+                for parts, success in zip(objects.values(), results):
+                    if not success:
+                        # Keep the data for the export in the next window,
+                        # the emptied partition might have been pruned.
+                        failed = True
+                        for queue, items in parts:
+                            queue.enqueue(items, pipe=pipe)
+                            self.config.add_partition(queue.key, pipe)
+
+        # Don't wait for the next window if partitions hold more data.
+        if not failed and ready_queues(redis_client, queues)[0]:
+            redis_client.delete(window_key)
+            self.task.apply_countdown(args=[self.config.name, self.queue_key])
 
+    def coalesce(self):
+        """
+        Dequeue the data of all ready partitions.
+
+        Returns a dict of (bucket name, object name) to a list of
+        (queue, items) pairs, and the list of dequeued queues.
+        """
+        redis_client = self.task.redis_client
+        objects = defaultdict(list)
+        queues = []
+        ready, _ = ready_queues(
+            redis_client,
+            [
+                self.config.queue(queue_key, redis_client)
+                for queue_key in self.config.partitions(redis_client)
+            ],
+        )
+        for queue in ready:
+            items = queue.dequeue(batch=(self.config.batch or 0) * self.max_batches)
+            if items:
+                objects[self.object_path(queue.key)].append((queue, items))
+                queues.append(queue)
+        return objects, queues
+
+    def object_path(self, queue_key):
+        """Return the bucket name and object name prefix for a partition."""
         _, bucketname, path = urlparse(self.config.url)[:3]
         # s3 key names start without a leading slash
         path = path.lstrip("/")
@@ -202,34 +387,48 @@ class S3Exporter(ReportExporter):
         year, month, day = util.utcnow().timetuple()[:3]
 
         # strip away queue prefix again
-        parts = self.queue_key.split(":")
+        parts = queue_key.split(":")
         source = parts[1]
         api_key = parts[2]
 
-        obj_name = path.format(
-            source=source, api_key=api_key, year=year, month=month, day=day
+        return (
+            bucketname,
+            path.format(
+                source=source, api_key=api_key, year=year, month=month, day=day
+            ),
         )
-        obj_name += uuid.uuid1().hex + ".json.gz"
-
-        try:
-            data = util.encode_gzip(
-                json.dumps({"items": reports}).encode(), compresslevel=7
-            )
 
-            s3 = boto3.resource("s3")
-            bucket = s3.Bucket(bucketname)
-
-            obj = bucket.Object(obj_name)
-            obj.put(Body=data, ContentEncoding="gzip", ContentType="application/json")
+    def upload(self, path, parts):
+        """
+        Upload the items of all parts as one object, and return whether
+        the upload succeeded.
+        """
+        bucketname, prefix = path
+        reports = [item["report"] for _, items in parts for item in items]
+        data = util.encode_gzip(
+            json.dumps({"items": reports}).encode(), compresslevel=7
+        )
+        obj_name = prefix + uuid.uuid1().hex + ".json.gz"
 
-            METRICS.incr(
-                "data.export.upload", tags=self.stats_tags + ["status:success"]
-            )
-        except Exception:
+        try:
+            with METRICS.timer("data.export.upload.timing", tags=self.stats_tags):
+                s3_client().put_object(
+                    Bucket=bucketname,
+                    Key=obj_name,
+                    Body=data,
+                    ContentEncoding="gzip",
+                    ContentType="application/json",
+                )
+        except self._retriable:
             METRICS.incr(
                 "data.export.upload", tags=self.stats_tags + ["status:failure"]
             )
-            raise
+            return False
+
+        METRICS.incr("data.export.upload", tags=self.stats_tags + ["status:success"])
+        METRICS.histogram("data.export.upload.size", len(data), tags=self.stats_tags)
+        METRICS.incr("data.export.batch", tags=self.stats_tags)
+        return True
 
 
 class InternalTransform(object):
@@ -359,10 +558,11 @@ class InternalExporter(ReportExporter):
 
         items = []
         for item in queue_items:
-            # preprocess items and extract set of API keys
-            item["report"] = self.transform(item["report"])
-            if item["report"]:
-                items.append(item)
+            # preprocess items and extract set of API keys, keep the
+            # queue items unchanged in case the batch is retried
+            report = self.transform(item["report"])
+            if report:
+                items.append(dict(item, report=report))
                 api_keys.add(item["api_key"])
 
         for api_key in api_keys:
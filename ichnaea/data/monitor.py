@@ -7,11 +7,15 @@ import markus
 from simple_pid import PID
 from sqlalchemy.exc import OperationalError
 
+from ichnaea.queue import BATCH_CONTROLLER_BATCH, BATCH_CONTROLLER_STATS
 from ichnaea import util
 
 METRICS = markus.get_metrics()
 LOGGER = logging.getLogger(__name__)
 
+# Data types of queues with an adaptive batch size
+BATCH_CONTROLLED_TYPES = ("bluetooth", "cell", "wifi", "cellarea")
+
 
 class ApiKeyLimits:
     def __init__(self, task):
@@ -99,6 +103,10 @@ class QueueSizeAndRateControl:
         self.trx_history_purging = None
         self.trx_history_min = None
         self.trx_history_max = None
+        self.bc_enabled = None
+        self.bc_min = None
+        self.bc_max = None
+        self.bc_duration = None
 
     def __call__(self):
         """Load components, set the rate, and send metrics."""
@@ -126,6 +134,11 @@ class QueueSizeAndRateControl:
         # Emit the current (controlled or manual) global rate
         METRICS.gauge("rate_control.locate", self.rate)
 
+        # Tune the batch sizes of the station and area update tasks
+        self.load_batch_controller()
+        if self.bc_enabled:
+            self.run_batch_controller(queue_sizes)
+
     def load_rate_controller(self):
         """Load rate controller parameters from Redis-stored strings."""
         with self.task.redis_client.pipeline() as pipe:
@@ -157,30 +170,8 @@ class QueueSizeAndRateControl:
         except (TypeError, ValueError):
             self.rate = 100.0
 
-        def load_param(param_type, name, raw_value, range_check, default=None):
-            """
-            Load and validate a parameter
-
-            Reset invalid parameters in Redis
-            Returns (value, is_valid)
-            """
-            if raw_value is None and default is not None:
-                self.task.redis_client.set(name, default)
-                raw_value = default
-
-            try:
-                val = param_type(raw_value)
-                if not range_check(val):
-                    raise ValueError("out of range")
-                return val, True
-            except (TypeError, ValueError):
-                log_fmt = "Redis key '%s' has invalid value %r, disabling rate control."
-                LOGGER.warning(log_fmt, name, raw_value)
-                self.task.redis_client.set(name, default or 0)
-                return None, False
-
         # Validate rate_controller_enabled, exit early if disabled
-        self.rc_enabled, valid = load_param(
+        self.rc_enabled, valid = self.load_param(
             int, "rate_controller_enabled", rc_enabled, lambda x: x in (0, 1)
         )
         if not self.rc_enabled:
@@ -189,25 +180,25 @@ class QueueSizeAndRateControl:
 
         # Validate simple PID parameters, exit if any are invalid
         valid = [True] * 7
-        self.rc_target, valid[0] = load_param(
+        self.rc_target, valid[0] = self.load_param(
             int, "rate_controller_target", rc_target, lambda x: x >= 0
         )
-        self.rc_kp, valid[1] = load_param(
+        self.rc_kp, valid[1] = self.load_param(
             float, "rate_controller_kp", rc_kp, lambda x: x >= 0, 8
         )
-        self.rc_ki, valid[2] = load_param(
+        self.rc_ki, valid[2] = self.load_param(
             float, "rate_controller_ki", rc_ki, lambda x: x >= 0, 0
         )
-        self.rc_kd, valid[3] = load_param(
+        self.rc_kd, valid[3] = self.load_param(
             float, "rate_controller_kd", rc_kd, lambda x: x >= 0, 0
         )
-        self.trx_history_purging, valid[4] = load_param(
+        self.trx_history_purging, valid[4] = self.load_param(
             int, "rate_controller_trx_purging", rc_trx_purging, lambda x: x in {0, 1}, 0
         )
-        self.trx_history_min, valid[5] = load_param(
+        self.trx_history_min, valid[5] = self.load_param(
             int, "rate_controller_trx_min", rc_trx_min, lambda x: x > 0, 1000
         )
-        self.trx_history_max, valid[5] = load_param(
+        self.trx_history_max, valid[5] = self.load_param(
             int,
             "rate_controller_trx_max",
             rc_trx_max,
@@ -258,12 +249,102 @@ class QueueSizeAndRateControl:
             # Apply limits, which may clamp integral and last output
             self.rc_controller.output_limits = (0, self.rc_target)
 
+    def load_param(
+        self,
+        param_type,
+        name,
+        raw_value,
+        range_check,
+        default=None,
+        controller="rate control",
+    ):
+        """
+        Load and validate a parameter
+
+        Reset invalid parameters in Redis
+        Returns (value, is_valid)
+        """
+        if raw_value is None and default is not None:
+            self.task.redis_client.set(name, default)
+            raw_value = default
+
+        try:
+            val = param_type(raw_value)
+            if not range_check(val):
+                raise ValueError("out of range")
+            return val, True
+        except (TypeError, ValueError):
+            log_fmt = "Redis key '%s' has invalid value %r, disabling %s."
+            LOGGER.warning(log_fmt, name, raw_value, controller)
+            self.task.redis_client.set(name, default or 0)
+            return None, False
+
+    def load_batch_controller(self):
+        """Load batch controller parameters from Redis-stored strings."""
+        with self.task.redis_client.pipeline() as pipe:
+            pipe.get("batch_controller_enabled")
+            pipe.get("batch_controller_min")
+            pipe.get("batch_controller_max")
+            pipe.get("batch_controller_duration")
+            pipe.exists(BATCH_CONTROLLER_BATCH)
+            bc_enabled, bc_min, bc_max, bc_duration, bc_batch = pipe.execute()
+
+        self.bc_enabled, valid = self.load_param(
+            int,
+            "batch_controller_enabled",
+            bc_enabled,
+            lambda x: x in (0, 1),
+            controller="batch control",
+        )
+        # Drop the tuned batch sizes once, when the controller is disabled.
+        if not self.bc_enabled:
+            if bc_batch:
+                self.task.redis_client.delete(BATCH_CONTROLLER_BATCH)
+            return
+
+        valid = [True] * 3
+        self.bc_min, valid[0] = self.load_param(
+            int,
+            "batch_controller_min",
+            bc_min,
+            lambda x: x > 0,
+            10,
+            controller="batch control",
+        )
+        self.bc_max, valid[1] = self.load_param(
+            int,
+            "batch_controller_max",
+            bc_max,
+            lambda x: x >= (self.bc_min or 1),
+            5000,
+            controller="batch control",
+        )
+        self.bc_duration, valid[2] = self.load_param(
+            int,
+            "batch_controller_duration",
+            bc_duration,
+            lambda x: x > 0,
+            10000,
+            controller="batch control",
+        )
+
+        if not all(valid):
+            self.task.redis_client.set("batch_controller_enabled", 0)
+            if bc_batch:
+                self.task.redis_client.delete(BATCH_CONTROLLER_BATCH)
+            self.bc_enabled = False
+
     def get_queue_sizes(self):
-        """Measure the observation queue sizes (redis llen)."""
+        """Measure the task and data queue sizes."""
         names = list(self.task.app.all_queues.keys())
+        data_queues = self.task.app.data_queues
         with self.task.redis_client.pipeline() as pipe:
             for name in names:
-                pipe.llen(name)
+                if name in data_queues:
+                    # Data queues can be lists or sets.
+                    data_queues[name].size(pipe=pipe)
+                else:
+                    pipe.llen(name)
             queue_lengths = pipe.execute()
         return {name: value for name, value in zip(names, queue_lengths)}
 
@@ -331,6 +412,56 @@ class QueueSizeAndRateControl:
         METRICS.gauge("rate_control.locate.iterm", i_term)
         METRICS.gauge("rate_control.locate.dterm", d_term)
 
+    def run_batch_controller(self, queue_sizes):
+        """Pick new batch sizes for the station and area data queues."""
+        queues = [
+            (name, queue)
+            for name, queue in self.task.app.data_queues.items()
+            if queue.data_type in BATCH_CONTROLLED_TYPES
+        ]
+        with self.task.redis_client.pipeline() as pipe:
+            pipe.hgetall(BATCH_CONTROLLER_BATCH)
+            for name, queue in queues:
+                pipe.hgetall(BATCH_CONTROLLER_STATS + queue.key)
+                pipe.delete(BATCH_CONTROLLER_STATS + queue.key)
+            result = pipe.execute()
+
+        batches = {key.decode("utf-8"): value for key, value in result[0].items()}
+        new_batches = {}
+        for i, (name, queue) in enumerate(queues):
+            stats = {
+                key.decode("utf-8"): int(value)
+                for key, value in result[1 + 2 * i].items()
+            }
+            try:
+                batch = int(batches[queue.key])
+            except (KeyError, ValueError):
+                batch = queue.batch
+            batch = self.next_batch_size(batch, stats, queue_sizes.get(queue.key, 0))
+            new_batches[queue.key] = batch
+            METRICS.gauge("rate_control.batch", batch, tags=["queue:" + name])
+
+        if new_batches:
+            self.task.redis_client.hset(BATCH_CONTROLLER_BATCH, mapping=new_batches)
+
+    def next_batch_size(self, batch, stats, queue_size):
+        """
+        Adjust a batch size, based on the statistics collected by the
+        tasks since the last run.
+
+        The batch is halved on lock contention, reduced if tasks took
+        longer than the target duration, and increased while there is a
+        backlog of more than one batch and tasks finish in time.
+        """
+        runs = stats.get("runs", 0)
+        if stats.get("lock_errors", 0):
+            batch = batch // 2
+        elif runs and stats.get("duration", 0) / runs > self.bc_duration:
+            batch = batch * 3 // 4
+        elif runs and queue_size > batch:
+            batch = batch + max(batch // 4, 1)
+        return max(self.bc_min, min(self.bc_max, batch))
+
     def trx_history_purging_mode(self, trx_history_length):
         """If transaction history is high, enter purging mode until back to minimum."""
         if (
@@ -0,0 +1,146 @@
+"""
+Monthly range partitions for the datamap and stat tables.
+
+The tables are partitioned on their date column, with one partition
+``pYYYYMM`` per month and a final ``pmax`` partition holding all later
+dates. Expired data is mostly removed by dropping whole partitions
+instead of deleting rows, so the cleanup doesn't generate undo history
+on the primary database. Only the expired days of the oldest remaining
+partition are deleted row by row.
+
+Tables without partitions are still cleaned up by deleting rows.
+
+The partitioning column has to be part of the primary key, so the
+datamap tables are keyed by (grid, modified). Lookups by grid alone
+probe the primary key of every partition, the datamap updater only does
+them for the first update of a grid on each day, and replaces all older
+rows of the grid, see :class:`ichnaea.data.datamap.DataMapUpdater`.
+"""
+
+from datetime import date
+import logging
+
+from sqlalchemy import delete
+from sqlalchemy.sql import text
+
+LOGGER = logging.getLogger(__name__)
+
+MAX_PARTITION = "pmax"
+"""Name of the partition for all dates after the monthly partitions."""
+
+
+def next_month(day):
+    """Return the first day of the month after the given date."""
+    if day.month == 12:
+        return date(day.year + 1, 1, 1)
+    return date(day.year, day.month + 1, 1)
+
+
+def partition_name(day):
+    """Return the name of the partition holding the given date."""
+    return "p" + day.strftime("%Y%m")
+
+
+def partition_definitions(first, last):
+    """
+    Return the definitions of the monthly partitions from the month of
+    the first up to and including the month of the last date.
+    """
+    definitions = []
+    month = first.replace(day=1)
+    while month <= last:
+        upper = next_month(month)
+        definitions.append(
+            "PARTITION %s VALUES LESS THAN ('%s')"
+            % (partition_name(month), upper.isoformat())
+        )
+        month = upper
+    return definitions
+
+
+def table_partitions(session, table):
+    """
+    Return a list of partition names and their exclusive upper bound
+    dates, in partition order. The upper bound of the ``pmax`` partition
+    is None. Returns an empty list for tables without partitions.
+    """
+    rows = session.execute(
+        text(
+            "SELECT `PARTITION_NAME` AS name, "
+            "`PARTITION_DESCRIPTION` AS description "
+            "FROM information_schema.PARTITIONS "
+            "WHERE `TABLE_SCHEMA` = DATABASE() AND `TABLE_NAME` = :table "
+            "AND `PARTITION_NAME` IS NOT NULL "
+            "ORDER BY `PARTITION_ORDINAL_POSITION`"
+        ),
+        {"table": table.name},
+    ).fetchall()
+    partitions = []
+    for row in rows:
+        bound = None
+        if row.description != "MAXVALUE":
+            bound = date.fromisoformat(row.description.strip("'"))
+        partitions.append((row.name, bound))
+    return partitions
+
+
+def add_partitions(session, table, today, months=3):
+    """
+    Make sure a partitioned table has monthly partitions for the next
+    months, by splitting them off the empty ``pmax`` partition.
+    Returns the names of the added partitions.
+    """
+    partitions = table_partitions(session, table)
+    if not partitions or partitions[-1][0] != MAX_PARTITION:
+        return []
+
+    first = today.replace(day=1)
+    if len(partitions) > 1:
+        first = partitions[-2][1]
+    last = today.replace(day=1)
+    for i in range(months):
+        last = next_month(last)
+
+    definitions = partition_definitions(first, last)
+    if not definitions:
+        return []
+
+    session.execute(
+        text(
+            "ALTER TABLE `%s` REORGANIZE PARTITION %s INTO "
+            "(%s, PARTITION %s VALUES LESS THAN (MAXVALUE))"
+            % (table.name, MAX_PARTITION, ", ".join(definitions), MAX_PARTITION)
+        )
+    )
+    added = [definition.split()[1] for definition in definitions]
+    LOGGER.info("Added partitions %s to %s.", ", ".join(added), table.name)
+    return added
+
+
+def expire_partitions(session, table, column, cutoff):
+    """
+    Remove the rows of a table with a date before the cutoff.
+
+    For partitioned tables, the partitions holding only earlier dates
+    are dropped first. The remaining expired rows, which share their
+    partition with the cutoff date, are deleted, and partition pruning
+    limits the delete to that partition. Tables without partitions have
+    all their expired rows deleted.
+
+    Returns a tuple of the number of dropped partitions and the number
+    of deleted rows.
+    """
+    partitions = table_partitions(session, table)
+    expired = [
+        name for name, bound in partitions if bound is not None and bound <= cutoff
+    ]
+    if expired:
+        session.execute(
+            text(
+                "ALTER TABLE `%s` DROP PARTITION %s" % (table.name, ", ".join(expired))
+            )
+        )
+        LOGGER.info("Dropped partitions %s from %s.", ", ".join(expired), table.name)
+
+    result = session.execute(delete(table).where(table.c[column] < cutoff))
+    return len(expired), result.rowcount
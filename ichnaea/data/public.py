@@ -1,24 +1,42 @@
 from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
 from csv import reader
 from datetime import datetime, timedelta
 import logging
 import os
+import shutil
+import time
 
 import boto3
 import colander
-from more_itertools import peekable
+import markus
+from more_itertools import chunked, peekable
+import numpy
 from zoneinfo import ZoneInfo
+from sqlalchemy import bindparam, func, literal_column, select
+from sqlalchemy.dialects.mysql import insert
 from sqlalchemy.sql import text
 from sqlalchemy.orm import load_only
 
 from ichnaea.cache import redis_pipeline
 from ichnaea.conf import settings
-from ichnaea.models import area_id, CellShard
+from ichnaea.db import db_worker_session
+from ichnaea.geocode import GEOCODER
+from ichnaea.models import (
+    area_id,
+    CellShard,
+    encode_cellarea,
+    encode_cellid,
+    Radio,
+    station_grid,
+)
+from ichnaea.models import constants
 from ichnaea.models.constants import CELL_MAX_RADIUS
 from ichnaea import util
 
 
 LOGGER = logging.getLogger(__name__)
+METRICS = markus.get_metrics()
 UTC = ZoneInfo("UTC")
 
 _FIELD_NAMES = [
@@ -39,23 +57,9 @@ _FIELD_NAMES = [
 ]
 
 
-def write_stations_to_csv(session, path, today, start_time=None, end_time=None):
-    linesep = "\r\n"
+_LINESEP = "\r\n"
 
-    where = "lat IS NOT NULL AND lon IS NOT NULL"
-    if start_time is not None and end_time is not None:
-        where = where + ' AND modified >= "%s" AND modified < "%s"'
-        fmt = "%Y-%m-%d %H:%M:%S"
-        where = where % (start_time.strftime(fmt), end_time.strftime(fmt))
-    else:
-        # limit to cells modified in the last 12 months
-        one_year = today - timedelta(days=365)
-        where = where + ' AND modified >= "%s"' % one_year.strftime("%Y-%m-%d")
-
-    header_row = ",".join(_FIELD_NAMES) + linesep
-
-    tables = [shard.__tablename__ for shard in CellShard.shards().values()]
-    stmt = """SELECT
+_EXPORT_STMT = """SELECT
     `cellid`,
     CONCAT_WS(",",
         CASE radio
@@ -84,23 +88,236 @@ ORDER BY `cellid`
 LIMIT :limit
 """
 
+CELL_CHANGES_TTL = 3 * 24 * 3600
+"""Seconds to keep the hourly change log of cells."""
+
+
+def _export_where(today, start_time=None, end_time=None):
+    where = "lat IS NOT NULL AND lon IS NOT NULL"
+    if start_time is not None and end_time is not None:
+        where = where + ' AND modified >= "%s" AND modified < "%s"'
+        fmt = "%Y-%m-%d %H:%M:%S"
+        where = where % (start_time.strftime(fmt), end_time.strftime(fmt))
+    else:
+        # limit to cells modified in the last 12 months
+        one_year = today - timedelta(days=365)
+        where = where + ' AND modified >= "%s"' % one_year.strftime("%Y-%m-%d")
+    return where
+
+
+def _write_table(session, gzip_file, table, where, params=None):
+    """
+    Write the rows of one table, or a cellid range of it, in cellid
+    order. Returns the number of written rows.
+    """
+    table_stmt = text(_EXPORT_STMT % (table, where))
+    if params:
+        table_stmt = table_stmt.bindparams(**params)
+    min_cellid = ""
+    limit = 25000
+    total = 0
+    while True:
+        rows = session.execute(
+            table_stmt.bindparams(limit=limit, cellid=min_cellid)
+        ).fetchall()
+        if rows:
+            buf = "".join(row.cell_value + _LINESEP for row in rows)
+            gzip_file.write(buf)
+            min_cellid = rows[-1].cellid
+            total += len(rows)
+            METRICS.incr("data.cell_export.rows", len(rows), tags=["table:" + table])
+        else:
+            break
+    return total
+
+
+def _write_cellids(session, gzip_file, table, where, cellids, batch=5000):
+    """
+    Write the rows for the given sorted cellids of one table, looking
+    them up by primary key. Returns the number of written rows.
+    """
+    table_stmt = text(
+        _EXPORT_STMT % (table, where + " AND `cellid` IN :cellids")
+    ).bindparams(bindparam("cellids", expanding=True))
+    total = 0
+    for chunk in chunked(cellids, batch):
+        rows = session.execute(
+            table_stmt, {"cellids": chunk, "cellid": "", "limit": len(chunk)}
+        ).fetchall()
+        if rows:
+            buf = "".join(row.cell_value + _LINESEP for row in rows)
+            gzip_file.write(buf)
+            total += len(rows)
+            METRICS.incr("data.cell_export.rows", len(rows), tags=["table:" + table])
+    return total
+
+
+def write_stations_to_csv(
+    session, path, today, start_time=None, end_time=None, cellids=None
+):
+    """
+    Write the cell export CSV file.
+
+    If a list of packed cellids is given, only those cells are looked
+    up, instead of scanning the tables for all cells in the time range.
+    """
+    where = _export_where(today, start_time=start_time, end_time=end_time)
+    header_row = ",".join(_FIELD_NAMES) + _LINESEP
+
+    table_cellids = None
+    if cellids is not None:
+        table_cellids = defaultdict(list)
+        for cellid in sorted(set(cellids)):
+            shard = CellShard.shard_model(cellid)
+            if shard is not None:
+                table_cellids[shard.__tablename__].append(cellid)
+
+    tables = [shard.__tablename__ for shard in CellShard.shards().values()]
     with util.gzip_open(path, "w", compresslevel=5) as gzip_wrapper:
         with gzip_wrapper as gzip_file:
             gzip_file.write(header_row)
             for table in tables:
-                table_stmt = text(stmt % (table, where))
-                min_cellid = ""
-                limit = 25000
-                while True:
-                    rows = session.execute(
-                        table_stmt.bindparams(limit=limit, cellid=min_cellid)
-                    ).fetchall()
-                    if rows:
-                        buf = "".join(row.cell_value + linesep for row in rows)
-                        gzip_file.write(buf)
-                        min_cellid = rows[-1].cellid
-                    else:
-                        break
+                if table_cellids is None:
+                    _write_table(session, gzip_file, table, where)
+                elif table_cellids[table]:
+                    _write_cellids(
+                        session, gzip_file, table, where, table_cellids[table]
+                    )
+
+
+def cell_changes_key(hour):
+    """Return the Redis key of the change log for an hour."""
+    return "cell_export_changes:" + hour.strftime("%Y%m%d%H")
+
+
+def cell_changes_complete_key(hour):
+    """Return the Redis key marking the change log of an hour as complete."""
+    return "cell_export_changes_complete:" + hour.strftime("%Y%m%d%H")
+
+
+def log_cell_changes(pipe, now, cellids):
+    """
+    Add the packed cellids to the change log of the current hour.
+
+    The change log is a sorted set with a score of zero for all
+    members, so they are kept in cellid order.
+
+    Logging changes during an hour also marks the log of the next hour
+    as complete, as it was logged from the start of that hour on.
+    """
+    key = cell_changes_key(now)
+    pipe.zadd(key, {cellid: 0 for cellid in cellids})
+    pipe.expire(key, CELL_CHANGES_TTL)
+    pipe.set(
+        cell_changes_complete_key(now + timedelta(hours=1)), 1, ex=CELL_CHANGES_TTL
+    )
+
+
+def read_cell_changes(redis_client, hour):
+    """
+    Return the packed cellids changed during an hour, or None if there
+    is no complete change log for the hour.
+
+    The log of an hour is incomplete if changes were logged only after
+    the hour started, for example after a deploy or a Redis flush.
+    """
+    with redis_client.pipeline() as pipe:
+        pipe.exists(cell_changes_complete_key(hour))
+        pipe.zrange(cell_changes_key(hour), 0, -1)
+        complete, cellids = pipe.execute()
+    if not complete:
+        return None
+    return cellids
+
+
+def cellid_ranges(radio, partitions):
+    """
+    Split the cellids of a radio type into ranges of MCCs, and return
+    a list of (min_cellid, max_cellid) tuples. The first range has no
+    lower and the last range no upper bound.
+    """
+    bounds = [
+        encode_cellid(radio, 1000 * i // partitions, 0, 0, 0)
+        for i in range(1, partitions)
+    ]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def _write_range(db, path, table, where, min_cellid, max_cellid):
+    """Write one cellid range of a table to its own gzip file."""
+    params = {}
+    if min_cellid is not None:
+        where = where + " AND `cellid` >= :min_cellid"
+        params["min_cellid"] = min_cellid
+    if max_cellid is not None:
+        where = where + " AND `cellid` < :max_cellid"
+        params["max_cellid"] = max_cellid
+
+    with METRICS.timer("data.cell_export.timing", tags=["table:" + table]):
+        with db_worker_session(db, commit=False) as session:
+            with util.gzip_open(path, "w", compresslevel=5) as gzip_wrapper:
+                with gzip_wrapper as gzip_file:
+                    return _write_table(session, gzip_file, table, where, params)
+
+
+def write_stations_to_csv_parallel(
+    db, path, today, start_time=None, end_time=None, workers=4, partitions=16
+):
+    """
+    Write the same CSV file as :func:`write_stations_to_csv`, exporting
+    cellid ranges of each table concurrently.
+
+    Each range is written to its own gzip file, and the files are
+    concatenated in cellid order, as members of one gzip file.
+    """
+    where = _export_where(today, start_time=start_time, end_time=end_time)
+    header_row = ",".join(_FIELD_NAMES) + _LINESEP
+    temp_dir = os.path.dirname(path)
+
+    jobs = []
+    for shard_id, shard in CellShard.shards().items():
+        table = shard.__tablename__
+        for min_cellid, max_cellid in cellid_ranges(Radio[shard_id], partitions):
+            part_path = os.path.join(temp_dir, "part-%04d.csv.gz" % len(jobs))
+            jobs.append((part_path, table, min_cellid, max_cellid))
+
+    start = time.time()
+    total = 0
+    with util.gzip_open(path, "w", compresslevel=5) as gzip_wrapper:
+        with gzip_wrapper as gzip_file:
+            gzip_file.write(header_row)
+
+    # On failure, cancel the ranges which haven't started, wait for the
+    # running ones and remove all part files.
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_write_range, db, part_path, table, where, *cellids)
+                for part_path, table, *cellids in jobs
+            ]
+            try:
+                with open(path, "ab") as fd:
+                    for i, (future, job) in enumerate(zip(futures, jobs)):
+                        total += future.result()
+                        with open(job[0], "rb") as part:
+                            shutil.copyfileobj(part, fd)
+                        os.remove(job[0])
+                        duration = time.time() - start
+                        LOGGER.info(
+                            "Exported %d of %d ranges, %d rows, %.0f rows/s",
+                            i + 1,
+                            len(jobs),
+                            total,
+                            total / duration if duration else 0,
+                        )
+            except BaseException:
+                executor.shutdown(cancel_futures=True)
+                raise
+    finally:
+        for part_path, *_ in jobs:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+    return total
 
 
 class InvalidCSV(ValueError):
@@ -194,6 +411,7 @@ def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
                 existing.psc = shard.psc
                 existing.lon = shard.lon
                 existing.lat = shard.lat
+                existing.grid = shard.grid
                 existing.radius = shard.radius
                 existing.samples = shard.samples
                 existing.created = shard.created
@@ -261,7 +479,360 @@ def read_stations_from_csv(session, file_handle, redis_client, cellarea_queue):
         )
 
 
+_RADIO_TYPE = {"UMTS": Radio.wcdma, "GSM": Radio.gsm, "LTE": Radio.lte, "": None}
+_VALID_MCCS = numpy.array(sorted(constants.ALL_VALID_MCCS))
+_STATION_FIELDS = (
+    "cellid",
+    "radio",
+    "mcc",
+    "mnc",
+    "lac",
+    "cid",
+    "psc",
+    "lat",
+    "lon",
+    "grid",
+    "max_lat",
+    "min_lat",
+    "max_lon",
+    "min_lon",
+    "radius",
+    "region",
+    "samples",
+    "created",
+    "modified",
+)
+# Columns updated for newer stations, modified must come last.
+_UPDATE_FIELDS = (
+    "psc",
+    "lon",
+    "lat",
+    "grid",
+    "radius",
+    "samples",
+    "created",
+    "modified",
+)
+
+
+def _station_values(validated):
+    values = {name: validated.get(name) for name in _STATION_FIELDS}
+    values["cellid"] = encode_cellid(*validated["cellid"])
+    values["max_lat"] = values["min_lat"] = validated["lat"]
+    values["max_lon"] = values["min_lon"] = validated["lon"]
+    return values
+
+
+def _parse_rows_slowly(rows, first):
+    """Parse and validate CSV rows one at a time, like the row importer."""
+    stations = []
+    invalid = 0
+    for i, (radio, row) in enumerate(rows):
+        try:
+            data = {
+                "radio": radio,
+                "mcc": int(row[1]),
+                "mnc": int(row[2]),
+                "lac": int(row[3]),
+                "cid": int(row[4]),
+                "psc": int(row[5]) if row[5] else 0,
+                "lon": float(row[6]),
+                "lat": float(row[7]),
+                "radius": min(int(row[8]), CELL_MAX_RADIUS),
+                "samples": int(row[9]),
+                "created": _timestamp(row[11]),
+                "modified": _timestamp(row[12]),
+            }
+            validated = CellShard.validate(data, _raise_invalid=True)
+            if validated["lac"] is None or validated["cid"] is None:
+                raise ValueError("Missing LAC or CID.")
+        except (colander.Invalid, IndexError, ValueError) as e:
+            if first and i == 0:
+                raise InvalidCSV("first row %s is invalid: %s" % (row, e))
+            LOGGER.warning("row %s is invalid: %s", row, e)
+            invalid += 1
+            continue
+        stations.append(_station_values(validated))
+    return stations, invalid
+
+
+# The range of timestamps which can be converted to datetimes.
+_MIN_TIMESTAMP = (datetime.min - datetime(1970, 1, 1)) // timedelta(seconds=1)
+_MAX_TIMESTAMP = (datetime.max - datetime(1970, 1, 1)) // timedelta(seconds=1)
+
+
+def _timestamp(value):
+    value = int(value)
+    if not _MIN_TIMESTAMP <= value <= _MAX_TIMESTAMP:
+        raise ValueError("Timestamp %s out of range." % value)
+    return datetime.fromtimestamp(value, UTC)
+
+
+def _int_column(values):
+    column = numpy.array(values)
+    empty = column == ""
+    column[empty] = "0"
+    return column.astype(numpy.int64), empty
+
+
+def parse_stations(rows, first=False):
+    """
+    Parse and validate a chunk of rows from a public cell export CSV.
+
+    Returns a list of station values and the number of invalid rows.
+    The numeric columns of the whole chunk are converted and checked
+    with numpy, with the same rules as the cell shard schema and
+    :func:`_parse_rows_slowly`. If a
+    column can't be converted, the chunk is parsed row by row.
+
+    :param first: Is this the first chunk of the file? If its first
+        row is invalid, the file is likely invalid, too.
+    """
+    radio_rows = []
+    for row in rows:
+        try:
+            radio = _RADIO_TYPE[row[0]]
+        except (IndexError, KeyError):
+            raise InvalidCSV("Unknown radio type in row: %s" % row)
+        if radio is None:
+            LOGGER.warning("Skipping unknown radio: %s", row)
+            continue
+        radio_rows.append((radio, row))
+    if not radio_rows:
+        return [], 0
+
+    try:
+        columns = list(zip(*(row[1:13] for _, row in radio_rows)))
+        mcc, mcc_empty = _int_column(columns[0])
+        mnc, mnc_empty = _int_column(columns[1])
+        lac, lac_empty = _int_column(columns[2])
+        cid, cid_empty = _int_column(columns[3])
+        # An empty psc is imported as 0, like the row importer.
+        psc, _ = _int_column(columns[4])
+        lon = numpy.array(columns[5]).astype(numpy.double)
+        lat = numpy.array(columns[6]).astype(numpy.double)
+        radius, radius_empty = _int_column(columns[7])
+        samples, samples_empty = _int_column(columns[8])
+        created, created_empty = _int_column(columns[10])
+        modified, modified_empty = _int_column(columns[11])
+    except (IndexError, ValueError):
+        return _parse_rows_slowly(radio_rows, first)
+    empty = (
+        mcc_empty
+        | mnc_empty
+        | lac_empty
+        | cid_empty
+        | radius_empty
+        | samples_empty
+        | created_empty
+        | modified_empty
+    )
+
+    radio = numpy.array([int(radio) for radio, _ in radio_rows])
+    # If the cell id > 65535 then it must be a WCDMA tower.
+    radio[(radio == Radio.gsm) & (cid > constants.MAX_CID_GSM)] = Radio.wcdma
+    psc[(radio == Radio.lte) & (psc > constants.MAX_PSC_LTE)] = -1
+    psc_valid = (psc >= constants.MIN_PSC) & (psc <= constants.MAX_PSC)
+    radius = numpy.minimum(radius, CELL_MAX_RADIUS)
+
+    valid = (
+        ~empty
+        & numpy.isin(mcc, _VALID_MCCS)
+        & (mnc >= constants.MIN_MNC)
+        & (mnc <= constants.MAX_MNC)
+        & (lac >= constants.MIN_LAC)
+        & (lac <= constants.MAX_LAC)
+        & (cid >= constants.MIN_CID)
+        & (cid <= constants.MAX_CID)
+        & (lat >= constants.MIN_LAT)
+        & (lat <= constants.MAX_LAT)
+        & (lon >= constants.MIN_LON)
+        & (lon <= constants.MAX_LON)
+        & (radius >= 0)
+        & (samples >= 0)
+        & (created >= _MIN_TIMESTAMP)
+        & (created <= _MAX_TIMESTAMP)
+        & (modified >= _MIN_TIMESTAMP)
+        & (modified <= _MAX_TIMESTAMP)
+    )
+    if first and not valid[0]:
+        raise InvalidCSV("first row %s is invalid" % radio_rows[0][1])
+    for i in numpy.flatnonzero(~valid):
+        LOGGER.warning("row %s is invalid", radio_rows[i][1])
+
+    stations = []
+    for i in numpy.flatnonzero(valid):
+        key = (Radio(int(radio[i])), int(mcc[i]), int(mnc[i]), int(lac[i]), int(cid[i]))
+        station_lat = float(lat[i])
+        station_lon = float(lon[i])
+        stations.append(
+            {
+                "cellid": encode_cellid(*key),
+                "radio": key[0],
+                "mcc": key[1],
+                "mnc": key[2],
+                "lac": key[3],
+                "cid": key[4],
+                "psc": int(psc[i]) if psc_valid[i] else None,
+                "lat": station_lat,
+                "lon": station_lon,
+                "grid": station_grid(station_lat, station_lon),
+                "max_lat": station_lat,
+                "min_lat": station_lat,
+                "max_lon": station_lon,
+                "min_lon": station_lon,
+                "radius": int(radius[i]),
+                "region": GEOCODER.region_for_cell(station_lat, station_lon, key[1]),
+                "samples": int(samples[i]),
+                "created": datetime.fromtimestamp(int(created[i]), UTC),
+                "modified": datetime.fromtimestamp(int(modified[i]), UTC),
+            }
+        )
+    return stations, int((~valid).sum())
+
+
+def _parse_chunk(args):
+    return parse_stations(*args)
+
+
+def write_stations(session, stations):
+    """
+    Insert new and update older stations, with one multi-row upsert
+    per cell shard. Existing stations are only updated if the new
+    values have a newer modified time.
+
+    Returns a counter of new, updated and found stations per radio,
+    and the set of area ids of new and updated stations.
+    """
+    counts = defaultdict(Counter)
+    areas = set()
+    sharded = defaultdict(list)
+    for values in stations:
+        sharded[CellShard.shard_model(values["radio"])].append(values)
+
+    for shard, shard_values in sorted(
+        sharded.items(), key=lambda item: item[0].__tablename__
+    ):
+        table = shard.__table__
+        existing = dict(
+            session.execute(
+                select([table.c.cellid, table.c.modified]).where(
+                    table.c.cellid.in_([values["cellid"] for values in shard_values])
+                )
+            ).fetchall()
+        )
+        existing = {
+            encode_cellid(*cellid): modified for cellid, modified in existing.items()
+        }
+
+        for values in shard_values:
+            modified = existing.get(values["cellid"])
+            if modified is None:
+                operation = "new"
+            elif modified < values["modified"]:
+                operation = "updated"
+            else:
+                operation = "found"
+            counts[values["radio"].name][operation] += 1
+            if operation != "found":
+                areas.add(
+                    encode_cellarea(
+                        values["radio"], values["mcc"], values["mnc"], values["lac"]
+                    )
+                )
+
+        stmt = insert(table).values(shard_values)
+        # Spelled out, SQLAlchemy renders any inserted column in this
+        # expression as the column being updated.
+        newer = table.c.modified < literal_column("VALUES(`modified`)")
+        stmt = stmt.on_duplicate_key_update(
+            [
+                (name, func.if_(newer, stmt.inserted[name], table.c[name]))
+                for name in _UPDATE_FIELDS
+            ]
+        )
+        session.execute(stmt)
+
+    return counts, areas
+
+
+def load_stations_from_csv(
+    session, file_handle, redis_client, cellarea_queue, chunk_size=10000, pool=None
+):
+    """
+    Bulk load stations from a public cell export CSV.
+
+    This imports the same data as :func:`read_stations_from_csv`, but
+    parses and writes the rows in chunks, and queues the affected cell
+    areas once per chunk.
+
+    :arg session: a database session
+    :arg file_handle: an open file handle for the CSV data
+    :arg redis_client: a Redis client
+    :arg cellarea_queue: the DataQueue for updating cellarea IDs
+    :arg chunk_size: the number of CSV rows per chunk
+    :arg pool: an optional multiprocessing pool to parse chunks in
+    """
+    # Avoid circular imports
+    from ichnaea.data.tasks import update_cellarea, update_statregion
+
+    csv_content = peekable(reader(file_handle))
+    if not csv_content:
+        LOGGER.warning("Nothing to process.")
+        return
+
+    first_row = csv_content.peek()
+    if first_row == _FIELD_NAMES:
+        # Skip the first row because it's a header row
+        next(csv_content)
+    else:
+        LOGGER.warning("Expected header row, got data: %s", first_row)
+
+    chunks = (
+        (chunk, i == 0) for i, chunk in enumerate(chunked(csv_content, chunk_size))
+    )
+    mapper = map if pool is None else pool.imap
+
+    counts = defaultdict(Counter)
+    areas_total = 0
+    total = 0
+    for stations, invalid in mapper(_parse_chunk, chunks):
+        if stations:
+            chunk_counts, areas = write_stations(session, stations)
+            session.commit()
+            for radio_type, op_counts in chunk_counts.items():
+                counts[radio_type].update(op_counts)
+            if areas:
+                areas_total += len(areas)
+                with redis_pipeline(redis_client) as pipe:
+                    cellarea_queue.enqueue(list(areas), pipe=pipe)
+                update_cellarea.delay()
+        total += len(stations)
+        LOGGER.info("Processed %d stations, %d invalid in chunk", total, invalid)
+
+    # Now that we've updated all the cell areas, we need to update the
+    # statregion
+    update_statregion.delay()
+
+    LOGGER.info("Complete, processed %d station%s:", total, "" if total == 1 else "s")
+    for radio_type, op_counts in sorted(counts.items()):
+        LOGGER.info(
+            "  %s: %d new, %d updated, %d already loaded",
+            radio_type,
+            op_counts["new"],
+            op_counts["updated"],
+            op_counts["found"],
+        )
+    if areas_total:
+        LOGGER.info(
+            "  %d station area%s updated", areas_total, "" if areas_total == 1 else "s"
+        )
+
+
 class CellExport(object):
+
+    workers = 4  # Threads exporting the full export concurrently.
+
     def __init__(self, task):
         self.task = task
 
@@ -293,9 +864,22 @@ class CellExport(object):
 
         with util.selfdestruct_tempdir() as temp_dir:
             path = os.path.join(temp_dir, filename)
-            with self.task.db_session(commit=False) as session:
-                write_stations_to_csv(
-                    session, path, today, start_time=start_time, end_time=end_time
+            if hourly:
+                # Look up only the cells in the change log. Without a
+                # complete log, fall back to scanning for the modified cells.
+                cellids = read_cell_changes(self.task.redis_client, start_time)
+                with self.task.db_session(commit=False) as session:
+                    write_stations_to_csv(
+                        session,
+                        path,
+                        today,
+                        start_time=start_time,
+                        end_time=end_time,
+                        cellids=cellids,
+                    )
+            else:
+                write_stations_to_csv_parallel(
+                    self.task.app.db, path, today, workers=self.workers
                 )
             self.write_stations_to_s3(path, bucket)
 
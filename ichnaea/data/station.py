@@ -1,20 +1,29 @@
 from collections import defaultdict
+from contextlib import contextmanager
 from datetime import timedelta
+import time
 
 import markus
 import numpy
-
-from geocalc import circle_radius, distance
-from ichnaea.db import retry_on_mysql_lock_fail
+from sqlalchemy import select
+from sqlalchemy.dialects.mysql import insert
+
+from geocalc import circle_radius, circle_radius_array, distance, distance_array
+from ichnaea.conf import settings
+from ichnaea.data.area import AREA_DELTA_FIELDS
+from ichnaea.data.public import log_cell_changes
+from ichnaea.db import is_mysql_lock_error, retry_on_mysql_lock_fail
 from ichnaea.geocode import GEOCODER
 from ichnaea.models import (
     decode_cellid,
     encode_cellarea,
+    encode_cellid,
     BlueObservation,
     CellObservation,
     WifiObservation,
     ReportSource,
     station_blocked,
+    station_grid,
     StatCounter,
     StatKey,
 )
@@ -24,6 +33,8 @@ from ichnaea import util
 
 METRICS = markus.get_metrics()
 
+_AGGREGATE = object()
+
 
 class StationState(object):
 
@@ -31,7 +42,16 @@ class StationState(object):
     MAX_OLD_WEIGHT = 10000.0
     MAX_OLD_DAYS = 365
 
-    def __init__(self, station_key, station, source, observations, now, today):
+    def __init__(
+        self,
+        station_key,
+        station,
+        source,
+        observations,
+        now,
+        today,
+        obs_data=_AGGREGATE,
+    ):
         self.station_key = station_key
         self.station = station
         self.source = source
@@ -39,7 +59,10 @@ class StationState(object):
         self.now = now
         self.today = today
         self.one_year = today - timedelta(days=self.MAX_OLD_DAYS)
-        self.obs_data = self.aggregate_obs()
+        if obs_data is _AGGREGATE:
+            # Not pre-computed by a batch aggregation, do it now.
+            obs_data = self.aggregate_obs()
+        self.obs_data = obs_data
 
     def base_key(self):
         raise NotImplementedError()
@@ -155,6 +178,7 @@ class StationState(object):
                 "modified": self.now,
                 "lat": None,
                 "lon": None,
+                "grid": None,
                 "max_lat": None,
                 "min_lat": None,
                 "max_lon": None,
@@ -185,6 +209,7 @@ class StationState(object):
                 "modified": self.now,
                 "lat": data["lat"],
                 "lon": data["lon"],
+                "grid": station_grid(data["lat"], data["lon"]),
                 "max_lat": data["max_lat"],
                 "min_lat": data["min_lat"],
                 "max_lon": data["max_lon"],
@@ -217,6 +242,7 @@ class StationState(object):
                 "modified": self.now,
                 "lat": data["lat"],
                 "lon": data["lon"],
+                "grid": station_grid(data["lat"], data["lon"]),
                 "max_lat": data["max_lat"],
                 "min_lat": data["min_lat"],
                 "max_lon": data["max_lon"],
@@ -244,50 +270,85 @@ class StationState(object):
         )
         return ("new_block", values)
 
-    def bounded_samples_weight(self, samples, weight):
+    @staticmethod
+    def bounded_samples_weight(samples, weight):
         # put in maximum value to avoid overflow of DB column
         return (min(samples, 4294967295), min(weight, 1000000000.0))
 
-    def aggregate_obs(self):
-        positions = numpy.array(
-            [(obs.lat, obs.lon) for obs in self.observations], dtype=numpy.double
-        )
-
-        max_lat, max_lon = positions.max(axis=0)
-        min_lat, min_lon = positions.min(axis=0)
-
-        box_distance = distance(min_lat, min_lon, max_lat, max_lon)
-        if box_distance > self.MAX_DIST_METERS:
-            return None
-
-        weights = numpy.array(
-            [obs.weight for obs in self.observations], dtype=numpy.double
-        )
+    @classmethod
+    def aggregate_obs_batch(cls, lat, lon, weight, group_starts):
+        """
+        Aggregate the observations of many stations at once.
+
+        The observations are passed in as flat arrays, sorted by station.
+        ``group_starts`` holds the index of the first observation of each
+        station. Returns a list with one aggregate per station, or None
+        for stations whose observations are too far apart.
+        """
+        if not len(group_starts):
+            return []
+
+        samples = numpy.diff(numpy.append(group_starts, len(lat)))
+        max_lat = numpy.maximum.reduceat(lat, group_starts)
+        min_lat = numpy.minimum.reduceat(lat, group_starts)
+        max_lon = numpy.maximum.reduceat(lon, group_starts)
+        min_lon = numpy.minimum.reduceat(lon, group_starts)
+
+        weights = numpy.add.reduceat(weight, group_starts)
+        ctr_lat = numpy.add.reduceat(lat * weight, group_starts) / weights
+        ctr_lon = numpy.add.reduceat(lon * weight, group_starts) / weights
+
+        # Most stations are only seen at a single position, their
+        # bounding box is a point and both box distance and radius are 0.
+        spread = (max_lat != min_lat) | (max_lon != min_lon)
+        box_distance = numpy.zeros(len(group_starts))
+        radius = numpy.zeros(len(group_starts), dtype=numpy.int64)
+        if spread.any():
+            box_distance[spread] = distance_array(
+                min_lat[spread], min_lon[spread], max_lat[spread], max_lon[spread]
+            )
+            radius[spread] = circle_radius_array(
+                ctr_lat[spread],
+                ctr_lon[spread],
+                max_lat[spread],
+                max_lon[spread],
+                min_lat[spread],
+                min_lon[spread],
+            )
 
-        lat, lon = numpy.average(positions, axis=0, weights=weights)
-        lat = float(lat)
-        lon = float(lon)
-        radius = circle_radius(lat, lon, max_lat, max_lon, min_lat, min_lon)
-        region = GEOCODER.region(lat, lon)
+        result = []
+        for i in range(len(group_starts)):
+            if box_distance[i] > cls.MAX_DIST_METERS:
+                result.append(None)
+                continue
 
-        samples, weight = self.bounded_samples_weight(
-            len(self.observations), float(weights.sum())
-        )
+            lat_i = float(ctr_lat[i])
+            lon_i = float(ctr_lon[i])
+            samples_i, weight_i = cls.bounded_samples_weight(
+                int(samples[i]), float(weights[i])
+            )
+            result.append(
+                {
+                    "lat": lat_i,
+                    "lon": lon_i,
+                    "max_lat": float(max_lat[i]),
+                    "min_lat": float(min_lat[i]),
+                    "max_lon": float(max_lon[i]),
+                    "min_lon": float(min_lon[i]),
+                    "radius": int(radius[i]),
+                    "region": GEOCODER.region(lat_i, lon_i),
+                    "samples": samples_i,
+                    "weight": weight_i,
+                }
+            )
+        return result
 
-        return {
-            "positions": positions,
-            "weights": weights,
-            "lat": lat,
-            "lon": lon,
-            "max_lat": float(max_lat),
-            "min_lat": float(min_lat),
-            "max_lon": float(max_lon),
-            "min_lon": float(min_lon),
-            "radius": radius,
-            "region": region,
-            "samples": samples,
-            "weight": weight,
-        }
+    def aggregate_obs(self):
+        observations = self.observations
+        lat = numpy.array([obs.lat for obs in observations], dtype=numpy.double)
+        lon = numpy.array([obs.lon for obs in observations], dtype=numpy.double)
+        weight = numpy.array([obs.weight for obs in observations], dtype=numpy.double)
+        return self.aggregate_obs_batch(lat, lon, weight, numpy.array([0]))[0]
 
     def aggregate_station_obs(self):
         station = self.station
@@ -297,14 +358,15 @@ class StationState(object):
             value = getattr(station, name, None)
             return numpy.nan if value is None else value
 
-        positions = numpy.append(
-            obs_data["positions"],
+        positions = numpy.array(
             [
+                (obs_data["max_lat"], obs_data["max_lon"]),
+                (obs_data["min_lat"], obs_data["min_lon"]),
                 (get_nan("lat"), get_nan("lon")),
                 (get_nan("max_lat"), get_nan("max_lon")),
                 (get_nan("min_lat"), get_nan("min_lon")),
             ],
-            axis=0,
+            dtype=numpy.double,
         )
 
         max_lat, max_lon = numpy.nanmax(positions, axis=0)
@@ -412,16 +474,33 @@ class StationUpdater(object):
         self.today = self.now.date()
         self.data_queues = self.task.app.data_queues
         self.data_queue = self.data_queues[self.queue_prefix + shard_id]
+        self.skip_locked = settings("station_skip_locked")
+        self.lock_errors = 0
+        self.changed = []
+
+    def query_shard(self, session, shard, keys, skip_locked=False):
+        """
+        Select and lock the station rows for the given keys, locking
+        them in primary key order.
+        """
+        raise NotImplementedError()
 
-    def query_shard(self, session, shard, keys):
+    def query_existing(self, session, shard, keys):
+        """Return the subset of keys which have a station row."""
         raise NotImplementedError()
 
-    def add_area_update(self, updated_areas, key):
+    def add_area_update(self, updated_areas, key, status, station, values):
         pass
 
     def queue_area_updates(self, pipe, updated_areas):
         pass
 
+    def dual_write(self, session, shard, keys):
+        pass
+
+    def log_changes(self, pipe, keys):
+        pass
+
     def stat_count(self, type_, action, count):
         if count > 0:
             METRICS.incr(
@@ -439,25 +518,82 @@ class StationUpdater(object):
         self.stat_count("station", "confirm", stats_counter["confirm"])
         self.stat_count("station", "new", stats_counter["new"])
 
+    def shard_tags(self, shard):
+        return ["type:%s" % self.station_type, "shard:%s" % shard.__tablename__]
+
+    @contextmanager
+    def track_lock_errors(self, shard):
+        """Count lock wait timeouts and deadlocks per shard."""
+        try:
+            yield
+        except Exception as exc:
+            if is_mysql_lock_error(exc):
+                self.lock_errors += 1
+                METRICS.incr(
+                    "data.station.lock.error",
+                    tags=self.shard_tags(shard) + ["errno:%s" % exc.orig.args[0]],
+                )
+            raise
+
     def query_stations(self, session, shard, shard_values):
         blocklist = {}
         stations = {}
+        contended = set()
 
-        keys = list(shard_values.keys())
-        rows = self.query_shard(session, shard, keys)
+        keys = sorted(shard_values.keys())
+        with METRICS.timer("data.station.lock.timing", tags=self.shard_tags(shard)):
+            rows = self.query_shard(session, shard, keys, skip_locked=self.skip_locked)
         for row in rows:
             unique_key = row.unique_key
             stations[unique_key] = row
             blocklist[unique_key] = station_blocked(row, self.today)
 
-        return (blocklist, stations)
+        if self.skip_locked:
+            # Rows locked by another task were skipped, tell them apart
+            # from stations which don't exist yet.
+            missing = [key for key in keys if key not in stations]
+            if missing:
+                contended = set(self.query_existing(session, shard, missing))
+
+        return (blocklist, stations, contended)
+
+    def aggregate_obs(self, pending):
+        """
+        Aggregate the observations of all pending stations of a shard
+        in one vectorized batch.
+        """
+        counts = numpy.array(
+            [len(observations) for _, _, observations in pending], dtype=numpy.intp
+        )
+        total = int(counts.sum())
+        all_obs = [obs for _, _, observations in pending for obs in observations]
+        lat = numpy.fromiter(
+            (obs.lat for obs in all_obs), dtype=numpy.double, count=total
+        )
+        lon = numpy.fromiter(
+            (obs.lon for obs in all_obs), dtype=numpy.double, count=total
+        )
+        weight = numpy.fromiter(
+            (obs.weight for obs in all_obs), dtype=numpy.double, count=total
+        )
+        group_starts = numpy.cumsum(counts) - counts
+        return self.station_state.aggregate_obs_batch(lat, lon, weight, group_starts)
 
-    def update_shard(self, session, shard, shard_values, stats_counter):
-        updated_areas = set()
+    def update_shard(self, session, shard, shard_values, stats_counter, deferred):
+        updated_areas = {}
         new_data = defaultdict(list)
-        blocklist, stations = self.query_stations(session, shard, shard_values)
+        written = []
+        blocklist, stations, contended = self.query_stations(
+            session, shard, shard_values
+        )
 
+        pending = []
         for station_key, observations in shard_values.items():
+            if station_key in contended:
+                # Leave stations locked by another task for a later run.
+                deferred.extend(observations)
+                continue
+
             # Count all observations.
             stats_counter["obs"] += len(observations)
 
@@ -473,14 +609,24 @@ class StationUpdater(object):
                     # treat fused, fixed as gnss
                     grouped_obs[ReportSource.gnss].append(obs)
 
-            station = stations.get(station_key, None)
             source = ReportSource.gnss
             if not grouped_obs[source]:
                 # Only query observations.
                 source = ReportSource.query
 
+            pending.append((station_key, source, grouped_obs[source]))
+
+        obs_data = self.aggregate_obs(pending) if pending else []
+        for (station_key, source, observations), data in zip(pending, obs_data):
+            station = stations.get(station_key, None)
             state = self.station_state(
-                station_key, station, source, grouped_obs[source], self.now, self.today
+                station_key,
+                station,
+                source,
+                observations,
+                self.now,
+                self.today,
+                obs_data=data,
             )
 
             transition = state.transition()
@@ -493,6 +639,9 @@ class StationUpdater(object):
                 continue
 
             new_data[status].append(result)
+            written.append(station_key)
+            if status in ("new", "change", "replace"):
+                self.changed.append(station_key)
 
             if status in ("change", "confirm", "replace"):
                 stats_counter["confirm"] += 1
@@ -503,7 +652,9 @@ class StationUpdater(object):
 
             # track potential updates to dependent areas
             if status != "confirm":
-                self.add_area_update(updated_areas, station_key)
+                self.add_area_update(
+                    updated_areas, station_key, status, station, result
+                )
 
         if new_data["new"]:
             session.execute(
@@ -526,6 +677,9 @@ class StationUpdater(object):
         if new_data["confirm"]:
             session.bulk_update_mappings(shard, new_data["confirm"])
 
+        if written:
+            self.dual_write(session, shard, written)
+
         return updated_areas
 
     def shard_observations(self, observations):
@@ -543,41 +697,113 @@ class StationUpdater(object):
         return sharded_obs
 
     def __call__(self):
-        sharded_obs = self.shard_observations(self.data_queue.dequeue())
+        batch = self.data_queue.current_batch()
+        items = self.data_queue.dequeue(batch=batch)
+        sharded_obs = self.shard_observations(items)
         if not sharded_obs:
+            # Empty runs are input for the adaptive batch controller, too.
+            self.data_queue.record_batch(len(items), 0.0, 0)
             return
 
         retry_wrapper = retry_on_mysql_lock_fail(
             metric="data.station.dberror", metric_tags=[f"type:{self.station_type}"]
         )(self.update_observations)
-        updated_areas, stats = retry_wrapper(sharded_obs)
+        start = time.time()
+        try:
+            updated_areas, stats, deferred = retry_wrapper(sharded_obs)
+        finally:
+            # Feed the adaptive batch controller, also on failure.
+            duration = (time.time() - start) * 1000.0
+            self.data_queue.record_batch(len(items), duration, self.lock_errors)
 
         with self.task.redis_pipeline() as pipe:
             if updated_areas:
                 self.queue_area_updates(pipe, updated_areas)
+            for shard, observations in deferred.items():
+                self.data_queue.enqueue(
+                    [obs.to_json() for obs in observations], pipe=pipe
+                )
+                METRICS.incr(
+                    "data.station.deferred",
+                    len(observations),
+                    tags=self.shard_tags(shard),
+                )
+            if self.changed:
+                self.log_changes(pipe, self.changed)
             self.emit_stats(pipe, stats)
 
-        if self.data_queue.ready():
+        if self.data_queue.ready(batch=batch):
             self.task.apply_async(kwargs={"shard_id": self.shard_id})
 
     def update_observations(self, sharded_observations):
-        """Update the station data based on per-shard observations."""
+        """
+        Update the station data based on per-shard observations.
+
+        Shards are locked in a fixed order, by table name, and rows
+        inside each shard by primary key, so concurrent tasks don't
+        deadlock each other.
+        """
         stats = defaultdict(int)
-        updated_areas = set()
+        updated_areas = {}
+        deferred = {}
+        # Reset on retries, the rows of a failed attempt weren't written.
+        self.changed = []
 
         with self.task.db_session() as session:
-            for shard, shard_values in sharded_observations.items():
-                areas = self.update_shard(session, shard, shard_values, stats)
+            for shard, shard_values in sorted(
+                sharded_observations.items(), key=lambda item: item[0].__tablename__
+            ):
+                shard_deferred = []
+                with self.track_lock_errors(shard):
+                    areas = self.update_shard(
+                        session, shard, shard_values, stats, shard_deferred
+                    )
                 updated_areas.update(areas)
-        return updated_areas, stats
+                if shard_deferred:
+                    deferred[shard] = shard_deferred
+        return updated_areas, stats, deferred
 
 
 class MacUpdater(StationUpdater):
-    def query_shard(self, session, shard, keys):
+    def query_shard(self, session, shard, keys, skip_locked=False):
         return (
-            (session.query(shard).filter(shard.mac.in_(keys))).with_for_update().all()
+            session.query(shard)
+            .filter(shard.mac.in_(keys))
+            .order_by(shard.mac)
+            .with_for_update(skip_locked=skip_locked)
+            .all()
         )
 
+    def query_existing(self, session, shard, keys):
+        rows = session.query(shard.mac).filter(shard.mac.in_(keys)).all()
+        return [row.mac for row in rows]
+
+    def dual_write(self, session, shard, keys):
+        """
+        While a re-sharding is in progress, copy the written rows to
+        their shards in the next shard layout. The next layout tables
+        are created by ``reshard.py --create-tables`` beforehand.
+        """
+        next_keys = defaultdict(list)
+        for key in keys:
+            next_shard = shard.next_shard_model(key)
+            if next_shard is not None and next_shard is not shard:
+                next_keys[next_shard].append(key)
+
+        table = shard.__table__
+        columns = [column.name for column in table.columns]
+        for next_shard, mac_keys in sorted(
+            next_keys.items(), key=lambda item: item[0].__tablename__
+        ):
+            query = select([table.c[name] for name in columns]).where(
+                table.c.mac.in_(mac_keys)
+            )
+            stmt = insert(next_shard.__table__).from_select(columns, query)
+            stmt = stmt.on_duplicate_key_update(
+                **{name: stmt.inserted[name] for name in columns if name != "mac"}
+            )
+            session.execute(stmt)
+
 
 class BlueUpdater(MacUpdater):
 
@@ -608,16 +834,63 @@ class CellUpdater(StationUpdater):
     stat_obs_key = StatKey.cell
     stat_station_key = StatKey.unique_cell
 
-    def query_shard(self, session, shard, keys):
+    def query_shard(self, session, shard, keys, skip_locked=False):
         return (
-            (session.query(shard).filter(shard.cellid.in_(keys)))
-            .with_for_update()
+            session.query(shard)
+            .filter(shard.cellid.in_(keys))
+            .order_by(shard.cellid)
+            .with_for_update(skip_locked=skip_locked)
             .all()
         )
 
-    def add_area_update(self, updated_areas, key):
-        updated_areas.add(encode_cellarea(*decode_cellid(key)[:4]))
+    def query_existing(self, session, shard, keys):
+        rows = session.query(shard.cellid).filter(shard.cellid.in_(keys)).all()
+        return [encode_cellid(*row.cellid) for row in rows]
+
+    def add_area_update(self, updated_areas, key, status, station, values):
+        """
+        Track the areas of changed cells.
+
+        New and moved cells are sent as deltas to the area updater,
+        stamped with the update time, so the area updater can tell if
+        a later recompute already includes them. Blocked and replaced cells
+        can shrink an area, which requires a full recompute. A value of
+        None for an area requests the full recompute.
+        """
+        cellarea = decode_cellid(key)[:4]
+        areaid = encode_cellarea(*cellarea)
+        if status not in ("new", "change") or (
+            areaid in updated_areas and updated_areas[areaid] is None
+        ):
+            updated_areas[areaid] = None
+            return
+
+        old = None
+        if status == "change" and station.lat is not None and station.lon is not None:
+            old = {field: getattr(station, field) for field in AREA_DELTA_FIELDS}
+        updated_areas.setdefault(areaid, []).append(
+            {
+                "areaid": encode_cellarea(*cellarea, codec="base64").decode("ascii"),
+                "old": old,
+                "new": {field: values[field] for field in AREA_DELTA_FIELDS},
+                "last_seen": values["last_seen"].isoformat(),
+                "modified": self.now.isoformat(),
+            }
+        )
+
+    def log_changes(self, pipe, keys):
+        """Log the changed cells for the hourly cell export."""
+        log_cell_changes(pipe, self.now, keys)
 
     def queue_area_updates(self, pipe, updated_areas):
-        data_queue = self.data_queues["update_cellarea"]
-        data_queue.enqueue(list(updated_areas), pipe=pipe)
+        areaids = []
+        deltas = []
+        for areaid, area_deltas in updated_areas.items():
+            if area_deltas is None:
+                areaids.append(areaid)
+            else:
+                deltas.extend(area_deltas)
+        if areaids:
+            self.data_queues["update_cellarea"].enqueue(areaids, pipe=pipe)
+        if deltas:
+            self.data_queues["update_cellarea_delta"].enqueue(deltas, pipe=pipe)
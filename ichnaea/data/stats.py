@@ -1,8 +1,9 @@
 from datetime import timedelta
 
-from sqlalchemy import delete, func, select
+from sqlalchemy import func, select
 from sqlalchemy.dialects.mysql import insert
 
+from ichnaea.data.partition import add_partitions, expire_partitions
 from ichnaea.models import (
     BlueShard,
     CellArea,
@@ -81,13 +82,10 @@ class StatCleaner(object):
         today = util.utcnow().date()
         two_years = today - timedelta(days=365 * 2)
 
-        deleted_rows = 0
         with self.task.db_session() as session:
             table = Stat.__table__
-            deleted_rows = session.execute(
-                delete(table).where(table.c.time < two_years)
-            )
-        return deleted_rows
+            add_partitions(session, table, today)
+            return expire_partitions(session, table, "time", two_years)
 
 
 class StatRegion(object):
@@ -12,7 +12,9 @@ from celery.schedules import crontab
 from ichnaea import models
 from ichnaea.data import (
     _cell_export_enabled,
+    _data_queue_tasks_enabled,
     _map_content_enabled,
+    _map_content_queue_tasks_enabled,
     area,
     datamap,
     export,
@@ -94,14 +96,15 @@ def sentry_test(self, msg):
     _countdown=2,
     expires=20,
     _schedule=timedelta(seconds=32),
+    _enabled=_data_queue_tasks_enabled,
 )
 def update_incoming(self):
     export.IncomingQueue(self)(export_reports)
 
 
 @celery_app.task(base=BaseTask, bind=True, queue="celery_export", expires=300)
-def export_reports(self, name, queue_key):
-    export.ReportExporter.export(self, name, queue_key)
+def export_reports(self, name, queue_key, retry=0):
+    export.ReportExporter.export(self, name, queue_key, retry=retry)
 
 
 @celery_app.task(
@@ -111,6 +114,7 @@ def export_reports(self, name, queue_key):
     expires=30,
     _schedule=timedelta(seconds=48),
     _shard_model=models.BlueShard,
+    _enabled=_data_queue_tasks_enabled,
 )
 def update_blue(self, shard_id=None):
     station.BlueUpdater(self, shard_id=shard_id)()
@@ -123,6 +127,7 @@ def update_blue(self, shard_id=None):
     expires=30,
     _schedule=timedelta(seconds=41),
     _shard_model=models.CellShard,
+    _enabled=_data_queue_tasks_enabled,
 )
 def update_cell(self, shard_id=None):
     station.CellUpdater(self, shard_id=shard_id)()
@@ -135,6 +140,7 @@ def update_cell(self, shard_id=None):
     expires=30,
     _schedule=timedelta(seconds=40),
     _shard_model=models.WifiShard,
+    _enabled=_data_queue_tasks_enabled,
 )
 def update_wifi(self, shard_id=None):
     station.WifiUpdater(self, shard_id=shard_id)()
@@ -146,6 +152,7 @@ def update_wifi(self, shard_id=None):
     queue="celery_cell",
     expires=30,
     _schedule=timedelta(seconds=44),
+    _enabled=_data_queue_tasks_enabled,
 )
 def update_cellarea(self):
     area.CellAreaUpdater(self)()
@@ -159,6 +166,7 @@ def update_cellarea(self):
     _schedule=crontab(hour=0, minute=17),
     _shard_model=models.DataMap,
     _enabled=_map_content_enabled,
+    _lease_chain=False,
 )
 def cleanup_datamap(self, shard_id=None):
     datamap.DataMapCleaner(self, shard_id=shard_id)()
@@ -172,7 +180,7 @@ def cleanup_datamap(self, shard_id=None):
     expires=30,
     _schedule=timedelta(seconds=47),
     _shard_model=models.DataMap,
-    _enabled=_map_content_enabled,
+    _enabled=_map_content_queue_tasks_enabled,
 )
 def update_datamap(self, shard_id=None):
     datamap.DataMapUpdater(self, shard_id=shard_id)()
@@ -16,6 +16,31 @@ class TestArea(object):
     def area_queue(self, celery):
         return celery.data_queues["update_cellarea"]
 
+    def delta_queue(self, celery):
+        return celery.data_queues["update_cellarea_delta"]
+
+    def delta(self, area, new, old=None, modified=None):
+        values = {"radius": 0, "region": area.region}
+        values.update(new)
+        for name in ("lat", "lon"):
+            values.setdefault("max_" + name, values[name])
+            values.setdefault("min_" + name, values[name])
+        if modified is None:
+            modified = area.modified + timedelta(seconds=1)
+        return {
+            "areaid": encode_cellarea(*area.areaid, codec="base64").decode("ascii"),
+            "old": old,
+            "new": values,
+            "last_seen": util.utcnow().date().isoformat(),
+            "modified": modified.isoformat(),
+        }
+
+    def grow_bbox(self, area, margin=0.1):
+        area.max_lat = area.lat + margin
+        area.min_lat = area.lat - margin
+        area.max_lon = area.lon + margin
+        area.min_lon = area.lon - margin
+
     def test_empty(self, celery, session):
         self.task.delay().get()
 
@@ -86,6 +111,169 @@ class TestArea(object):
         assert area.num_cells == 2
         assert area.last_seen == today
 
+    def test_delta_new_cell(self, celery, session):
+        area = self.area_factory(num_cells=2, avg_cell_radius=100, radius=0)
+        session.commit()
+
+        delta = self.delta(
+            area, {"lat": area.lat + 0.03, "lon": area.lon + 0.03, "radius": 400}
+        )
+        self.delta_queue(celery).enqueue([delta])
+        self.task.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 3
+        assert round(area.lat, 7) == round(delta["new"]["lat"] - 0.02, 7)
+        assert round(area.lon, 7) == round(delta["new"]["lon"] - 0.02, 7)
+        assert area.max_lat == delta["new"]["lat"]
+        assert area.max_lon == delta["new"]["lon"]
+        assert area.radius > 0
+        assert area.avg_cell_radius == 200
+        assert area.region == "GB"
+
+    def test_delta_moved_cell(self, celery, session):
+        area = self.area_factory(num_cells=2, avg_cell_radius=100, radius=0)
+        self.grow_bbox(area)
+        session.commit()
+        modified = area.modified
+
+        old = {"lat": area.lat, "lon": area.lon, "radius": 100, "region": "GB"}
+        delta = self.delta(
+            area, {"lat": area.lat + 0.02, "lon": area.lon, "radius": 300}, old=old
+        )
+        self.delta_queue(celery).enqueue([delta])
+        self.task.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 2
+        assert round(area.lat, 7) == round(old["lat"] + 0.01, 7)
+        assert area.avg_cell_radius == 200
+        # The modified time tracks full recomputes only.
+        assert area.modified == modified
+
+    def test_delta_moved_edge_cell(self, celery, session):
+        area = self.area_factory(num_cells=2)
+        self.grow_bbox(area)
+        cell = self.cell_factory(
+            lat=area.lat,
+            lon=area.lon,
+            radio=area.radio,
+            mcc=area.mcc,
+            mnc=area.mnc,
+            lac=area.lac,
+        )
+        session.commit()
+
+        # The old cell position defined the area box, which must shrink.
+        old = {"lat": area.max_lat, "lon": area.lon, "radius": 0, "region": "GB"}
+        delta = self.delta(area, {"lat": area.lat, "lon": area.lon}, old=old)
+        self.delta_queue(celery).enqueue([delta])
+        self.task.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 1
+        assert area.max_lat == cell.max_lat
+
+    def test_delta_before_recompute(self, celery, session):
+        area = self.area_factory(num_cells=2)
+        cell = self.cell_factory(
+            lat=area.lat,
+            lon=area.lon,
+            radio=area.radio,
+            mcc=area.mcc,
+            mnc=area.mnc,
+            lac=area.lac,
+        )
+        session.commit()
+
+        # The area was recomputed after the delta was produced, so
+        # the cell might be counted already.
+        delta = self.delta(
+            area,
+            {"lat": area.lat + 0.01, "lon": area.lon},
+            modified=area.modified - timedelta(seconds=1),
+        )
+        self.delta_queue(celery).enqueue([delta])
+        self.task.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 1
+        assert area.lat == cell.lat
+
+    def test_delta_full_recompute(self, celery, session):
+        today = util.utcnow().date()
+        area = self.area_factory(
+            num_cells=5, modified=util.utcnow() - timedelta(days=1)
+        )
+        cell = self.cell_factory(
+            lat=area.lat,
+            lon=area.lon,
+            radio=area.radio,
+            mcc=area.mcc,
+            mnc=area.mnc,
+            lac=area.lac,
+        )
+        session.commit()
+
+        self.delta_queue(celery).enqueue([self.delta(area, {"lat": 1.0, "lon": 1.0})])
+        self.task.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 1
+        assert area.lat == cell.lat
+        assert area.max_lat == cell.max_lat
+        assert area.modified.date() == today
+
+    def test_delta_region_change(self, celery, session):
+        area = self.area_factory(num_cells=3)
+        cell = self.cell_factory(
+            lat=area.lat,
+            lon=area.lon,
+            radio=area.radio,
+            mcc=area.mcc,
+            mnc=area.mnc,
+            lac=area.lac,
+        )
+        session.commit()
+
+        delta = self.delta(area, {"lat": 1.0, "lon": 1.0, "region": "FR"})
+        self.delta_queue(celery).enqueue([delta])
+        self.task.delay().get()
+
+        session.refresh(area)
+        assert area.num_cells == 1
+        assert area.lat == cell.lat
+
+    def test_batch(self, celery, session):
+        removed = self.area_factory(radio=Radio.lte)
+        updated = self.area_factory(radio=Radio.gsm, num_cells=5)
+        cell1 = self.cell_factory(
+            radio=updated.radio,
+            mcc=updated.mcc,
+            mnc=updated.mnc,
+            lac=updated.lac,
+            lat=updated.lat,
+            lon=updated.lon,
+        )
+        cell2 = self.cell_factory(radio=Radio.wcdma, lac=updated.lac + 1)
+        session.commit()
+
+        self.area_queue(celery).enqueue(
+            [
+                encode_cellarea(*removed.areaid),
+                encode_cellarea(*updated.areaid),
+                area_id(cell2),
+            ]
+        )
+        self.task.delay().get()
+
+        areas = {area.areaid: area for area in session.query(self.area_model)}
+        assert set(areas) == {updated.areaid, cell2.cellid[:4]}
+        assert areas[updated.areaid].num_cells == 1
+        assert areas[updated.areaid].lat == cell1.lat
+        assert areas[cell2.cellid[:4]].num_cells == 1
+        assert areas[cell2.cellid[:4]].lat == cell2.lat
+
     def test_update_incomplete_cell(self, celery, session):
         area = self.area_factory(radius=500)
         area_key = {
@@ -0,0 +1,115 @@
+from unittest import mock
+
+from ichnaea.data.consumer import ConsumerTask, DataQueueConsumer, queue_runners
+from ichnaea.data.tasks import update_wifi
+from ichnaea.models import WifiShard
+from ichnaea.tests.factories import WifiObservationFactory
+
+
+class TestConsumer(object):
+    def test_queue_runners(self, celery):
+        runners = queue_runners()
+        expected = set(
+            name for name in celery.data_queues if not name.startswith("update_datamap")
+        )
+        assert set(runners) == expected
+
+    def test_consumer_task(self, celery):
+        task = ConsumerTask(update_wifi)
+        assert task.app is celery
+        with mock.patch.object(update_wifi, "apply_async") as apply_async:
+            task.apply_async(kwargs={"shard_id": "0"})
+            task.apply_countdown(kwargs={"shard_id": "0"})
+        assert not apply_async.called
+
+    def test_wait(self, celery, redis):
+        consumer = DataQueueConsumer(celery, {}, timeout=0.1)
+        queue = celery.data_queues["update_incoming"]
+        assert not consumer.wait(queue.key)
+
+        queue.enqueue([{"a": 1}, {"b": 2}])
+        assert consumer.wait(queue.key)
+        assert queue.size() == 2
+
+    def test_run_batch(self, celery, redis, session, metricsmock):
+        mac = WifiObservationFactory().mac
+        obs = WifiObservationFactory.create_batch(3, mac=mac)
+        shard_id = WifiShard.shard_id(mac)
+        queue = celery.data_queues["update_wifi_" + shard_id]
+        queue.enqueue([ob.to_json() for ob in obs])
+
+        consumer = DataQueueConsumer(celery, queue_runners(), timeout=0.1)
+        assert consumer.wait(queue.key)
+        with mock.patch.object(update_wifi, "apply_async") as apply_async:
+            assert consumer.run_batch(queue.key)
+        assert not apply_async.called
+
+        assert queue.size() == 0
+        shard = WifiShard.shard_model(mac)
+        assert session.query(shard).count() == 1
+        metricsmock.assert_timing_once(
+            "data.consumer.timing", tags=["queue:" + queue.key]
+        )
+
+    def test_run_batch_leased(self, celery, redis, session):
+        obs = WifiObservationFactory()
+        shard_id = WifiShard.shard_id(obs.mac)
+        queue = celery.data_queues["update_wifi_" + shard_id]
+        queue.enqueue([obs.to_json()])
+
+        # Another process updates the shard.
+        lease = redis.lock(update_wifi.lease_key(shard_id), timeout=10)
+        assert lease.acquire(blocking=False)
+        consumer = DataQueueConsumer(celery, queue_runners(), timeout=0.1)
+        assert not consumer.run_batch(queue.key)
+        assert queue.size() == 1
+
+        lease.release()
+        assert consumer.run_batch(queue.key)
+        assert queue.size() == 0
+
+    def test_idle(self, celery, redis, metricsmock):
+        queue = celery.data_queues["update_incoming"]
+        queue.enqueue([{"a": 1}])
+
+        consumer = DataQueueConsumer(celery, {}, timeout=0.1)
+
+        def defer():
+            consumer.stop()
+            # Leave the data in the queue.
+
+        consumer.runners[queue.key] = defer
+        consumer.idle_backoff = 0.0
+        consumer.consume(queue.key)
+
+        assert queue.size() == 1
+        metricsmock.assert_incr_once("data.consumer.idle", tags=["queue:" + queue.key])
+
+    def test_error(self, celery, redis, raven, metricsmock):
+        queue = celery.data_queues["update_incoming"]
+        queue.enqueue([{"a": 1}])
+
+        consumer = DataQueueConsumer(celery, {}, timeout=0.1)
+
+        def fail():
+            consumer.stop()
+            raise ValueError("broken")
+
+        consumer.runners[queue.key] = fail
+        consumer.error_backoff = 0.0
+        consumer.consume(queue.key)
+
+        raven.check([("ValueError", 1)])
+        metricsmock.assert_incr_once("data.consumer.error", tags=["queue:" + queue.key])
+
+    def test_start_stop(self, celery, redis):
+        runner = mock.Mock()
+        consumer = DataQueueConsumer(
+            celery, {"update_incoming": runner}, concurrency=2, timeout=0.1
+        )
+        consumer.start()
+        assert len(consumer.threads) == 2
+        consumer.stop()
+        consumer.join(timeout=0.1)
+        assert not any(thread.is_alive() for thread in consumer.threads)
+        assert not runner.called
@@ -1,6 +1,7 @@
 from collections import defaultdict
 from datetime import timedelta
 
+from ichnaea.data.datamap import SEEN_BLOCK, seen_grid_bit
 from ichnaea.data.tasks import cleanup_datamap, update_datamap
 from ichnaea.models.content import DataMap, encode_datamap_grid
 from ichnaea import util
@@ -107,6 +108,53 @@ class TestDataMapUpdater(object):
         assert grids[0].created == self.yesterday
         assert grids[0].modified == self.today
 
+    def test_duplicates(self, celery, session):
+        lat = 1.0
+        lon = 2.0
+        shard_id = DataMap.shard_id(*DataMap.scale(lat, lon))
+        two_days = self.today - timedelta(days=2)
+        self._add(session, [(lat, lon, self.yesterday), (lat, lon, two_days)])
+        self._queue(celery, [(lat, lon)])
+        update_datamap.delay(shard_id=shard_id).get()
+
+        # The rows of the grid are collapsed into one.
+        grids = session.query(DataMap.shards()[shard_id]).all()
+        assert len(grids) == 1
+        assert grids[0].created == two_days
+        assert grids[0].modified == self.today
+
+    def test_seen_today(self, celery, redis, session):
+        lat = 1.0
+        lon = 2.0
+        shard_id = DataMap.shard_id(*DataMap.scale(lat, lon))
+        shard = DataMap.shards()[shard_id]
+        self._queue(celery, [(lat, lon)])
+        update_datamap.delay(shard_id=shard_id).get()
+        assert session.query(shard).count() == 1
+
+        # The grid was marked as seen, and isn't written again today.
+        session.query(shard).delete()
+        session.commit()
+        self._queue(celery, [(lat, lon)])
+        update_datamap.delay(shard_id=shard_id).get()
+        assert session.query(shard).count() == 0
+
+        key, offset = seen_grid_bit(
+            encode_datamap_grid(*DataMap.scale(lat, lon)), self.today
+        )
+        assert redis.getbit(key, offset) == 1
+        assert redis.ttl(key) > 0
+
+    def test_seen_grid_bit(self):
+        day = self.today
+        keys = set()
+        for lat, lon in ((-90000, -180000), (90000, 180000), (127, 127), (128, 0)):
+            key, offset = seen_grid_bit(encode_datamap_grid(lat, lon), day)
+            assert 0 <= offset < SEEN_BLOCK * SEEN_BLOCK
+            keys.add(key)
+        assert len(keys) == 4
+        assert day.strftime("%Y%m%d") in key
+
     def test_multiple(self, celery, session):
         self._add(
             session,
@@ -3,12 +3,25 @@ import time
 from unittest import mock
 
 import boto3
+import botocore.exceptions
 import pytest
 import requests_mock
 
-from ichnaea.data.export import DummyExporter, InternalTransform
-from ichnaea.data.tasks import update_blue, update_cell, update_incoming, update_wifi
-from ichnaea.models import BlueShard, CellShard, WifiShard
+from ichnaea.data.export import (
+    DummyExporter,
+    http_session,
+    InternalTransform,
+    S3Exporter,
+    s3_client,
+)
+from ichnaea.data.tasks import (
+    export_reports,
+    update_blue,
+    update_cell,
+    update_incoming,
+    update_wifi,
+)
+from ichnaea.models import BlueShard, CellShard, ExportConfig, WifiShard
 from ichnaea.tests.factories import (
     ApiKeyFactory,
     BlueShardFactory,
@@ -144,27 +157,64 @@ class TestExporter(BaseExportTest):
         update_incoming.delay().get()
         assert self.queue_length(redis, "queue_export_everything") == 1
 
-    def test_retry(self, celery, redis, session):
+    def test_config_cache(self, celery, redis, session):
+        ExportConfigFactory(name="test", batch=5)
+        session.flush()
+        self.add_reports(celery, 1)
+        update_incoming.delay().get()
+
+        # New configs are used once the version changes.
+        ExportConfigFactory(name="new", batch=5)
+        session.flush()
+        self.add_reports(celery, 1)
+        update_incoming.delay().get()
+        assert self.queue_length(redis, "queue_export_test") == 2
+        assert self.queue_length(redis, "queue_export_new") == 0
+
+        ExportConfig.increment_version(redis)
+        self.add_reports(celery, 1)
+        update_incoming.delay().get()
+        assert self.queue_length(redis, "queue_export_test") == 3
+        assert self.queue_length(redis, "queue_export_new") == 1
+
+    def test_retry(self, celery, redis, session, metricsmock):
         ExportConfigFactory(name="test", batch=1)
         session.flush()
         self.add_reports(celery, 1)
 
         num = [0]
-        orig_wait = DummyExporter._retry_wait
 
         def mock_send(self, data, num=num):
             num[0] += 1
             if num[0] == 1:
                 raise IOError()
 
-        with mock.patch("ichnaea.data.export.DummyExporter.send", mock_send):
-            try:
-                DummyExporter._retry_wait = 0.001
+        with mock.patch.object(DummyExporter, "send", mock_send):
+            with mock.patch.object(
+                export_reports, "apply_async", wraps=export_reports.apply_async
+            ) as apply_async:
                 update_incoming.delay().get()
-            finally:
-                DummyExporter._retry_wait = orig_wait
 
+        assert num[0] == 2
+        assert apply_async.call_args[1]["kwargs"] == {"retry": 1}
+        assert apply_async.call_args[1]["countdown"] == DummyExporter._retry_wait
         assert self.queue_length(redis, "queue_export_test") == 0
+        assert self.queue_length(redis, "retry_queue_export_test") == 0
+        metricsmock.assert_incr_once("data.export.batch", value=1, tags=["key:test"])
+
+    def test_retry_limit(self, celery, redis, session, metricsmock):
+        ExportConfigFactory(name="test", batch=1)
+        session.flush()
+        self.add_reports(celery, 1)
+
+        send = mock.Mock(side_effect=IOError())
+        with mock.patch.object(DummyExporter, "send", send):
+            update_incoming.delay().get()
+
+        assert send.call_count == DummyExporter._retries
+        assert self.queue_length(redis, "queue_export_test") == 0
+        assert self.queue_length(redis, "retry_queue_export_test") == 0
+        assert not metricsmock.filter_records("incr", "data.export.batch")
 
 
 class TestGeosubmit(BaseExportTest):
@@ -215,9 +265,94 @@ class TestGeosubmit(BaseExportTest):
         )
         metricsmock.assert_timing_once("data.export.upload.timing", tags=["key:test"])
 
+    def test_session(self):
+        assert http_session("test") is http_session("test")
+        assert http_session("test") is not http_session("other")
+
+    def test_concurrent(self, celery, redis, session, metricsmock):
+        ExportConfigFactory(
+            name="test",
+            batch=2,
+            schema="geosubmit",
+            url="http://127.0.0.1:9/v2/geosubmit?key=external",
+        )
+        session.flush()
+        self.add_reports(celery, 7)
+
+        with requests_mock.Mocker() as mock:
+            mock.register_uri("POST", requests_mock.ANY, text="{}")
+            update_incoming.delay().get()
+
+        # Three full batches were sent by one task, the rest stays queued.
+        assert mock.call_count == 3
+        sizes = [
+            len(json.loads(util.decode_gzip(req.body))["items"])
+            for req in mock.request_history
+        ]
+        assert sizes == [2, 2, 2]
+        assert self.queue_length(redis, "queue_export_test") == 1
+        assert (
+            len(
+                metricsmock.filter_records(
+                    "incr", "data.export.batch", value=1, tags=["key:test"]
+                )
+            )
+            == 3
+        )
+
+    def test_retry(self, celery, redis, session):
+        ExportConfigFactory(
+            name="test",
+            batch=2,
+            schema="geosubmit",
+            url="http://127.0.0.1:9/v2/geosubmit?key=external",
+        )
+        session.flush()
+        self.add_reports(celery, 2)
+
+        with requests_mock.Mocker() as mock:
+            mock.register_uri(
+                "POST",
+                requests_mock.ANY,
+                [{"status_code": 503}, {"status_code": 200, "text": "{}"}],
+            )
+            update_incoming.delay().get()
+
+        assert mock.call_count == 2
+        bodies = [util.decode_gzip(req.body) for req in mock.request_history]
+        assert bodies[0] == bodies[1]
+        assert self.queue_length(redis, "retry_queue_export_test") == 0
+
+
+class LocalS3(object):
+    """A local stand-in for the S3 client, keeping objects in memory."""
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kw):
+        if self.failures:
+            self.failures -= 1
+            raise botocore.exceptions.EndpointConnectionError(endpoint_url=Bucket)
+        self.objects[(Bucket, Key)] = dict(kw, Body=Body)
+
 
 class TestS3(BaseExportTest):
-    def test_upload(self, celery, session, metricsmock):
+    @pytest.fixture
+    def s3(self):
+        local_s3 = LocalS3()
+        s3_client.cache_clear()
+        with mock.patch.object(boto3, "client", return_value=local_s3):
+            yield local_s3
+        s3_client.cache_clear()
+
+    def test_client_cached(self, s3):
+        assert s3_client() is s3
+        assert s3_client() is s3
+        assert boto3.client.call_count == 1
+
+    def test_upload(self, celery, session, metricsmock, s3):
         ExportConfigFactory(
             name="backup",
             batch=3,
@@ -234,32 +369,21 @@ class TestS3(BaseExportTest):
         self.add_reports(celery, 3, api_key=None)
         self.add_reports(celery, 3, api_key="no-position", set_position=False)
 
-        mock_conn = mock.MagicMock()
-        mock_bucket = mock.MagicMock()
-        mock_obj = mock.MagicMock()
-        mock_conn.return_value.Bucket.return_value = mock_bucket
-        mock_bucket.Object.return_value = mock_obj
-
-        with mock.patch.object(boto3, "resource", mock_conn):
-            update_incoming.delay().get()
-
-        obj_calls = mock_bucket.Object.call_args_list
-        put_calls = mock_obj.put.call_args_list
-        assert len(obj_calls) == 5
-        assert len(put_calls) == 5
+        update_incoming.delay().get()
 
+        assert len(s3.objects) == 5
         keys = []
         test_export = None
-        for obj_call, put_call in zip(obj_calls, put_calls):
-            s3_key = obj_call[0][0]
+        for (bucket, s3_key), obj in s3.objects.items():
+            assert bucket == "bucket"
             assert s3_key.startswith("backups/")
             assert s3_key.endswith(".json.gz")
-            assert put_call[1]["Body"]
-            assert put_call[1]["ContentType"] == "application/json"
-            assert put_call[1]["ContentEncoding"] == "gzip"
+            assert obj["Body"]
+            assert obj["ContentType"] == "application/json"
+            assert obj["ContentEncoding"] == "gzip"
             keys.append(s3_key)
             if "test" in s3_key:
-                test_export = put_call[1]["Body"]
+                test_export = obj["Body"]
 
         # extract second and third path segment from key names
         groups = [tuple(key.split("/")[1:3]) for key in keys]
@@ -309,6 +433,115 @@ class TestS3(BaseExportTest):
             )
             == 5
         )
+        assert (
+            len(
+                metricsmock.filter_records(
+                    "histogram", "data.export.upload.size", tags=["key:backup"]
+                )
+            )
+            == 5
+        )
+
+    def test_coalesce(self, celery, redis, session, s3):
+        ExportConfigFactory(
+            name="backup", batch=3, schema="s3", url="s3://bucket/backups/{source}"
+        )
+        ApiKeyFactory(valid_key="e5444-794")
+        session.flush()
+
+        self.add_reports(celery, 3)
+        self.add_reports(celery, 6, api_key="e5444-794")
+        self.add_reports(celery, 3, api_key="e5444-794", source="fused")
+        update_incoming.delay().get()
+
+        # Partitions with the same url are combined into one object.
+        assert len(s3.objects) == 2
+        sizes = {}
+        for (_, s3_key), obj in s3.objects.items():
+            items = json.loads(util.decode_gzip(obj["Body"]))["items"]
+            sizes[s3_key.split("/")[1]] = len(items)
+        assert sizes == {"gnss": 9, "fused": 3}
+        assert redis.ttl("export_window_backup") > 0
+
+        # Data arriving during the window stays queued.
+        self.add_reports(celery, 3)
+        update_incoming.delay().get()
+        assert len(s3.objects) == 2
+        assert self.queue_length(redis, "queue_export_backup:gnss:test") == 3
+
+        redis.delete("export_window_backup")
+        update_incoming.delay().get()
+        assert len(s3.objects) == 3
+        assert self.queue_length(redis, "queue_export_backup:gnss:test") == 0
+
+    def test_partitions(self, celery, redis, session, s3):
+        ExportConfigFactory(name="backup", batch=3, schema="s3", url="s3://bucket/")
+        session.flush()
+
+        self.add_reports(celery, 1)
+        self.add_reports(celery, 3, api_key="other")
+        update_incoming.delay().get()
+        assert redis.smembers("export_partitions_backup") == {
+            b"queue_export_backup:gnss:test",
+            b"queue_export_backup:gnss:other",
+        }
+        assert len(s3.objects) == 1
+
+        # Exported queues are removed from the partitions.
+        update_incoming.delay().get()
+        assert redis.smembers("export_partitions_backup") == {
+            b"queue_export_backup:gnss:test"
+        }
+
+    def test_max_batches(self, celery, redis, session, s3):
+        ExportConfigFactory(
+            name="backup", batch=2, schema="s3", url="s3://bucket/backups/"
+        )
+        session.flush()
+
+        self.add_reports(celery, 7)
+        with mock.patch.object(S3Exporter, "max_batches", 2):
+            update_incoming.delay().get()
+
+        # The remaining data was exported without waiting for the window.
+        sizes = [
+            len(json.loads(util.decode_gzip(obj["Body"]))["items"])
+            for obj in s3.objects.values()
+        ]
+        assert sorted(sizes) == [3, 4]
+        assert self.queue_length(redis, "queue_export_backup:gnss:test") == 0
+
+    def test_failure(self, celery, redis, session, metricsmock, s3):
+        ExportConfigFactory(
+            name="backup", batch=3, schema="s3", url="s3://bucket/backups/"
+        )
+        session.flush()
+
+        self.add_reports(celery, 3)
+        s3.failures = 1
+        update_incoming.delay().get()
+
+        assert s3.objects == {}
+        assert self.queue_length(redis, "queue_export_backup:gnss:test") == 3
+        assert redis.smembers("export_partitions_backup") == {
+            b"queue_export_backup:gnss:test"
+        }
+        assert (
+            len(
+                metricsmock.filter_records(
+                    "incr",
+                    "data.export.upload",
+                    value=1,
+                    tags=["key:backup", "status:failure"],
+                )
+            )
+            == 1
+        )
+        assert not metricsmock.filter_records("incr", "data.export.batch")
+
+        redis.delete("export_window_backup")
+        update_incoming.delay().get()
+        assert len(s3.objects) == 1
 
 
 class TestInternalTransform(object):
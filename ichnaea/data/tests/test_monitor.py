@@ -13,6 +13,11 @@ from ichnaea.data.tasks import (
     monitor_queue_size_and_rate_control,
     sentry_test,
 )
+from ichnaea.queue import (
+    BATCH_CONTROLLER_BATCH,
+    BATCH_CONTROLLER_STATS,
+    SetDataQueue,
+)
 from ichnaea import util
 
 
@@ -191,6 +196,7 @@ class TestMonitorQueueSizeAndRateControl:
         "update_cell_lte": ["data", "cell"],
         "update_cell_wcdma": ["data", "cell"],
         "update_cellarea": ["data", "cellarea"],
+        "update_cellarea_delta": ["data", "cellarea"],
         "update_datamap_ne": ["data", "datamap"],
         "update_datamap_nw": ["data", "datamap"],
         "update_datamap_se": ["data", "datamap"],
@@ -232,7 +238,10 @@ class TestMonitorQueueSizeAndRateControl:
             data[name] = random.randint(1, 10)
 
         for key, val in data.items():
-            redis.lpush(key, *range(val))
+            if isinstance(celery.data_queues.get(key), SetDataQueue):
+                redis.sadd(key, *range(val))
+            else:
+                redis.lpush(key, *range(val))
 
         monitor_queue_size_and_rate_control.delay().get()
         for key, val in data.items():
@@ -586,6 +595,93 @@ class TestMonitorQueueSizeAndRateControl:
         metricsmock.assert_not_gauge("trx_history.purging")
         metricsmock.assert_not_gauge("rate_control.locate.target")
 
+    def test_batch_control_disabled(self, celery, redis, metricsmock):
+        """A disabled batch controller resets all batch sizes."""
+        redis.hset(BATCH_CONTROLLER_BATCH, "update_wifi_0", 20)
+        monitor_queue_size_and_rate_control.delay().get()
+
+        assert int(redis.get("batch_controller_enabled")) == 0
+        assert not redis.exists(BATCH_CONTROLLER_BATCH)
+        assert celery.data_queues["update_wifi_0"].current_batch() == 500
+        metricsmock.assert_not_gauge("rate_control.batch")
+
+        # Later runs don't delete the batch sizes again.
+        with mock.patch.object(
+            celery.redis_client, "delete", wraps=celery.redis_client.delete
+        ) as delete:
+            monitor_queue_size_and_rate_control.delay().get()
+        delete.assert_not_called()
+
+    def test_batch_control(self, celery, redis, metricsmock):
+        """The batch controller reacts to lock errors, slow tasks and backlogs."""
+        redis.set("batch_controller_enabled", 1)
+        redis.set("batch_controller_duration", 1000)
+        redis.lpush("update_wifi_1", *range(1000))
+        redis.lpush("update_wifi_2", *range(1000))
+        redis.lpush("update_cellarea", *range(10))
+        celery.data_queues["update_wifi_0"].record_batch(500, 200, 2)
+        celery.data_queues["update_wifi_1"].record_batch(500, 2000, 0)
+        celery.data_queues["update_wifi_2"].record_batch(500, 200, 0)
+        celery.data_queues["update_cellarea"].record_batch(10, 200, 0)
+
+        monitor_queue_size_and_rate_control.delay().get()
+
+        assert int(redis.get("batch_controller_min")) == 10
+        assert int(redis.get("batch_controller_max")) == 5000
+        batches = {
+            name: celery.data_queues[name].current_batch()
+            for name in (
+                "update_wifi_0",
+                "update_wifi_1",
+                "update_wifi_2",
+                "update_wifi_3",
+                "update_cellarea",
+            )
+        }
+        assert batches == {
+            "update_wifi_0": 250,
+            "update_wifi_1": 375,
+            "update_wifi_2": 625,
+            "update_wifi_3": 500,
+            "update_cellarea": 100,
+        }
+        assert not redis.exists(BATCH_CONTROLLER_STATS + "update_wifi_0")
+        for name, batch in batches.items():
+            metricsmock.assert_gauge_once(
+                "rate_control.batch", value=batch, tags=["queue:" + name]
+            )
+        metricsmock.assert_not_gauge(
+            "rate_control.batch", tags=["queue:update_datamap_ne"]
+        )
+
+    def test_batch_control_limits(self, celery, redis):
+        """Batch sizes stay within the configured limits."""
+        redis.set("batch_controller_enabled", 1)
+        redis.set("batch_controller_min", 300)
+        redis.set("batch_controller_max", 550)
+        redis.lpush("update_wifi_1", *range(1000))
+        celery.data_queues["update_wifi_0"].record_batch(500, 200, 1)
+        celery.data_queues["update_wifi_1"].record_batch(500, 200, 0)
+
+        monitor_queue_size_and_rate_control.delay().get()
+
+        assert celery.data_queues["update_wifi_0"].current_batch() == 300
+        assert celery.data_queues["update_wifi_1"].current_batch() == 550
+
+    @pytest.mark.parametrize(
+        "key", ("batch_controller_min", "batch_controller_duration")
+    )
+    def test_batch_control_auto_disable(self, celery, redis, metricsmock, key):
+        """When some Redis values fail to validate, it disables the batch controller."""
+        redis.set("batch_controller_enabled", 1)
+        redis.set(key, -1)
+
+        monitor_queue_size_and_rate_control.delay().get()
+
+        assert int(redis.get("batch_controller_enabled")) == 0
+        assert not redis.exists(BATCH_CONTROLLER_BATCH)
+        metricsmock.assert_not_gauge("rate_control.batch")
+
 
 class TestSentryTest:
     def test_basic(self, celery, raven_client):
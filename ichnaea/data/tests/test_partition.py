@@ -0,0 +1,139 @@
+from datetime import date, timedelta
+
+from sqlalchemy import Column, Date, Integer, MetaData, Table
+
+from ichnaea.data.partition import (
+    add_partitions,
+    expire_partitions,
+    MAX_PARTITION,
+    next_month,
+    partition_definitions,
+    partition_name,
+    table_partitions,
+)
+from ichnaea.db import db_worker_session
+from ichnaea.models import Stat, StatKey
+from ichnaea import util
+
+
+class TestPartition(object):
+    def test_next_month(self):
+        assert next_month(date(2026, 1, 31)) == date(2026, 2, 1)
+        assert next_month(date(2026, 12, 1)) == date(2027, 1, 1)
+
+    def test_partition_definitions(self):
+        assert partition_definitions(date(2026, 11, 15), date(2027, 1, 1)) == [
+            "PARTITION p202611 VALUES LESS THAN ('2026-12-01')",
+            "PARTITION p202612 VALUES LESS THAN ('2027-01-01')",
+            "PARTITION p202701 VALUES LESS THAN ('2027-02-01')",
+        ]
+        assert partition_definitions(date(2027, 2, 1), date(2027, 1, 1)) == []
+
+    def test_unpartitioned(self, session):
+        # A temporary table doesn't commit the test transaction.
+        table = Table(
+            "partition_test",
+            MetaData(),
+            Column("id", Integer, primary_key=True),
+            Column("time", Date),
+            prefixes=["TEMPORARY"],
+        )
+        table.create(session.connection())
+        session.execute(
+            table.insert().values(
+                [
+                    {"id": 1, "time": date(2026, 1, 1)},
+                    {"id": 2, "time": date(2026, 2, 1)},
+                ]
+            )
+        )
+
+        assert table_partitions(session, table) == []
+        assert add_partitions(session, table, date(2026, 2, 1)) == []
+        assert expire_partitions(session, table, "time", date(2026, 2, 1)) == (0, 1)
+        assert session.execute(table.select()).fetchall() == [(2, date(2026, 2, 1))]
+
+
+class TestPartitioned(object):
+    """
+    The migrations partition the stat table, with monthly partitions
+    covering two years back and three months ahead. The DDL statements
+    commit implicitly, so the tests use a clean database.
+    """
+
+    table = Stat.__table__
+
+    @property
+    def today(self):
+        return util.utcnow().date()
+
+    def _add(self, db, times):
+        with db_worker_session(db) as session:
+            session.add_all(
+                [Stat(key=StatKey.cell, time=time, value=1) for time in times]
+            )
+
+    def _times(self, db):
+        with db_worker_session(db, commit=False) as session:
+            return sorted(row.time for row in session.query(Stat).all())
+
+    def _partitions(self, db):
+        with db_worker_session(db, commit=False) as session:
+            return table_partitions(session, self.table)
+
+    def test_migration(self, clean_db):
+        partitions = self._partitions(clean_db)
+        assert partitions[0][0] == partition_name(self.today - timedelta(days=730))
+        assert partitions[-1] == (MAX_PARTITION, None)
+        ahead = self.today.replace(day=1)
+        for i in range(4):
+            ahead = next_month(ahead)
+        assert partitions[-2][1] == ahead
+
+    def test_add_partitions(self, clean_db):
+        later = self.today + timedelta(days=100)
+        beyond = self.today + timedelta(days=400)
+        self._add(clean_db, [self.today, later, beyond])
+        before = self._partitions(clean_db)
+
+        with db_worker_session(clean_db) as session:
+            added = add_partitions(session, self.table, later)
+
+        last = later.replace(day=1)
+        for i in range(3):
+            last = next_month(last)
+        assert added[0] == partition_name(before[-2][1])
+        assert added[-1] == partition_name(last)
+        after = self._partitions(clean_db)
+        assert [name for name, bound in after] == (
+            [name for name, bound in before[:-1]] + added + [MAX_PARTITION]
+        )
+        # Rows of the split pmax partition are kept.
+        assert self._times(clean_db) == [self.today, later, beyond]
+
+        # Partitions which already exist aren't added again.
+        with db_worker_session(clean_db) as session:
+            assert add_partitions(session, self.table, later) == []
+
+    def test_expire_partitions(self, clean_db):
+        cutoff = self.today - timedelta(days=365)
+        old = self.today - timedelta(days=800)
+        self._add(clean_db, [old, cutoff - timedelta(days=1), cutoff, self.today])
+        before = self._partitions(clean_db)
+        expired = [
+            name for name, bound in before if bound is not None and bound <= cutoff
+        ]
+        # The first partition holds all older rows, too.
+        assert before[0][0] in expired
+
+        with db_worker_session(clean_db) as session:
+            dropped, deleted = expire_partitions(session, self.table, "time", cutoff)
+
+        assert dropped == len(expired)
+        after = self._partitions(clean_db)
+        assert after == [
+            partition for partition in before if partition[0] not in expired
+        ]
+        assert after[0][1] > cutoff
+        # Rows before the cutoff are gone, with or without their partition.
+        assert self._times(clean_db) == [cutoff, self.today]
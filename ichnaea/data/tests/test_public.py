@@ -1,6 +1,8 @@
 import csv
+import gzip
 import os
 import re
+import time
 from datetime import datetime, timedelta
 from io import StringIO
 from unittest import mock
@@ -11,12 +13,20 @@ from zoneinfo import ZoneInfo
 from sqlalchemy import func
 
 from ichnaea.data.public import (
+    _parse_rows_slowly,
+    cellid_ranges,
+    CellExport,
+    load_stations_from_csv,
+    log_cell_changes,
+    parse_stations,
+    read_cell_changes,
     read_stations_from_csv,
     write_stations_to_csv,
+    write_stations_to_csv_parallel,
     InvalidCSV,
 )
 from ichnaea.data.tasks import cell_export_full, cell_export_diff
-from ichnaea.models import Radio, CellArea, CellShard, RegionStat
+from ichnaea.models import Radio, CellArea, CellShard, RegionStat, encode_cellid
 from ichnaea.taskapp.config import configure_data
 from ichnaea.tests.factories import CellShardFactory
 from ichnaea import util
@@ -126,6 +136,64 @@ class TestExport(object):
         tmp_file = mock_obj.upload_file.call_args[0][0]
         assert pattern.search(tmp_file)
 
+    def test_change_log_export(self, celery, redis, session):
+        now = util.utcnow()
+        end_time = now.replace(minute=0, second=0, microsecond=0)
+        start_time = end_time - timedelta(hours=1)
+        modified = start_time + timedelta(minutes=30)
+        cells = CellShardFactory.create_batch(
+            3, radio=Radio.lte, created=modified, modified=modified
+        )
+        gsm_cell = CellShardFactory(
+            radio=Radio.gsm, created=modified, modified=modified
+        )
+        # Logged, but modified outside of the hour.
+        old_cell = CellShardFactory(radio=Radio.gsm)
+        session.commit()
+
+        logged = [cells[0], cells[2], gsm_cell, old_cell]
+        with redis.pipeline() as pipe:
+            log_cell_changes(
+                pipe, modified, [encode_cellid(*cell.cellid) for cell in logged]
+            )
+            pipe.execute()
+        # The log only started during the hour.
+        assert read_cell_changes(redis, start_time) is None
+        # The log of the next hour is complete, without changes so far.
+        assert read_cell_changes(redis, end_time) == []
+
+        with redis.pipeline() as pipe:
+            log_cell_changes(
+                pipe,
+                start_time - timedelta(minutes=30),
+                [encode_cellid(*old_cell.cellid)],
+            )
+            pipe.execute()
+        cellids = read_cell_changes(redis, start_time)
+        assert len(cellids) == 4
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            path = os.path.join(temp_dir, "export.csv.gz")
+            write_stations_to_csv(
+                session,
+                path,
+                now.date(),
+                start_time=start_time,
+                end_time=end_time,
+                cellids=cellids,
+            )
+            with util.gzip_open(path, "r") as gzip_wrapper:
+                with gzip_wrapper as gzip_file:
+                    reader = csv.DictReader(gzip_file, CELL_FIELDS)
+                    next(reader)
+                    exported = [(row["radio"], int(row["cid"])) for row in reader]
+
+        # Tables are written in shard order.
+        assert exported[0] == ("GSM", gsm_cell.cid)
+        assert sorted(exported[1:]) == sorted(
+            [("LTE", cells[0].cid), ("LTE", cells[2].cid)]
+        )
+
     def test_export_full(self, celery, session):
         now = util.utcnow()
         long_ago = now - timedelta(days=367)
@@ -145,8 +213,10 @@ class TestExport(object):
         mock_conn.return_value.Bucket.return_value = mock_bucket
         mock_bucket.Object.return_value = mock_obj
 
+        # The test sessions share one database connection.
         with mock.patch.object(boto3, "resource", mock_conn):
-            cell_export_full(_bucket="bucket")
+            with mock.patch.object(CellExport, "workers", 1):
+                cell_export_full(_bucket="bucket")
 
         s3_key = mock_bucket.Object.call_args[0][0]
         assert pattern.search(s3_key)
@@ -154,6 +224,73 @@ class TestExport(object):
         tmp_file = mock_obj.upload_file.call_args[0][0]
         assert pattern.search(tmp_file)
 
+    def test_cellid_ranges(self):
+        ranges = cellid_ranges(Radio.gsm, 4)
+        assert len(ranges) == 4
+        assert ranges[0][0] is None
+        assert ranges[-1][1] is None
+        for (_, upper), (lower, _) in zip(ranges, ranges[1:]):
+            assert upper == lower
+        assert cellid_ranges(Radio.lte, 1) == [(None, None)]
+
+    def test_parallel_export(self, celery, session, metricsmock):
+        today = util.utcnow().date()
+        for mcc in (1, 234, 262, 310, 460, 734, 999):
+            CellShardFactory(radio=Radio.gsm, mcc=mcc)
+        CellShardFactory.create_batch(3, radio=Radio.wcdma)
+        CellShardFactory.create_batch(3, radio=Radio.lte)
+        session.commit()
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            path = os.path.join(temp_dir, "export.csv.gz")
+            write_stations_to_csv(session, path, today)
+            parallel_dir = os.path.join(temp_dir, "parallel")
+            os.mkdir(parallel_dir)
+            parallel_path = os.path.join(parallel_dir, "export.csv.gz")
+            # The test sessions share one database connection.
+            total = write_stations_to_csv_parallel(
+                celery.db, parallel_path, today, workers=1, partitions=4
+            )
+
+            with gzip.open(path, "rb") as fd:
+                expected = fd.read()
+            with gzip.open(parallel_path, "rb") as fd:
+                content = fd.read()
+            assert os.listdir(parallel_dir) == ["export.csv.gz"]
+
+        assert total == 13
+        assert content == expected
+        assert len(content.split(b"\r\n")) == 15
+        assert (
+            len(metricsmock.filter_records("timing", "data.cell_export.timing")) == 12
+        )
+
+    def test_parallel_export_error(self):
+        today = util.utcnow().date()
+        calls = []
+
+        def write_range(db, path, table, where, min_cellid, max_cellid):
+            calls.append(path)
+            with open(path, "wb") as fd:
+                fd.write(b"")
+            if len(calls) == 1:
+                raise ValueError("broken range")
+            time.sleep(0.1)
+            return 0
+
+        with util.selfdestruct_tempdir() as temp_dir:
+            path = os.path.join(temp_dir, "export.csv.gz")
+            with mock.patch("ichnaea.data.public._write_range", write_range):
+                with pytest.raises(ValueError):
+                    write_stations_to_csv_parallel(
+                        None, path, today, workers=1, partitions=4
+                    )
+            # No part files are left behind.
+            assert os.listdir(temp_dir) == ["export.csv.gz"]
+
+        # The outstanding ranges were cancelled.
+        assert len(calls) < 12
+
 
 @pytest.fixture
 def cellarea_queue(redis_client, celery):
@@ -417,3 +554,179 @@ LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
         assert session.query(func.count(lte_model.cellid)).scalar() == 1
         assert session.query(func.count(CellArea.areaid)).scalar() == 2
         assert session.query(func.count(RegionStat.region)).scalar() == 1
+
+
+class TestBulkImport:
+    header = (
+        "radio,mcc,net,area,cell,unit,lon,lat,range,samples,changeable,"
+        "created,updated,averageSignal\n"
+    )
+
+    def load(self, session, redis_client, cellarea_queue, rows, chunk_size=2):
+        csv = StringIO(self.header + rows)
+        load_stations_from_csv(
+            session, csv, redis_client, cellarea_queue, chunk_size=chunk_size
+        )
+
+    def test_parse(self):
+        rows = [
+            "UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,",
+            "GSM,208,10,30014,120669,3,2.51,46.59,0,78,1,1566307030,1570119413,",
+            "LTE,202,1,2120,12842,600,23.41,38.85,0,6,1,1568220588,1570120328,",
+            "GSM,553,10,30014,20669,,2.51,46.59,0,78,1,1566307030,1570119413,",
+            "GSM,208,10,0,20669,,2.51,46.59,-1,78,1,1566307030,1570119413,",
+            ",208,10,30014,20669,,2.51,46.59,0,78,1,1566307030,1570119413,",
+        ]
+        stations, invalid = parse_stations(list(csv.reader(rows)), first=True)
+        assert invalid == 2
+        wcdma, gsm, lte = stations
+        assert wcdma["radio"] is Radio.wcdma
+        assert wcdma["psc"] == 0
+        assert wcdma["region"] == "GR"
+        assert wcdma["max_lat"] == wcdma["min_lat"] == 38.8574351
+        assert wcdma["modified"] == datetime(2019, 10, 3, 16, 31, 56, tzinfo=UTC)
+        # A GSM cell id > 65535 is a WCDMA cell.
+        assert gsm["radio"] is Radio.wcdma
+        assert gsm["region"] == "FR"
+        # Out of range values are dropped.
+        assert lte["psc"] is None
+
+    def test_parse_fallback(self):
+        rows = [
+            "UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,",
+            'GSM,"MCC",10,30014,20669,,2.51,46.59,0,78,1,1566307030,1570119413,',
+        ]
+        stations, invalid = parse_stations(list(csv.reader(rows)))
+        assert invalid == 1
+        assert [station["mcc"] for station in stations] == [202]
+
+    def test_parse_same_as_slowly(self):
+        rows = [
+            "UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,",
+            # Negative samples.
+            "UMTS,202,1,2120,12843,,23.41,38.85,0,-6,1,1568220564,1570120316,",
+            # Out of range psc, which is dropped.
+            "UMTS,202,1,2120,12844,600,23.41,38.85,0,6,1,1568220564,1570120316,",
+            "LTE,202,1,2120,12845,-3,23.41,38.85,0,6,1,1568220564,1570120316,",
+            # Invalid positions.
+            "UMTS,202,1,2120,12846,,nan,38.85,0,6,1,1568220564,1570120316,",
+            "UMTS,202,1,2120,12847,,23.41,91.0,0,6,1,1568220564,1570120316,",
+            # Timestamps out of range.
+            "UMTS,202,1,2120,12848,,23.41,38.85,0,6,1,1568220564,99999999999999,",
+            "UMTS,202,1,2120,12849,,23.41,38.85,0,6,1,-99999999999999,1570120316,",
+            # Invalid lac, cid and mnc.
+            "UMTS,202,1,70000,12850,,23.41,38.85,0,6,1,1568220564,1570120316,",
+            "UMTS,202,1,2120,0,,23.41,38.85,0,6,1,1568220564,1570120316,",
+            "UMTS,202,1000,2120,12851,,23.41,38.85,0,6,1,1568220564,1570120316,",
+            # Negative and capped radius.
+            "UMTS,202,1,2120,12852,,23.41,38.85,-1,6,1,1568220564,1570120316,",
+            "UMTS,202,1,2120,12853,,23.41,38.85,999999,6,1,1568220564,1570120316,",
+        ]
+        rows = list(csv.reader(rows))
+        radio_rows = [
+            (Radio.lte if row[0] == "LTE" else Radio.wcdma, row) for row in rows
+        ]
+        stations, invalid = parse_stations(rows, first=True)
+        assert (stations, invalid) == _parse_rows_slowly(radio_rows, True)
+        assert invalid == 9
+        assert [station["cid"] for station in stations] == [
+            12842,
+            12844,
+            12845,
+            12853,
+        ]
+
+    def test_parse_invalid_first_row(self):
+        rows = ["GSM,208,10,30014,20669,,202.5,46.59,0,78,1,1566307030,1570119413,"]
+        with pytest.raises(InvalidCSV):
+            parse_stations(list(csv.reader(rows)), first=True)
+        with pytest.raises(InvalidCSV):
+            parse_stations([["WCDMA"] + rows[0].split(",")[1:]])
+
+    def test_new_stations(self, session, redis_client, cellarea_queue):
+        self.load(
+            session,
+            redis_client,
+            cellarea_queue,
+            """\
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+GSM,208,10,30014,20669,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
+LTE,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220588,1570120328,
+GSM,208,10,30014,202.5,,2.5112670,46.5992450,0,78,1,1566307030,1570119413,
+""",
+        )
+
+        wcdma = session.query(CellShard.shard_model(Radio.wcdma)).one()
+        assert wcdma.cellid == (Radio.wcdma, 202, 1, 2120, 12842)
+        assert wcdma.lat == 38.8574351
+        assert wcdma.lon == 23.4123167
+        assert wcdma.max_lat == wcdma.min_lat == wcdma.lat
+        assert wcdma.max_lon == wcdma.min_lon == wcdma.lon
+        assert wcdma.samples == 6
+        assert wcdma.created == datetime(2019, 9, 11, 16, 49, 24, tzinfo=UTC)
+        assert wcdma.modified == datetime(2019, 10, 3, 16, 31, 56, tzinfo=UTC)
+        assert wcdma.region == "GR"
+
+        gsm_model = CellShard.shard_model(Radio.gsm)
+        assert session.query(func.count(gsm_model.cellid)).scalar() == 1
+        lte_model = CellShard.shard_model(Radio.lte)
+        assert session.query(func.count(lte_model.cellid)).scalar() == 1
+
+        assert session.query(func.count(CellArea.areaid)).scalar() == 3
+        stats = session.query(RegionStat).order_by("region").all()
+        actual = [(stat.region, stat.gsm, stat.wcdma, stat.lte) for stat in stats]
+        assert actual == [("FR", 1, 0, 0), ("GR", 0, 1, 1)]
+
+    def test_modified_and_outdated(self, session, redis_client, cellarea_queue):
+        stations = []
+        for cid, modified in ((12842, datetime(2019, 1, 1, tzinfo=UTC)), (12843, None)):
+            station = CellShard.create(
+                _raise_invalid=True,
+                radio=Radio.wcdma,
+                mcc=202,
+                mnc=1,
+                lac=2120,
+                cid=cid,
+                lat=38.85,
+                lon=23.41,
+                min_lat=38.7,
+                max_lat=38.9,
+                min_lon=23.4,
+                max_lon=23.5,
+                radius=1,
+                samples=1,
+                created=datetime(2019, 1, 1, tzinfo=UTC),
+                modified=modified or datetime(2019, 10, 7, tzinfo=UTC),
+            )
+            session.add(station)
+            stations.append(station)
+        session.flush()
+
+        self.load(
+            session,
+            redis_client,
+            cellarea_queue,
+            """\
+UMTS,202,1,2120,12842,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+UMTS,202,1,2120,12843,,23.4123167,38.8574351,0,6,1,1568220564,1570120316,
+""",
+        )
+
+        model = CellShard.shard_model(Radio.wcdma)
+        modified, outdated = session.query(model).order_by(model.cid).all()
+        # New position, other details from import
+        assert modified.lat == 38.8574351
+        assert modified.lon == 23.4123167
+        assert modified.radius == 0
+        assert modified.samples == 6
+        assert modified.created == datetime(2019, 9, 11, 16, 49, 24, tzinfo=UTC)
+        assert modified.modified == datetime(2019, 10, 3, 16, 31, 56, tzinfo=UTC)
+        assert modified.max_lat == 38.9
+        assert modified.min_lon == 23.4
+        # The newer existing station is unchanged.
+        assert outdated.lat == 38.85
+        assert outdated.samples == 1
+        assert outdated.modified == datetime(2019, 10, 7, tzinfo=UTC)
+
+        cell_area = session.query(CellArea).one()
+        assert cell_area.areaid == (Radio.wcdma, 202, 1, 2120)
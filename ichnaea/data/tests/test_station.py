@@ -1,15 +1,20 @@
+import base64
 from collections import defaultdict
 from datetime import datetime, timedelta
+import os
 from unittest import mock
 
+import numpy
 import pytest
 from pymysql.err import MySQLError
 from zoneinfo import ZoneInfo
 from sqlalchemy.exc import InterfaceError
 
-from geocalc import destination
-from ichnaea.data.station import CellUpdater
+from geocalc import circle_radius, destination, distance
+from ichnaea.data.public import cell_changes_key
+from ichnaea.data.station import CellUpdater, WifiState, WifiUpdater
 from ichnaea.data.tasks import update_blue, update_cell, update_wifi
+from ichnaea.geocode import GEOCODER
 from ichnaea.models import (
     decode_cellid,
     encode_cellarea,
@@ -18,6 +23,7 @@ from ichnaea.models import (
     Radio,
     ReportSource,
     station_blocked,
+    station_grid,
     StatCounter,
     StatKey,
     WifiShard,
@@ -132,6 +138,139 @@ class TestDatabaseErrors(BaseStationTest):
         metricsmock.assert_incr_once(
             "data.station.dberror", tags=["type:cell", "errno:%s" % errno]
         )
+        metricsmock.assert_incr_once(
+            "data.station.lock.error",
+            tags=["type:cell", "shard:cell_lte", "errno:%s" % errno],
+        )
+
+
+class TestSkipLocked(BaseStationTest):
+    queue_prefix = "update_wifi_"
+    shard_model = WifiShard
+    unique_key = "mac"
+
+    def test_defer_locked(self, celery, redis, session, metricsmock):
+        """Observations for rows locked by another task are queued again."""
+        obs, new_obs = WifiObservationFactory.build_batch(2)
+        locked = WifiShardFactory(mac=obs.mac, samples=10)
+        session.commit()
+        shard = WifiShard.shard_model(obs.mac)
+
+        with mock.patch.dict(os.environ, {"STATION_SKIP_LOCKED": "true"}):
+            # Simulate another task holding the lock on the existing row.
+            with mock.patch.object(WifiUpdater, "query_shard", return_value=[]):
+                self._queue_and_update(celery, [obs, new_obs], update_wifi)
+
+        queue = celery.data_queues[self.queue_prefix + WifiShard.shard_id(obs.mac)]
+        assert [item["mac"] for item in queue.dequeue()] == [obs.mac]
+        stations = {row.mac: row for row in session.query(shard).all()}
+        assert stations[locked.mac].samples == 10
+        assert stations[new_obs.mac].samples == 1
+        self.check_statcounter(redis, StatKey.wifi, 1)
+        metricsmock.assert_incr_once(
+            "data.station.deferred",
+            value=1,
+            tags=["type:wifi", "shard:%s" % shard.__tablename__],
+        )
+
+    def test_lock_order(self, celery, session):
+        """Station rows are locked in primary key order."""
+        observations = WifiObservationFactory.build_batch(3)
+        with mock.patch.object(
+            WifiUpdater, "query_shard", autospec=True, return_value=[]
+        ) as query_shard:
+            self._queue_and_update(celery, observations, update_wifi)
+        assert query_shard.call_count == 1
+        keys = query_shard.call_args[0][3]
+        assert keys == sorted(obs.mac for obs in observations)
+
+
+class TestStationStateBatch:
+    def aggregate(self, grouped_obs):
+        flat_obs = [obs for group in grouped_obs for obs in group]
+        counts = numpy.array([len(group) for group in grouped_obs])
+        return WifiState.aggregate_obs_batch(
+            numpy.array([obs.lat for obs in flat_obs]),
+            numpy.array([obs.lon for obs in flat_obs]),
+            numpy.array([obs.weight for obs in flat_obs]),
+            numpy.cumsum(counts) - counts,
+        )
+
+    def test_empty(self):
+        assert self.aggregate([]) == []
+
+    @staticmethod
+    def aggregate_single(observations):
+        """The former per-station implementation, kept as a reference."""
+        positions = numpy.array(
+            [(obs.lat, obs.lon) for obs in observations], dtype=numpy.double
+        )
+        max_lat, max_lon = positions.max(axis=0)
+        min_lat, min_lon = positions.min(axis=0)
+        if distance(min_lat, min_lon, max_lat, max_lon) > WifiState.MAX_DIST_METERS:
+            return None
+
+        weights = numpy.array([obs.weight for obs in observations], dtype=numpy.double)
+        lat, lon = numpy.average(positions, axis=0, weights=weights)
+        lat = float(lat)
+        lon = float(lon)
+        return {
+            "lat": lat,
+            "lon": lon,
+            "max_lat": float(max_lat),
+            "min_lat": float(min_lat),
+            "max_lon": float(max_lon),
+            "min_lon": float(min_lon),
+            "radius": circle_radius(lat, lon, max_lat, max_lon, min_lat, min_lon),
+            "region": GEOCODER.region(lat, lon),
+            "samples": len(observations),
+            "weight": float(weights.sum()),
+        }
+
+    def test_matches_single_station(self):
+        single = WifiObservationFactory.build()
+        near = WifiObservationFactory.build()
+        near_obs = [near] + [
+            WifiObservationFactory.build(
+                mac=near.mac, lat=near.lat + 0.001 * i, lon=near.lon, accuracy=5.0 * i
+            )
+            for i in (1, 2)
+        ]
+        far = WifiObservationFactory.build()
+        far_obs = [
+            far,
+            WifiObservationFactory.build(mac=far.mac, lat=far.lat + 0.1, lon=far.lon),
+        ]
+        grouped_obs = [[single], near_obs, far_obs]
+
+        result = self.aggregate(grouped_obs)
+        assert len(result) == 3
+        for observations, obs_data in zip(grouped_obs, result):
+            expected = self.aggregate_single(observations)
+            if expected is None:
+                assert obs_data is None
+                continue
+            assert obs_data.keys() == expected.keys()
+            for key, value in expected.items():
+                assert obs_data[key] == pytest.approx(value)
+
+        assert result[0]["lat"] == single.lat
+        assert result[0]["lon"] == single.lon
+        assert result[0]["radius"] == 0
+        assert result[0]["samples"] == 1
+        assert result[0]["weight"] == pytest.approx(single.weight)
+
+        weights = [obs.weight for obs in near_obs]
+        assert result[1]["lat"] == pytest.approx(
+            sum(obs.lat * obs.weight for obs in near_obs) / sum(weights)
+        )
+        assert result[1]["lon"] == pytest.approx(near.lon)
+        assert result[1]["max_lat"] == pytest.approx(near.lat + 0.002)
+        assert result[1]["min_lat"] == near.lat
+        assert result[1]["samples"] == 3
+        assert result[1]["weight"] == pytest.approx(sum(weights))
+        assert result[1]["radius"] > 0
+        assert result[2] is None
 
 
 class StationTest(BaseStationTest):
@@ -222,6 +361,7 @@ class StationTest(BaseStationTest):
         assert station.samples is None
         assert station.source is None
         assert station.weight is None
+        assert station.grid is None
 
     def test_blocklist_skip(self, celery, redis, session):
         observations = self.obs_factory.build_batch(3)
@@ -270,6 +410,7 @@ class StationTest(BaseStationTest):
         assert station.samples == 5
         assert station.source == source
         assert station.weight == pytest.approx(5.0)
+        assert station.grid == station_grid(station.lat, station.lon)
         self.check_blocked(station, None)
         self.check_dates(station, self.today, self.today, self.today)
 
@@ -706,6 +847,30 @@ class TestWifi(StationMacTest):
         assert station.source == source
         assert station.weight == pytest.approx(16.10707)
 
+    def test_dual_write(self, celery, session):
+        station = self.station_factory(mac="111101123456", samples=2)
+        new_mac = "111101abcdef"
+        obs = [
+            self.obs_factory(mac=station.mac, lat=station.lat, lon=station.lon),
+            self.obs_factory(mac=new_mac),
+        ]
+        session.commit()
+
+        next_shard = self.shard_model.shards()["f"]
+        with mock.patch.object(
+            self.shard_model, "next_shard_model", return_value=next_shard
+        ):
+            self.queue_and_update(celery, obs)
+
+        shard = self.shard_model.shards()["0"]
+        rows = {row.mac: row for row in session.query(shard).all()}
+        copies = {row.mac: row for row in session.query(next_shard).all()}
+        assert set(copies) == set(rows) == {station.mac, new_mac}
+        for mac, row in rows.items():
+            assert copies[mac].samples == row.samples
+            assert copies[mac].lat == row.lat
+            assert copies[mac].modified == row.modified
+
     def test_region(self, celery, session):
         obs = []
         station1 = self.station_factory(lat=46.2884, lon=6.77, region="FR")
@@ -760,6 +925,9 @@ class TestCell(StationTest):
     def check_areas(self, celery, obs):
         queue = celery.data_queues["update_cellarea"]
         queued = set(queue.dequeue())
+        delta_queue = celery.data_queues["update_cellarea_delta"]
+        for delta in delta_queue.dequeue():
+            queued.add(base64.b64decode(delta["areaid"]))
         cellids = [decode_cellid(ob.unique_key) for ob in obs]
         areaids = set([encode_cellarea(*cellid[:4]) for cellid in cellids])
         assert queued == areaids
@@ -809,3 +977,49 @@ class TestCell(StationTest):
         assert station.samples == 3
         assert station.source == source
         assert station.weight == pytest.approx(9.2452954)
+
+    def test_change_log(self, celery, redis, session):
+        station = self.station_factory(radio=Radio.gsm, samples=1, weight=2.0)
+        confirmed = self.station_factory(
+            radio=Radio.gsm,
+            source=ReportSource.gnss,
+            last_seen=self.ten_days.date(),
+        )
+        session.commit()
+        new_obs = self.obs_factory(radio=Radio.wcdma)
+        obs = [
+            new_obs,
+            self.obs_factory(
+                lat=station.lat, lon=station.lon + 0.002, **self.key(station)
+            ),
+            self.obs_factory(
+                lat=confirmed.lat,
+                lon=confirmed.lon,
+                source=ReportSource.query,
+                **self.key(confirmed),
+            ),
+        ]
+        self.queue_and_update(celery, obs)
+
+        logged = redis.zrange(cell_changes_key(util.utcnow()), 0, -1)
+        assert set(logged) == {new_obs.unique_key, obs[1].unique_key}
+        assert redis.ttl(cell_changes_key(util.utcnow())) > 0
+
+    def test_area_delta(self, celery, session):
+        station = self.station_factory(radio=Radio.gsm, samples=1, weight=2.0)
+        lat = station.lat
+        lon = station.lon
+        session.commit()
+        obs = self.obs_factory(lat=lat, lon=lon + 0.002, **self.key(station))
+        self.queue_and_update(celery, [obs])
+
+        assert celery.data_queues["update_cellarea"].dequeue() == []
+        deltas = celery.data_queues["update_cellarea_delta"].dequeue()
+        assert len(deltas) == 1
+        assert deltas[0]["areaid"] == encode_cellarea(
+            *decode_cellid(obs.unique_key)[:4], codec="base64"
+        ).decode("ascii")
+        assert deltas[0]["old"]["lat"] == lat
+        assert deltas[0]["old"]["lon"] == lon
+        assert deltas[0]["new"]["max_lon"] == lon + 0.002
+        assert datetime.fromisoformat(deltas[0]["modified"]) <= util.utcnow()
@@ -284,6 +284,19 @@ def database_is_ready():
     return True
 
 
+def is_mysql_lock_error(exception):
+    """Is the exception a retryable MySQL lock error?
+
+    This is true for SQLAlchemy wrapped lock wait timeouts (1205)
+    and deadlocks (1213).
+    """
+    return (
+        isinstance(exception, StatementError)
+        and isinstance(exception.orig, MySQLError)
+        and exception.orig.args[0] in (LOCK_DEADLOCK, LOCK_WAIT_TIMEOUT)
+    )
+
+
 def retry_on_mysql_lock_fail(metric=None, metric_tags=None):
     """Function decorator to backoff and retry on MySQL lock failures.
 
@@ -306,14 +319,6 @@ def retry_on_mysql_lock_fail(metric=None, metric_tags=None):
     :return: A function decorator implementing the retry logic
     """
 
-    def is_mysql_lock_error(exception):
-        """Is the exception a retryable MySQL lock error?"""
-        return (
-            isinstance(exception, StatementError)
-            and isinstance(exception.orig, MySQLError)
-            and exception.orig.args[0] in (LOCK_DEADLOCK, LOCK_WAIT_TIMEOUT)
-        )
-
     def count_exception(exception):
         """Increment the tracking metric for lock errors."""
         tags = ["errno:%s" % exception.orig.args[0]]
@@ -31,7 +31,7 @@ from ichnaea.models.observation import (
     WifiObservation,
     WifiReport,
 )
-from ichnaea.models.station import station_blocked
+from ichnaea.models.station import grid_ranges, station_blocked, station_grid
 from ichnaea.models.wifi import WifiShard
 
 __all__ = (_Model,)
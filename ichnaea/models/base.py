@@ -22,6 +22,34 @@ class BaseModel(object):
 _Model = declarative_base(cls=BaseModel)
 
 
+def create_shard_models(base, shard_ids, table_prefix, doc, namespace):
+    """
+    Create a model class for each shard id, and return a dict of
+    shard id to model classes.
+
+    The classes are named after the base class and the upper-cased
+    shard id, like ``WifiShard0`` or ``DataMapNE``, and are added to
+    the given module namespace.
+
+    :param doc: The class docstring, with a ``%s`` for the shard id.
+    """
+    shards = {}
+    for shard_id in shard_ids:
+        name = base.__name__ + shard_id.upper()
+        model = type(
+            name,
+            (base, _Model),
+            {
+                "__doc__": doc % shard_id,
+                "__module__": namespace["__name__"],
+                "__tablename__": table_prefix + shard_id,
+            },
+        )
+        namespace[name] = model
+        shards[shard_id] = model
+    return shards
+
+
 class HashableDict(object):
     """
     A class representing a unique combination of fields, much like a
@@ -211,9 +211,11 @@ from ichnaea.models.constants import Radio
 from ichnaea.models.sa_types import TinyIntEnum
 from ichnaea.models.schema import DateFromString, DefaultNode, ValidatorNode
 from ichnaea.models.station import (
+    BboxMixin,
     PositionMixin,
     StationMixin,
     TimeTrackingMixin,
+    ValidBboxSchema,
     ValidPositionSchema,
     ValidStationSchema,
     ValidTimeTrackingSchema,
@@ -441,7 +443,10 @@ class ValidCellKeySchema(ValidCellAreaKeySchema):
 
 
 class ValidCellAreaSchema(
-    ValidCellAreaKeySchema, ValidPositionSchema, ValidTimeTrackingSchema
+    ValidCellAreaKeySchema,
+    ValidBboxSchema,
+    ValidPositionSchema,
+    ValidTimeTrackingSchema,
 ):
 
     # areaid is a derived value
@@ -456,7 +461,7 @@ class ValidCellAreaSchema(
     last_seen = colander.SchemaNode(DateFromString(), missing=None)
 
 
-class CellAreaMixin(PositionMixin, TimeTrackingMixin, CreationMixin):
+class CellAreaMixin(BboxMixin, PositionMixin, TimeTrackingMixin, CreationMixin):
 
     _valid_schema = ValidCellAreaSchema()
 
@@ -520,12 +525,15 @@ class CellArea(CellAreaMixin, _Model):
 
 class ValidCellShardSchema(ValidCellKeySchema, ValidStationSchema):
 
-    # adds a range validator
+    # adds range validators
     radius = colander.SchemaNode(
         colander.Integer(),
         missing=None,
         validator=colander.Range(0, constants.CELL_MAX_RADIUS),
     )
+    samples = colander.SchemaNode(
+        colander.Integer(), missing=None, validator=colander.Range(min=0)
+    )
 
 
 class CellShard(StationMixin):
@@ -558,6 +566,7 @@ class CellShard(StationMixin):
             Index("%s_created_idx" % cls.__tablename__, "created"),
             Index("%s_modified_idx" % cls.__tablename__, "modified"),
             Index("%s_latlon_idx" % cls.__tablename__, "lat", "lon"),
+            Index("%s_grid_idx" % cls.__tablename__, "grid"),
         )
         return _indices + (cls._settings,)
 
@@ -635,6 +644,11 @@ class CellShard(StationMixin):
         """Return a dict of shard id to model classes."""
         return cls._shards
 
+    @classmethod
+    def queue_shards(cls):
+        """Return a dict of shard id to model classes for the data queues."""
+        return cls._shards
+
     @classmethod
     def export_header(cls):
         return (
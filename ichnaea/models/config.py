@@ -2,6 +2,9 @@
 This module contains database models for tables storing configuration.
 """
 
+from random import getrandbits
+
+import redis.exceptions
 from sqlalchemy import Column, String
 from sqlalchemy.dialects.mysql import INTEGER as Integer
 
@@ -9,6 +12,18 @@ from ichnaea.models.base import _Model
 from ichnaea.models.sa_types import SetColumn
 from ichnaea.queue import DataQueue
 
+EXPORT_CONFIG_VERSION = "export_config_version"
+"""
+Redis key holding the version of the export config table. Increment
+it to make all processes reload their cached export configs.
+"""
+
+EXPORT_PARTITIONS = "export_partitions_"
+"""Redis set prefix holding the queue keys of each S3 export config."""
+
+EXPORT_PARTITIONS_SCANNED = "export_partitions_scanned_"
+"""Redis key prefix, set for a day after the partitions were scanned."""
+
 
 class ExportConfig(_Model):
     """
@@ -39,6 +54,25 @@ class ExportConfig(_Model):
             session.expunge(row)
         return row
 
+    @classmethod
+    def version(cls, redis_client):
+        """
+        Return the version of the export config table.
+
+        A missing version, for example after Redis lost its data, is
+        set to a random number, so the configs are reloaded.
+        """
+        version = redis_client.get(EXPORT_CONFIG_VERSION)
+        if version is None:
+            redis_client.set(EXPORT_CONFIG_VERSION, getrandbits(62), nx=True)
+            version = redis_client.get(EXPORT_CONFIG_VERSION)
+        return int(version)
+
+    @classmethod
+    def increment_version(cls, redis_client):
+        """Mark all cached export configs as outdated."""
+        return redis_client.incr(EXPORT_CONFIG_VERSION)
+
     def allowed(self, api_key, source):
         skip_keys = self.skip_keys or ()
         skip_sources = self.skip_sources or ()
@@ -46,15 +80,54 @@ class ExportConfig(_Model):
 
     def partitions(self, redis_client):
         if self.schema == "s3":
-            # e.g. ['queue_export_something:api_key']
-            return [
-                key.decode("utf-8")
-                for key in redis_client.scan_iter(
-                    match="queue_export_%s:*" % self.name, count=100
+            # e.g. ['queue_export_something:source:api_key']
+            partitions_key = EXPORT_PARTITIONS + self.name
+            if redis_client.set(
+                EXPORT_PARTITIONS_SCANNED + self.name,
+                1,
+                nx=True,
+                ex=DataQueue.queue_ttl,
+            ):
+                # Once a day, add queues missing from the registry,
+                # for example queues created by an older version.
+                scanned = list(
+                    redis_client.scan_iter(
+                        match="queue_export_%s:*" % self.name, count=100
+                    )
                 )
-            ]
+                if scanned:
+                    redis_client.sadd(partitions_key, *scanned)
+            return sorted(
+                key.decode("utf-8") for key in redis_client.smembers(partitions_key)
+            )
         return ["queue_export_" + self.name]
 
+    def add_partition(self, queue_key, pipe):
+        """Register the queue key as a partition, as part of the pipe."""
+        if self.schema == "s3":
+            pipe.sadd(EXPORT_PARTITIONS + self.name, queue_key)
+
+    def remove_partitions(self, queue_keys, redis_client):
+        """
+        Unregister partitions whose queues don't exist anymore.
+
+        Nothing is removed if any of the queues was created again in
+        the meantime.
+        """
+        if self.schema != "s3" or not queue_keys:
+            return False
+        with redis_client.pipeline() as pipe:
+            try:
+                pipe.watch(*queue_keys)
+                if pipe.exists(*queue_keys):
+                    return False
+                pipe.multi()
+                pipe.srem(EXPORT_PARTITIONS + self.name, *queue_keys)
+                pipe.execute()
+            except redis.exceptions.WatchError:
+                return False
+        return True
+
     def queue_key(self, api_key, source="gnss"):
         if self.schema == "s3":
             if not api_key:
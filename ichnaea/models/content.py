@@ -7,7 +7,7 @@ from sqlalchemy.dialects.mysql import BIGINT as BigInteger, INTEGER as Integer
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.types import TypeDecorator
 
-from ichnaea.models.base import _Model
+from ichnaea.models.base import _Model, create_shard_models
 from ichnaea.models.sa_types import TinyIntEnum
 
 DATAMAP_GRID_SCALE = 1000
@@ -100,7 +100,11 @@ class DataMap(object):
     @declared_attr
     def __table_args__(cls):  # noqa
         _indices = (
-            PrimaryKeyConstraint("grid"),
+            # The modified date is part of the primary key, as the
+            # tables can be partitioned by it. A grid can therefore have
+            # rows for several days, the updater collapses them into one
+            # row and the datamap export groups them by grid.
+            PrimaryKeyConstraint("grid", "modified"),
             Index("%s_created_idx" % cls.__tablename__, "created"),
             Index("%s_modified_idx" % cls.__tablename__, "modified"),
         )
@@ -143,6 +147,12 @@ class DataMap(object):
         global DATAMAP_SHARDS
         return DATAMAP_SHARDS
 
+    @classmethod
+    def queue_shards(cls):
+        """Return a dict of shard id to model classes for the data queues."""
+        global DATAMAP_SHARDS
+        return DATAMAP_SHARDS
+
     @classmethod
     def scale(cls, lat, lon):
         return (
@@ -151,40 +161,11 @@ class DataMap(object):
         )
 
 
-class DataMapNE(DataMap, _Model):
-    """DataMap north-east shard."""
-
-    __tablename__ = "datamap_ne"
-
-
-DATAMAP_SHARDS["ne"] = DataMapNE
-
-
-class DataMapNW(DataMap, _Model):
-    """DataMap north-west shard."""
-
-    __tablename__ = "datamap_nw"
-
-
-DATAMAP_SHARDS["nw"] = DataMapNW
-
-
-class DataMapSE(DataMap, _Model):
-    """DataMap south-east shard."""
-
-    __tablename__ = "datamap_se"
-
-
-DATAMAP_SHARDS["se"] = DataMapSE
-
-
-class DataMapSW(DataMap, _Model):
-    """DataMap south-west shard."""
-
-    __tablename__ = "datamap_sw"
-
-
-DATAMAP_SHARDS["sw"] = DataMapSW
+DATAMAP_SHARDS.update(
+    create_shard_models(
+        DataMap, ("ne", "nw", "se", "sw"), "datamap_", "DataMap %s shard.", globals()
+    )
+)
 
 
 class RegionStat(_Model):
@@ -1,10 +1,12 @@
 from base64 import b16decode, b16encode, b64decode, b64encode
+from itertools import product
 
 import colander
 from sqlalchemy import BINARY, Column, Index, PrimaryKeyConstraint
 from sqlalchemy.ext.declarative import declared_attr
 from sqlalchemy.types import TypeDecorator
 
+from ichnaea.models.base import create_shard_models
 from ichnaea.models.constants import INVALID_MAC_REGEX, VALID_MAC_REGEX
 from ichnaea.models.schema import ValidatorNode
 from ichnaea.models.station import StationMixin, ValidStationSchema
@@ -117,12 +119,64 @@ class ValidMacStationSchema(ValidStationSchema):
     mac = MacNode(colander.String())
 
 
+HEX_DIGITS = "0123456789abcdef"
+
+
+def validate_mac_shards(shard_ids):
+    """
+    Check that the shard ids map every MAC address to exactly one shard.
+
+    Shard ids are prefixes of one or two hex characters, starting at the
+    fifth hex character of the MAC address. A layout can split a single
+    hot shard, like ``3``, into ``30`` through ``3f``.
+    """
+    if not shard_ids:
+        raise ValueError("No shard ids.")
+    for shard_id in shard_ids:
+        if not (0 < len(shard_id) <= 2) or set(shard_id) - set(HEX_DIGITS):
+            raise ValueError("Invalid shard id: %r" % shard_id)
+
+    length = max(len(shard_id) for shard_id in shard_ids)
+    for prefix in product(HEX_DIGITS, repeat=length):
+        prefix = "".join(prefix)
+        matches = [shard_id for shard_id in shard_ids if prefix.startswith(shard_id)]
+        if len(matches) != 1:
+            raise ValueError(
+                "Prefix %s matches %s shards: %r" % (prefix, len(matches), matches)
+            )
+
+
+def create_mac_shards(base, shard_ids, next_shard_ids, table_prefix, doc, namespace):
+    """
+    Create the shard models for the configured shard layout, and the
+    next layout of an in-progress re-sharding, and return a dict of
+    shard id to model classes for the current layout.
+    """
+    validate_mac_shards(shard_ids)
+    if next_shard_ids:
+        validate_mac_shards(next_shard_ids)
+
+    models = create_shard_models(
+        base,
+        sorted(set(shard_ids) | set(next_shard_ids)),
+        table_prefix,
+        doc,
+        namespace,
+    )
+    base._shards = {shard_id: models[shard_id] for shard_id in shard_ids}
+    base._next_shards = {shard_id: models[shard_id] for shard_id in next_shard_ids}
+    base._queue_shards = models
+    return base._shards
+
+
 class MacStationMixin(StationMixin):
     """
     A mixin class for station whose primary key is a mac address.
     """
 
     _shards = None
+    _next_shards = None
+    _queue_shards = None
 
     mac = Column(MacColumn(6))
 
@@ -134,6 +188,7 @@ class MacStationMixin(StationMixin):
             Index("%s_created_idx" % cls.__tablename__, "created"),
             Index("%s_modified_idx" % cls.__tablename__, "modified"),
             Index("%s_latlon_idx" % cls.__tablename__, "lat", "lon"),
+            Index("%s_grid_idx" % cls.__tablename__, "grid"),
         )
         return _indices + (cls._settings,)
 
@@ -150,6 +205,18 @@ class MacStationMixin(StationMixin):
         shard = cls.shard_model(validated["mac"])
         return shard(**validated)
 
+    @staticmethod
+    def _lookup_shard_id(shards, mac):
+        if type(mac) == bytes and len(mac) == 6:
+            # mac is encoded as bytes
+            mac = decode_mac(mac)
+        mac = mac.lower()
+        for length in (2, 1):
+            shard_id = mac[4 : 4 + length]
+            if shard_id in shards:
+                return shard_id
+        return None
+
     @classmethod
     def shard_id(cls, mac):
         """
@@ -157,10 +224,7 @@ class MacStationMixin(StationMixin):
         """
         if not mac:
             return None
-        if type(mac) == bytes and len(mac) == 6:
-            # mac is encoded as bytes
-            mac = decode_mac(mac)
-        return mac.lower()[4]
+        return cls._lookup_shard_id(cls._shards, mac)
 
     @classmethod
     def shard_model(cls, mac):
@@ -181,11 +245,37 @@ class MacStationMixin(StationMixin):
             return None
         return cls._shards.get(cls.shard_id(mac), None)
 
+    @classmethod
+    def next_shard_model(cls, mac):
+        """
+        Given a BSSID/MAC return the DB model class in the next shard
+        layout, or None if no re-sharding is in progress.
+        """
+        if not mac or not cls._next_shards:
+            return None
+        return cls._next_shards.get(cls._lookup_shard_id(cls._next_shards, mac))
+
     @classmethod
     def shards(cls):
         """Return a dict of shard id to model classes."""
         return cls._shards
 
+    @classmethod
+    def next_shards(cls):
+        """
+        Return a dict of shard id to model classes for the next shard
+        layout, empty if no re-sharding is in progress.
+        """
+        return cls._next_shards
+
+    @classmethod
+    def queue_shards(cls):
+        """
+        Return a dict of shard id to model classes for the data queues,
+        including the shards of an in-progress re-sharding.
+        """
+        return cls._queue_shards
+
     @property
     def unique_key(self):
         return self.mac
@@ -1,3 +1,5 @@
+import math
+
 import colander
 from sqlalchemy import Column, Date, String
 from sqlalchemy.dialects.mysql import (
@@ -19,6 +21,48 @@ from ichnaea.models.schema import (
 )
 from ichnaea import util
 
+GRID_SCALE = 10
+"""Number of spatial grid cells per degree."""
+
+GRID_ROWS = 180 * GRID_SCALE + 1
+GRID_COLUMNS = 360 * GRID_SCALE + 1
+
+
+def _grid_position(lat, lon):
+    row = int(math.floor((lat + 90.0) * GRID_SCALE))
+    column = int(math.floor((lon + 180.0) * GRID_SCALE))
+    return (
+        min(max(row, 0), GRID_ROWS - 1),
+        min(max(column, 0), GRID_COLUMNS - 1),
+    )
+
+
+def station_grid(lat, lon):
+    """
+    Return the key of the spatial grid cell containing the position,
+    or None if there is no position.
+
+    Grid cells are numbered row by row from the south-west, so the
+    cells of a bounding box form one range of keys per row.
+    """
+    if lat is None or lon is None:
+        return None
+    row, column = _grid_position(lat, lon)
+    return row * GRID_COLUMNS + column
+
+
+def grid_ranges(max_lat, min_lat, max_lon, min_lon):
+    """
+    Return a list of (first, last) key ranges of the grid cells
+    covering the bounding box, one per row of grid cells.
+    """
+    min_row, min_column = _grid_position(min_lat, min_lon)
+    max_row, max_column = _grid_position(max_lat, max_lon)
+    return [
+        (row * GRID_COLUMNS + min_column, row * GRID_COLUMNS + max_column)
+        for row in range(min_row, max_row + 1)
+    ]
+
 
 class ValidBboxSchema(colander.MappingSchema, ValidatorNode):
     """A schema which validates fields present in a bounding box."""
@@ -120,6 +164,16 @@ class StationMixin(BboxMixin, PositionMixin, TimeTrackingMixin, CreationMixin):
     block_first = Column(Date)
     block_last = Column(Date)
     block_count = Column(TinyInteger(unsigned=True))
+    grid = Column(Integer(unsigned=True))
+
+    @classmethod
+    def validate(cls, entry, _raise_invalid=False, **kw):
+        validated = super(StationMixin, cls).validate(
+            entry, _raise_invalid=_raise_invalid, **kw
+        )
+        if validated is not None:
+            validated["grid"] = station_grid(validated.get("lat"), validated.get("lon"))
+        return validated
 
 
 def station_blocked(obj, today=None):
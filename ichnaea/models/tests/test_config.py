@@ -1,6 +1,10 @@
 import uuid
 
-from ichnaea.models.config import ExportConfig
+from ichnaea.models.config import (
+    EXPORT_CONFIG_VERSION,
+    EXPORT_PARTITIONS,
+    ExportConfig,
+)
 
 
 class TestExportConfig(object):
@@ -97,3 +101,55 @@ class TestExportConfig(object):
         test("one", frozenset(["ab"]))
         test("two", frozenset(["ab", "cd"]))
         test("unicode", frozenset(["ab", non_ascii]))
+
+    def test_version(self, redis):
+        version = ExportConfig.version(redis)
+        assert ExportConfig.version(redis) == version
+        assert ExportConfig.increment_version(redis) == version + 1
+        assert ExportConfig.version(redis) == version + 1
+        redis.delete(EXPORT_CONFIG_VERSION)
+        assert ExportConfig.version(redis) != version + 1
+
+    def test_partitions(self, redis):
+        config = ExportConfig(name="backup", schema="s3", batch=10)
+        assert config.partitions(redis) == []
+
+        with redis.pipeline() as pipe:
+            for queue_key in (
+                "queue_export_backup:gnss:b",
+                "queue_export_backup:gnss:a",
+            ):
+                config.queue(queue_key, redis).enqueue([{}], pipe=pipe)
+                config.add_partition(queue_key, pipe)
+            pipe.execute()
+        assert config.partitions(redis) == [
+            "queue_export_backup:gnss:a",
+            "queue_export_backup:gnss:b",
+        ]
+
+        redis.delete("queue_export_backup:gnss:a")
+        assert not config.remove_partitions(
+            ["queue_export_backup:gnss:a", "queue_export_backup:gnss:b"], redis
+        )
+        assert config.remove_partitions(["queue_export_backup:gnss:a"], redis)
+        assert config.partitions(redis) == ["queue_export_backup:gnss:b"]
+
+    def test_partitions_scan(self, redis):
+        config = ExportConfig(name="backup", schema="s3", batch=10)
+        # Queues created without registering them are found once a day.
+        config.queue("queue_export_backup:gnss:a", redis).enqueue([{}])
+        assert config.partitions(redis) == ["queue_export_backup:gnss:a"]
+        config.queue("queue_export_backup:gnss:b", redis).enqueue([{}])
+        assert config.partitions(redis) == ["queue_export_backup:gnss:a"]
+        assert redis.smembers(EXPORT_PARTITIONS + "backup") == {
+            b"queue_export_backup:gnss:a"
+        }
+
+    def test_partitions_single(self, redis):
+        config = ExportConfig(name="internal", schema="internal", batch=10)
+        with redis.pipeline() as pipe:
+            config.add_partition(config.queue_key("test"), pipe)
+            pipe.execute()
+        assert config.partitions(redis) == ["queue_export_internal"]
+        assert not config.remove_partitions(["queue_export_internal"], redis)
+        assert not redis.exists(EXPORT_PARTITIONS + "internal")
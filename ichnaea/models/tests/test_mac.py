@@ -1,4 +1,12 @@
-from ichnaea.models.mac import channel_frequency, decode_mac, encode_mac
+import pytest
+
+from ichnaea.models.mac import (
+    channel_frequency,
+    decode_mac,
+    encode_mac,
+    MacStationMixin,
+    validate_mac_shards,
+)
 
 
 class TestChannelFrequency(object):
@@ -58,3 +66,33 @@ class TestMacCodec(object):
     def test_min(self):
         assert encode_mac("000000000000") == b"\x00\x00\x00\x00\x00\x00"
         assert encode_mac("000000000000", codec="base64") == b"AAAAAAAA"
+
+
+class TestMacShards(object):
+    def test_validate(self):
+        validate_mac_shards(tuple("0123456789abcdef"))
+        split = tuple("012456789abcdef") + tuple("3" + c for c in "0123456789abcdef")
+        validate_mac_shards(split)
+
+    @pytest.mark.parametrize(
+        "shard_ids",
+        [
+            (),
+            tuple("0123456789abcde"),
+            tuple("0123456789abcdef") + ("30",),
+            tuple("0123456789abcde") + ("f0", "f1"),
+            tuple("0123456789abcdeg"),
+            tuple("0123456789abcde") + ("fff",),
+        ],
+    )
+    def test_validate_invalid(self, shard_ids):
+        with pytest.raises(ValueError):
+            validate_mac_shards(shard_ids)
+
+    def test_lookup(self):
+        shards = dict.fromkeys(tuple("012456789abcdef"))
+        shards.update(dict.fromkeys("3" + c for c in "0123456789abcdef"))
+        lookup = MacStationMixin._lookup_shard_id
+        assert lookup(shards, "0000f0123456") == "f"
+        assert lookup(shards, "00003A123456") == "3a"
+        assert lookup(shards, encode_mac("000030123456")) == "30"
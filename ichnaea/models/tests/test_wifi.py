@@ -4,7 +4,7 @@ import pytest
 from sqlalchemy.exc import SAWarning, SQLAlchemyError
 
 from ichnaea.conftest import GB_LAT, GB_LON
-from ichnaea.models import encode_mac, ReportSource
+from ichnaea.models import encode_mac, grid_ranges, ReportSource, station_grid
 from ichnaea.models.wifi import WifiShard, WifiShard0, WifiShardF
 from ichnaea import util
 
@@ -97,6 +97,22 @@ class TestWifiShard(object):
         assert wifi.block_first == today
         assert wifi.block_last == today
         assert wifi.block_count == 1
+        assert wifi.grid == station_grid(GB_LAT, GB_LON)
+
+    def test_grid(self):
+        assert station_grid(None, GB_LON) is None
+        assert station_grid(-90.0, -180.0) == 0
+        assert station_grid(-90.0, -179.85) == 1
+        assert station_grid(-89.85, -180.0) == 3601
+        assert station_grid(90.0, 180.0) == 1801 * 3601 - 1
+        assert station_grid(91.0, 181.0) == 1801 * 3601 - 1
+
+        ranges = grid_ranges(51.55, 51.45, 0.25, -0.15)
+        assert ranges == [(5093612, 5093616), (5097213, 5097217)]
+        for lat, lon in ((51.45, -0.15), (51.5, 0.1), (51.55, 0.25)):
+            key = station_grid(lat, lon)
+            assert [first <= key <= last for first, last in ranges].count(True) == 1
+        assert station_grid(51.5, 0.3) > ranges[-1][1]
 
     def test_mac_unhex(self, session):
         stmt = 'insert into wifi_shard_0 (mac) values (unhex("111101123456"))'
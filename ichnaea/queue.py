@@ -3,10 +3,17 @@ Functionality related to custom Redis based queues.
 """
 
 import json
+import time
 
 from ichnaea.cache import redis_pipeline
 from ichnaea import util
 
+BATCH_CONTROLLER_BATCH = "batch_controller_batch"
+"""Redis hash of data queue names to batch sizes picked by the controller."""
+
+BATCH_CONTROLLER_STATS = "batch_controller_stats:"
+"""Redis hash prefix for per data queue processing statistics."""
+
 
 class DataQueue(object):
     """
@@ -28,6 +35,7 @@ class DataQueue(object):
         self.batch = batch
         self.compress = compress
         self.json = json
+        self.data_type = data_type
         self.tags = {"queue_type": "data", "data_type": data_type}
 
     def dequeue(self, batch=None):
@@ -92,19 +100,162 @@ class DataQueue(object):
         batch number of items in it, or if the last time it has seen
         new data was more than an hour ago (queue_max_age).
         """
-        if batch is None:
-            batch = self.batch
-
         with self.redis_client.pipeline() as pipe:
             pipe.ttl(self.key)
-            pipe.llen(self.key)
+            self.size(pipe=pipe)
             ttl, size = pipe.execute()
+        return self._ready(ttl, size, batch=batch)
+
+    def _ready(self, ttl, size, batch=None):
+        if batch is None:
+            batch = self.batch
+
         if ttl < 0:
             age = -1
         else:
             age = max(self.queue_ttl - ttl, 0)
         return bool(size > 0 and (size >= batch or age >= self.queue_max_age))
 
-    def size(self):
-        """Return the size of the queue."""
+    def size(self, pipe=None):
+        """
+        Return the size of the queue.
+
+        If a pipe is given, the size is instead added to the results
+        of the pipe.
+        """
+        if pipe is not None:
+            pipe.llen(self.key)
+            return None
         return self.redis_client.llen(self.key)
+
+    def wait(self, timeout):
+        """
+        Block until the queue holds data, and return True, or return
+        False after the timeout in seconds.
+
+        The wait rotates the last item of the queue to its front in
+        one atomic command, so no data is removed or lost.
+        """
+        item = self.redis_client.blmove(
+            self.key, self.key, timeout, src="RIGHT", dest="LEFT"
+        )
+        return item is not None
+
+    def current_batch(self):
+        """
+        Return the batch size picked by the adaptive batch controller,
+        or the configured batch size if the controller isn't running.
+        """
+        value = self.redis_client.hget(BATCH_CONTROLLER_BATCH, self.key)
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return self.batch
+
+    def _record(self, pipe, items, duration, lock_errors):
+        key = BATCH_CONTROLLER_STATS + self.key
+        pipe.hincrby(key, "runs", 1)
+        pipe.hincrby(key, "items", items)
+        pipe.hincrby(key, "duration", int(duration))
+        pipe.hincrby(key, "lock_errors", lock_errors)
+        pipe.expire(key, self.queue_max_age)
+
+    def record_batch(self, items, duration, lock_errors, pipe=None):
+        """
+        Record the outcome of processing one batch of items, as input
+        for the adaptive batch controller.
+
+        :param items: Number of dequeued items.
+        :param duration: Processing time in milliseconds.
+        :param lock_errors: Number of database lock timeouts / deadlocks.
+        """
+        if pipe is not None:
+            self._record(pipe, items, duration, lock_errors)
+        else:
+            with redis_pipeline(self.redis_client) as pipe:
+                self._record(pipe, items, duration, lock_errors)
+
+
+def ready_queues(redis_client, queues):
+    """
+    Check if the queues are ready, in a single Redis round trip.
+
+    Returns a list of the ready queues, and a list of the queues whose
+    Redis key doesn't exist.
+    """
+    if not queues:
+        return [], []
+
+    with redis_client.pipeline(transaction=False) as pipe:
+        for queue in queues:
+            pipe.ttl(queue.key)
+            queue.size(pipe=pipe)
+        results = pipe.execute()
+
+    ready = []
+    missing = []
+    for queue, ttl, size in zip(queues, results[::2], results[1::2]):
+        if queue._ready(ttl, size):
+            ready.append(queue)
+        elif ttl == -2:
+            missing.append(queue)
+    return ready, missing
+
+
+class SetDataQueue(DataQueue):
+    """
+    A Redis based queue which stores binary items in a set, so each
+    distinct item is stored only once until it is dequeued.
+
+    Items are dequeued in no particular order.
+    """
+
+    poll_interval = 0.5  # Seconds between checks while waiting for data.
+
+    def __init__(self, key, redis_client, data_type, batch=0):
+        super().__init__(key, redis_client, data_type, batch=batch, json=False)
+
+    def dequeue(self, batch=None):
+        """
+        Get batch number of items from the queue.
+        """
+        if batch is None:
+            batch = self.batch
+
+        if batch != 0:
+            return self.redis_client.spop(self.key, batch)
+
+        # special case for getting everything
+        with self.redis_client.pipeline() as pipe:
+            pipe.multi()
+            pipe.smembers(self.key)
+            pipe.delete(self.key)
+            return list(pipe.execute()[0])
+
+    def _push(self, pipe, items, batch):
+        for i in range(0, len(items), batch):
+            pipe.sadd(self.key, *items[i : i + batch])
+
+        # expire key after it was created by sadd
+        pipe.expire(self.key, self.queue_ttl)
+
+    def size(self, pipe=None):
+        if pipe is not None:
+            pipe.scard(self.key)
+            return None
+        return self.redis_client.scard(self.key)
+
+    def wait(self, timeout):
+        """
+        Return True once the queue holds data, or False after the
+        timeout in seconds. Redis has no blocking set commands, so the
+        queue size is polled.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.size():
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
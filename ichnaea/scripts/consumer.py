@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+"""
+Process the data queues in a long-running process.
+
+This replaces the scheduled Celery tasks for the incoming, station,
+cell area and datamap data queues. Set DATA_CONSUMER=true for the
+Celery scheduler, so it no longer schedules these tasks.
+"""
+
+import argparse
+import fnmatch
+import logging
+import signal
+import sys
+
+from ichnaea.cache import configure_redis
+from ichnaea.conf import settings
+from ichnaea.data.consumer import DataQueueConsumer, queue_runners
+from ichnaea.log import configure_logging
+from ichnaea.taskapp.config import init_worker, shutdown_worker
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def main(argv, _app=None, _consumer=None):
+    parser = argparse.ArgumentParser(
+        prog=argv[0],
+        description=(
+            "Process the data queues, as soon as they receive new data. "
+            "Runs until interrupted or terminated."
+        ),
+    )
+    parser.add_argument(
+        "--queue",
+        action="append",
+        default=[],
+        help=(
+            "Only process data queues matching this pattern, like update_wifi_*."
+            " Can be repeated."
+        ),
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=1, help="Threads per data queue."
+    )
+    parser.add_argument(
+        "--max-active",
+        type=int,
+        default=10,
+        help="Maximum number of batches processed at the same time.",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        default=5,
+        help="Seconds to block on a data queue, before checking for shutdown.",
+    )
+    args = parser.parse_args(argv[1:])
+
+    configure_logging()
+    if not settings("data_consumer"):
+        LOGGER.warning(
+            "DATA_CONSUMER is not set, the Celery scheduler still runs"
+            " the data queue tasks."
+        )
+
+    if _app is None:
+        # Importing the app creates the Celery app.
+        from ichnaea.taskapp.app import celery_app as _app
+
+    runners = queue_runners()
+    if args.queue:
+        runners = {
+            name: runner
+            for name, runner in runners.items()
+            if any(fnmatch.fnmatchcase(name, pattern) for pattern in args.queue)
+        }
+    if not runners:
+        print("No data queues match %s." % ", ".join(args.queue))
+        return 1
+
+    # Each thread holds one Redis connection while blocking on its queue.
+    threads = len(runners) * args.concurrency
+    redis_client = configure_redis(max_connections=threads + args.max_active + 10)
+    init_worker(_app, _redis_client=redis_client)
+
+    consumer = _consumer or DataQueueConsumer(
+        _app,
+        runners,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+        max_active=args.max_active,
+    )
+
+    def shutdown(signum, frame):
+        LOGGER.info("Received signal %s, stopping the consumer.", signum)
+        consumer.stop()
+
+    signal.signal(signal.SIGINT, shutdown)
+    signal.signal(signal.SIGTERM, shutdown)
+
+    LOGGER.info("Consuming %s data queues with %s threads.", len(runners), threads)
+    consumer.start()
+    consumer.join()
+    shutdown_worker(_app)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -4,58 +4,73 @@ Generate datamap image tiles and upload them to Amazon S3.
 
 The process is:
 
-1. Export data from datamap tables to CSV.
-   The data is exported as pairs of latitude and longitude,
-   converted into 0 to 6 pairs randomly around that point.
-2. Convert the data into quadtree structures.
-   This structure is more efficient for finding the points that
-   apply to a tile.
-3. Merge the per-table quadtrees into a single file
-4. Generate tiles for each zoom level.
+1. Stream the datamap tables, and encode their points into a single
+   sorted array of point keys.
+   Each row is converted into 0 to 6 points randomly around its
+   grid position. The keys interleave the bits of the projected x
+   and y positions, so the points of each tile, at any zoom level,
+   are a contiguous range of the array.
+2. Render tiles for each zoom level.
    More tiles, covering a smaller distance, are created at each
-   higher zoom level.
-5. Update the S3 bucket with the new tiles.
+   higher zoom level. The points of a tile are counted per pixel,
+   and shaded by density. If the output directory has the points
+   and tiles of a previous run, only the tiles containing added or
+   removed points are rendered again.
+3. Update the S3 bucket with the new tiles.
    The MD5 checksum is used to determine if a tile is unchanged.
-   New tiles are uploaded, and orphaned tiles are deleted.
-
-The quadtree and tile generators are from:
-https://github.com/ericfischer/datamaps
-
-The generated tiles are minimized with pngquant:
-https://pngquant.org
+   New tiles are uploaded, and orphaned tiles are deleted. The
+   checksums of the uploaded tiles are kept in a local manifest,
+   and the bucket is only listed if there is no manifest, or it
+   is due for a periodic reconciliation.
 """
 
 import argparse
-import glob
 import hashlib
 import os
 import os.path
 import shutil
-import subprocess
+import sqlite3
+import struct
 import sys
 import uuid
-from collections import defaultdict
+import zlib
+from datetime import datetime, timedelta
 from json import dumps
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from timeit import default_timer
 
 import boto3
 import botocore
+import numpy
 import structlog
 from more_itertools import chunked
 from sqlalchemy import text
 
-from geocalc import random_points
+from geocalc import random_points_array
 from ichnaea import util
 from ichnaea.conf import settings
 from ichnaea.db import configure_db, db_worker_session
 from ichnaea.log import configure_logging, configure_raven
-from ichnaea.models.content import DataMap, decode_datamap_grid
+from ichnaea.models.content import DataMap
 
 
 LOG = structlog.get_logger("ichnaea.scripts.datamap")
 S3_CLIENT = None  # Will be re-initialized in each pool thread
 
+TILE_SIZE = 256  # Pixels per side of a tile
+KEY_BITS = 24  # Bits per axis of the projected point positions in point keys
+MAX_LAT = 85.0511287798  # Latitude limit of the Web Mercator projection
+RENDER_BATCH = 1000  # Tiles rendered per job
+
+# Density shading, the opacity added by each point in a pixel is
+# BRIGHTNESS * RAMP ** (BASE_ZOOM - zoom), followed by a GAMMA curve.
+BASE_ZOOM = 12
+BRIGHTNESS = 0.0379
+RAMP = 0.874
+GAMMA = 0.5
+COLOR = (0x00, 0x88, 0xFF)  # Fully saturated blue
+
 
 class Timer:
     """Context-based timer."""
@@ -81,6 +96,8 @@ def generate(
     upload=True,
     concurrency=2,
     max_zoom=11,
+    full=False,
+    reconcile_days=7,
 ):
     """
     Process datamaps tables into tiles and optionally upload them.
@@ -91,6 +108,10 @@ def generate(
     :param upload: True (default) if tiles should be uploaded to S3
     :param concurrency: The number of simultanous worker processes
     :param max_zoom: The maximum zoom level to generate
+    :param full: True to render all tiles, even if the output directory
+        has the tiles of a previous run
+    :param reconcile_days: How many days to trust the local manifest of
+        uploaded tiles, before listing the S3 bucket again
     :return: Details of the process
     :rtype: dict
     """
@@ -99,64 +120,58 @@ def generate(
     # Setup directories
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
-    csv_dir = os.path.join(output_dir, "csv")
-    quadtree_dir = os.path.join(output_dir, "quadtrees")
-    shapes_dir = os.path.join(output_dir, "shapes")
+    keys_path = os.path.join(output_dir, "points.npy")
+    new_keys_path = os.path.join(output_dir, "points.new.npy")
     tiles_dir = os.path.abspath(os.path.join(output_dir, "tiles"))
+    manifest_path = os.path.join(output_dir, "manifest.sqlite")
 
     if create:
         LOG.debug("Generating tiles from datamap tables...")
 
-        # Export datamap table to CSV files
-        if not os.path.isdir(csv_dir):
-            os.mkdir(csv_dir)
-
-        row_count = None
+        # Export datamap tables into sorted and unique point keys
         with Pool(processes=concurrency) as pool, Timer() as export_timer:
-            row_count, csv_count = export_to_csvs(pool, csv_dir)
+            row_count, point_count = export_points(pool, new_keys_path)
         result["export_duration_s"] = export_timer.duration_s
         result["row_count"] = row_count
-        result["csv_count"] = csv_count
+        result["point_count"] = point_count
         LOG.debug(
             f"Exported {row_count:,} row{_s(row_count)}"
-            f" to {csv_count:,} CSV{_s(csv_count)}"
+            f" to {point_count:,} unique point{_s(point_count)}"
             f" in {export_timer.duration_s:0.1f} seconds"
         )
         if result["row_count"] == 0:
             LOG.debug("No rows to export, so no tiles to generate.")
             return result
 
-        # Convert CSV files to per-table quadtrees
-        if os.path.isdir(quadtree_dir):
-            shutil.rmtree(quadtree_dir)
-        os.mkdir(quadtree_dir)
-
-        with Pool(processes=concurrency) as pool, Timer() as quadtree_timer:
-            quad_result = csv_to_quadtrees(pool, csv_dir, quadtree_dir)
-        csv_converted, intermediate, final = quad_result
-        result["quadtree_duration_s"] = quadtree_timer.duration_s
-        result["csv_converted_count"] = csv_converted
-        result["intermediate_quadtree_count"] = intermediate
-        result["quadtree_count"] = final
-        LOG.debug(
-            f"Processed {csv_converted:,} CSV{_s(csv_converted)}"
-            f" into {intermediate:,} intermediate quadtree{_s(intermediate)}"
-            f" and {final:,} region quadtree{_s(final)}"
-            f" in {quadtree_timer.duration_s:0.1f} seconds"
+        # Compare to the points of the previous run, if its tiles are kept
+        changed = None
+        incremental = (
+            not full and os.path.isfile(keys_path) and os.path.isdir(tiles_dir)
         )
-
-        # Merge quadtrees and make points unique.
-        if os.path.isdir(shapes_dir):
-            shutil.rmtree(shapes_dir)
-
-        with Timer() as merge_timer:
-            merge_quadtrees(quadtree_dir, shapes_dir)
-        result["merge_duration_s"] = merge_timer.duration_s
-        LOG.debug(f"Merged quadtrees in {merge_timer.duration_s:0.1f} seconds")
+        if incremental:
+            changed = changed_points(keys_path, new_keys_path)
+            changed_count = len(changed)
+            LOG.debug(
+                f"Found {changed_count:,} added or removed"
+                f" point{_s(changed_count)} since the previous run"
+            )
+        else:
+            changed_count = point_count
+            # Remove the previous points first, in case this run is halted
+            if os.path.isfile(keys_path):
+                os.remove(keys_path)
+            if os.path.isdir(tiles_dir):
+                shutil.rmtree(tiles_dir)
+        result["incremental"] = incremental
+        result["changed_point_count"] = changed_count
 
         # Render tiles
         with Pool(processes=concurrency) as pool, Timer() as render_timer:
-            tile_count = render_tiles(pool, shapes_dir, tiles_dir, max_zoom)
+            tile_count = render_tiles(
+                pool, new_keys_path, tiles_dir, max_zoom, changed=changed
+            )
+        # Keep the points of the rendered tiles for the next run
+        os.replace(new_keys_path, keys_path)
         result["tile_count"] = tile_count
         result["render_duration_s"] = render_timer.duration_s
         LOG.debug(
@@ -167,22 +182,40 @@ def generate(
     if upload:
         LOG.debug(f"Syncing tiles to S3 bucket {bucket_name}...")
 
-        # Determine the sync plan by comparing S3 to the local tiles
-        # This function times itself
-        plan, unchanged_count = get_sync_plan(bucket_name, tiles_dir)
-
-        # Sync local tiles with S3 bucket
-        # Double concurrency since I/O rather than CPU bound
-        # Max tasks to free accumulated memory from the S3 clients
-        with Pool(
-            processes=concurrency * 2, maxtasksperchild=1000
-        ) as pool, Timer() as sync_timer:
-            sync_counts = sync_tiles(
-                pool, plan, bucket_name, tiles_dir, max_zoom, raven_client
+        manifest = TileManifest(manifest_path, bucket_name)
+        try:
+            # Determine the sync plan by comparing S3 to the local tiles
+            # This function times itself
+            # Double concurrency since I/O rather than CPU bound
+            plan, unchanged_count, listed = get_sync_plan(
+                bucket_name,
+                tiles_dir,
+                manifest=manifest,
+                max_zoom=max_zoom,
+                concurrency=concurrency * 2,
+                reconcile_days=reconcile_days,
             )
 
+            # Sync local tiles with S3 bucket
+            # Max tasks to free accumulated memory from the S3 clients
+            with Pool(
+                processes=concurrency * 2, maxtasksperchild=1000
+            ) as pool, Timer() as sync_timer:
+                sync_counts = sync_tiles(
+                    pool,
+                    plan,
+                    bucket_name,
+                    tiles_dir,
+                    max_zoom,
+                    raven_client,
+                    manifest=manifest,
+                )
+        finally:
+            manifest.close()
+
         result["sync_duration_s"] = sync_timer.duration_s
         result["tiles_unchanged"] = unchanged_count
+        result["bucket_listed"] = listed
         result.update(sync_counts)
         LOG.debug(
             f"Synced tiles to S3 in {sync_timer.duration_s:0.1f} seconds: "
@@ -206,49 +239,45 @@ def _s(count):
         return "s"
 
 
-def export_to_csvs(pool, csv_dir):
+def export_points(pool, keys_path):
     """
-    Export from database tables to CSV.
-
-    For small database tables, there will be one CSV created, such as
-    "map_ne.csv" for the datamap_ne (northeast) table.
-
-    For large database tables, there will be multiple CSVs created,
-    such as "submap_ne_0001.csv".
+    Export the points of all datamap tables into a sorted array of
+    unique point keys, and save it to a numpy file.
 
     :param pool: A multiprocessing pool
-    :csv_dir: The directory to write CSV output files
-    :return: A tuple of counts (rows, CSVs)
+    :param keys_path: The output numpy file
+    :return: A tuple of counts (rows, unique points)
     """
     jobs = []
-    result_rows = 0
-    result_csvs = 0
     for shard_id, shard in sorted(DataMap.shards().items()):
         # sorting the shards prefers the north which contains more
         # data points than the south
-        filename = f"map_{shard_id}.csv"
-        jobs.append(
-            pool.apply_async(export_to_csv, (filename, csv_dir, shard.__tablename__))
-        )
+        jobs.append(pool.apply_async(export_table_keys, (shard.__tablename__,)))
 
     # Run export jobs to completion
+    result_rows = 0
+    parts = []
+
     def on_success(result):
-        nonlocal result_rows, result_csvs
-        rows, csvs = result
+        nonlocal result_rows
+        rows, keys = result
         result_rows += rows
-        result_csvs += csvs
+        parts.append(keys)
 
     def on_progress(tables_complete, table_percent):
-        nonlocal result_rows
         LOG.debug(
             f"  Exported {result_rows:,} row{_s(result_rows)}"
             f" from {tables_complete:,} table{_s(tables_complete)}"
-            f" to {result_csvs:,} CSV file{_s(result_csvs)}"
             f" ({table_percent:0.1%})"
         )
 
     watch_jobs(jobs, on_success=on_success, on_progress=on_progress)
-    return result_rows, result_csvs
+
+    keys = numpy.concatenate(parts) if parts else numpy.zeros(0, dtype=numpy.uint64)
+    # Sort and remove duplicates at the boundaries of tables
+    keys = numpy.unique(keys)
+    numpy.save(keys_path, keys)
+    return result_rows, len(keys)
 
 
 def watch_jobs(
@@ -295,111 +324,211 @@ def watch_jobs(
             jobs_complete += 1
 
 
-def csv_to_quadtrees(pool, csvdir, quadtree_dir):
+def render_tiles(pool, keys_path, tiles_dir, max_zoom, changed=None):
     """
-    Convert CSV to quadtrees.
+    Render the tiles at all zoom levels, and the front-page 2x tile.
 
-    :param pool: A multiprocessing pool
-    :param csvdir: The directory with the input CSV files
-    :param quadtree_dir: The directory with the output quadtree files
-    :return: A tuple of counts (CSVs processed, intermediate quadtrees, final quads)
-
-    If multiple CSVs were generated for a datamap table, then per-CSV intermediate
-    quadtrees will be created in a subfolder, and then merged (allowing duplicates)
-    to a standard quadtree.
+    If changed point keys are given, only the tiles containing them
+    are rendered, and those without any remaining points are removed.
     """
-    jobs = []
-    intermediate_count = 0
-    intermediates = defaultdict(list)
-    final_count = 0
-    for name in os.listdir(csvdir):
-        if name.startswith("map_") and name.endswith(".csv"):
-            final_count += 1
-            jobs.append(pool.apply_async(csv_to_quadtree, (name, csvdir, quadtree_dir)))
-        if name.startswith("submap_") and name.endswith(".csv"):
-            intermediate_count += 1
-            prefix, shard, suffix = name.split("_")
-            basename, suffix = name.split(".")
-            intermediates[shard].append(basename)
-            submap_dir = os.path.join(quadtree_dir, f"submap_{shard}")
-            if not os.path.isdir(submap_dir):
-                os.mkdir(submap_dir)
-            jobs.append(pool.apply_async(csv_to_quadtree, (name, csvdir, submap_dir)))
-
-    # Run conversion jobs to completion
-    def on_progress(converted, percent):
-        if converted == 1:
-            LOG.debug(f"  Converted 1 CSV to a quadtree ({percent:0.1%})")
-        else:
-            LOG.debug(f"  Converted {converted:,} CSVs to quadtrees ({percent:0.1%})")
 
-    watch_jobs(jobs, on_progress=on_progress)
-    csv_count = len(jobs)
+    # Render tiles at all zoom levels
+    tile_count = 0
+    for zoom in range(max_zoom + 1):
+        tile_count += render_tiles_for_zoom(
+            pool, keys_path, tiles_dir, zoom, changed=changed
+        )
 
-    # Queue jobs to merge intermediates
-    merge_jobs = []
-    for shard, basenames in intermediates.items():
-        submap_dir = os.path.join(quadtree_dir, f"submap_{shard}")
-        map_dir = os.path.join(quadtree_dir, f"map_{shard}")
-        merge_jobs.append(
+    # Render front-page tile
+    tile_count += render_tiles_for_zoom(
+        pool,
+        keys_path,
+        tiles_dir,
+        zoom=0,
+        tile_type="high-resolution tile",
+        tile_size=TILE_SIZE * 2,
+        suffix="@2x",  # Suffix for high-res variant images
+        changed=changed,
+    )
+
+    return tile_count
+
+
+def render_tiles_for_zoom(
+    pool,
+    keys_path,
+    tiles_dir,
+    zoom,
+    tile_type="tile",
+    tile_size=TILE_SIZE,
+    suffix="",
+    changed=None,
+):
+    """Render the tiles of a zoom level concurrently, in ranges of tiles."""
+
+    keys = numpy.load(keys_path, mmap_mode="r")
+    dirty = None
+    if changed is not None:
+        dirty = tile_prefixes(changed, zoom)
+    tiles = enumerate_tiles(keys, zoom, only=dirty)
+
+    if dirty is not None:
+        # Remove the changed tiles without any remaining points
+        rendered = set((tile_x, tile_y) for tile_x, tile_y, _, _ in tiles)
+        removed = 0
+        for tile_x, tile_y in tile_positions(dirty):
+            if (tile_x, tile_y) not in rendered:
+                path = os.path.join(
+                    tiles_dir, str(zoom), str(tile_x), f"{tile_y}{suffix}.png"
+                )
+                if os.path.isfile(path):
+                    os.remove(path)
+                    removed += 1
+        if removed:
+            LOG.debug(
+                f"Removed {removed:,} empty {tile_type}{_s(removed)}"
+                f" at zoom level {zoom}"
+            )
+
+    total = len(tiles)
+    LOG.debug(f"Rendering {total:,} {tile_type}{_s(total)} at zoom level {zoom}...")
+
+    jobs = []
+    for batch in chunked(tiles, RENDER_BATCH):
+        jobs.append(
             pool.apply_async(
-                merge_quadtrees,
-                (submap_dir, map_dir),
-                {"remove_duplicates": False, "pattern": "submap*"},
+                render_tile_range,
+                (keys_path, zoom, batch, tiles_dir),
+                {"tile_size": tile_size, "suffix": suffix},
             )
         )
-        final_count += 1
 
-    def on_merge_progress(merged, percent):
-        LOG.debug(
-            f"  Merged intermediate quadtrees to {merged:,}"
-            f" quadtree{_s(merged)} ({percent:0.1%})"
-        )
+    # Watch render jobs to completion
+    rendered = 0
 
-    watch_jobs(merge_jobs, on_progress=on_merge_progress)
-    return (csv_count, intermediate_count, final_count)
+    def on_success(count):
+        nonlocal rendered
+        rendered += count
 
+    def on_progress(jobs_complete, percent):
+        LOG.debug(f"  Rendered {rendered:,} {tile_type}{_s(rendered)} ({percent:.1%})")
 
-def merge_quadtrees(quadtree_dir, shapes_dir, remove_duplicates=True, pattern="map*"):
-    """Merge multiple quadtree files into one, removing duplicates."""
-    quadtree_files = glob.glob(os.path.join(quadtree_dir, pattern))
-    assert quadtree_files
-    cmd = ["merge"]
-    if remove_duplicates:
-        cmd.append("-u")
-    cmd += ["-o", shapes_dir]  # Output to shapes directory
-    cmd += quadtree_files  # input files
-    subprocess.run(cmd, check=True, capture_output=True)
+    watch_jobs(jobs, on_success=on_success, on_progress=on_progress)
+    return rendered
 
 
-def render_tiles(pool, shapes_dir, tiles_dir, max_zoom):
-    """Render the tiles at all zoom levels, and the front-page 2x tile."""
+class TileManifest:
+    """
+    A local record of the tiles in the S3 bucket, as of the last sync.
 
-    # Render tiles at all zoom levels
-    tile_count = render_tiles_for_zoom_levels(pool, shapes_dir, tiles_dir, max_zoom)
+    The manifest is a SQLite database with the size and MD5 checksum of
+    each tile, and the time the bucket was last listed to reconcile it.
+    """
 
-    # Render front-page tile
-    tile_count += render_tiles_for_zoom_levels(
-        pool,
-        shapes_dir,
-        tiles_dir,
-        max_zoom=0,
-        tile_type="high-resolution tile",
-        extra_args=("-T", "512"),  # Tile size 512 instead of default of 256
-        suffix="@2x",  # Suffix for high-res variant images
-    )
+    def __init__(self, path, bucket_name, bucket_prefix="tiles/"):
+        self.bucket = f"{bucket_name}/{bucket_prefix}"
+        self.conn = sqlite3.connect(path)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS tile"
+                " (name TEXT PRIMARY KEY, size INTEGER, md5 TEXT)"
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+            )
 
-    return tile_count
+    def _meta(self, key):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,))
+        row = row.fetchone()
+        return row[0] if row else None
+
+    def needs_reconcile(self, reconcile_days=None):
+        """
+        Return True if the bucket should be listed, because the manifest
+        is for another bucket, or wasn't reconciled in reconcile_days.
+        """
+        if self._meta("bucket") != self.bucket:
+            return True
+        reconciled = self._meta("reconciled")
+        if reconciled is None:
+            return True
+        if reconcile_days is None:
+            return False
+        age = util.utcnow() - datetime.fromisoformat(reconciled)
+        return age >= timedelta(days=reconcile_days)
+
+    def objects(self):
+        """Return a dictionary of tile names to (size, MD5) tuples."""
+        return {
+            name: (size, md5)
+            for name, size, md5 in self.conn.execute("SELECT name, size, md5 FROM tile")
+        }
+
+    def replace(self, objects):
+        """Replace all tiles with the listed bucket objects."""
+        with self.conn:
+            self.conn.execute("DELETE FROM tile")
+            self.conn.executemany(
+                "INSERT INTO tile (name, size, md5) VALUES (?, ?, ?)",
+                ((name, size, md5) for name, (size, md5) in objects.items()),
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (("bucket", self.bucket), ("reconciled", util.utcnow().isoformat())),
+            )
 
+    def update(self, entries):
+        """Add or update tiles from (name, size, MD5) tuples."""
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO tile (name, size, md5) VALUES (?, ?, ?)", entries
+        )
 
-def get_sync_plan(bucket_name, tiles_dir, bucket_prefix="tiles/"):
-    """Compare S3 bucket and tiles directory to determine the sync plan."""
+    def remove(self, names):
+        """Remove tiles by name."""
+        self.conn.executemany(
+            "DELETE FROM tile WHERE name = ?", ((name,) for name in names)
+        )
+
+    def commit(self):
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def get_sync_plan(
+    bucket_name,
+    tiles_dir,
+    bucket_prefix="tiles/",
+    manifest=None,
+    max_zoom=11,
+    concurrency=1,
+    reconcile_days=None,
+):
+    """
+    Compare S3 bucket and tiles directory to determine the sync plan.
+
+    The S3 objects are read from the manifest, unless it needs to be
+    reconciled. Then the bucket is listed, and the manifest replaced.
+
+    :return: A tuple (actions, unchanged count, True if bucket was listed)
+    """
 
     # Get objects currently in the S3 bucket
+    listed = manifest is None or manifest.needs_reconcile(reconcile_days)
     with Timer() as obj_timer:
-        objects = get_current_objects(bucket_name, bucket_prefix)
+        if listed:
+            objects = list_current_objects(
+                bucket_name, bucket_prefix, max_zoom, concurrency
+            )
+            if manifest is not None:
+                manifest.replace(objects)
+        else:
+            objects = manifest.objects()
+    source = "bucket" if listed else "manifest of bucket"
     LOG.debug(
-        f"Found {len(objects):,} existing tiles in bucket {bucket_name},"
+        f"Found {len(objects):,} existing tiles in {source} {bucket_name},"
         f" /{bucket_prefix} in {obj_timer.duration_s:0.1f} seconds"
     )
 
@@ -418,7 +547,7 @@ def get_sync_plan(bucket_name, tiles_dir, bucket_prefix="tiles/"):
         f" tile{_s(unchanged_count)}"
     )
 
-    return actions, unchanged_count
+    return actions, unchanged_count, listed
 
 
 def sync_tiles(
@@ -430,8 +559,13 @@ def sync_tiles(
     raven_client,
     bucket_prefix="tiles/",
     delete_batch_size=100,
+    manifest=None,
 ):
-    """Execute the plan to sync the local tiles to S3 bucket objects."""
+    """
+    Execute the plan to sync the local tiles to S3 bucket objects.
+
+    If a manifest is given, it is updated with the synced tiles.
+    """
 
     result = {
         "tile_new": 0,
@@ -460,8 +594,13 @@ def sync_tiles(
     # Watch sync jobs until completion
     def on_success(job_result):
         nonlocal result
-        tile_result, count = job_result
-        result[tile_result] += count
+        tile_result, entries = job_result
+        result[tile_result] += len(entries)
+        if manifest is not None:
+            if tile_result == "tile_deleted":
+                manifest.remove(entries)
+            else:
+                manifest.update(entries)
 
     def on_error(exception):
         nonlocal result
@@ -474,7 +613,13 @@ def sync_tiles(
         percent = count / total
         LOG.debug(f"  Synced {count:,} file{_s(count)} ({percent:.1%})")
 
-    watch_jobs(jobs, on_progress=on_progress, on_success=on_success, on_error=on_error)
+    try:
+        watch_jobs(
+            jobs, on_progress=on_progress, on_success=on_success, on_error=on_error
+        )
+    finally:
+        if manifest is not None:
+            manifest.commit()
     return result
 
 
@@ -492,229 +637,254 @@ def upload_status_file(bucket_name, runtime_data, bucket_prefix="tiles/"):
     )
 
 
-def export_to_csv(filename, csv_dir, tablename, row_limit=None, file_limit=None):
+def export_table_keys(tablename, batch_size=None):
     """
-    Export a datamap table to a CSV file.
+    Export the points of a datamap table as point keys.
 
-    :param filename: An output file ending in .csv
-    :param csv_dir: The output directory
     :param tablename: The name of the datamap table to export
-    :param row_limit: The number of rows to fetch at a time
-    :param file_limit: The number of output rows before rotating files
-    :return: A tuple (rows exported, files created)
+    :param batch_size: The number of rows to convert at a time
+    :return: A tuple (rows exported, sorted and unique point keys)
 
-    Each database row is turned into 0 to 6 similar CSV rows by
-    random_points(), based on how recently they were recorded.
-
-    If file_limit is not reached, the output file will the filename.
-    If file_limit is reached, the output files will have a serial number and
-    be based on the filename. For example, "map.csv" will become "map_0001.csv",
-    "map_0002.csv", etc.
+    The table is read with a server-side cursor, and each batch of rows
+    is turned into 0 to 6 points per row by random_points_array(),
+    based on how recently they were recorded. A grid with rows for
+    several days is exported once, for its most recent row.
     """
     stmt = text(
         """\
 SELECT
-`grid`, CAST(ROUND(DATEDIFF(CURDATE(), `modified`) / 30) AS UNSIGNED) as `num`
+`grid`, CAST(ROUND(DATEDIFF(CURDATE(), MAX(`modified`)) / 30) AS UNSIGNED) as `num`
 FROM {tablename}
-WHERE `grid` > :grid
-ORDER BY `grid`
-LIMIT :limit
+GROUP BY `grid`
 """.format(
             tablename=tablename
         ).replace(
             "\n", " "
         )
-    )
+    ).execution_options(stream_results=True)
 
     db = configure_db("ro", pool=False)
-    min_grid = b""
-    row_limit = row_limit or 200_000
-    file_limit = file_limit or 10_000_000
+    batch_size = batch_size or 200_000
 
     result_rows = 0
-    file_path = os.path.join(csv_dir, filename)
-    fd = open(file_path, "w")
-    file_count = 1
-    file_rows = 0
-    orig_filename = filename
-    orig_file_path = file_path
-    assert filename.endswith(".csv")
+    parts = []
     try:
         with db_worker_session(db, commit=False) as session:
-            while True:
-                result = session.execute(
-                    stmt.bindparams(limit=row_limit, grid=min_grid)
-                )
-                rows = result.fetchall()
+            result = session.execute(stmt)
+            try:
+                while True:
+                    rows = result.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    result_rows += len(rows)
+                    parts.append(rows_to_keys(rows))
+            finally:
                 result.close()
-                if not rows:
-                    break
-
-                lines = []
-                extend = lines.extend
-                for row in rows:
-                    lat, lon = decode_datamap_grid(row.grid)
-                    extend(random_points(lat, lon, row.num))
-
-                fd.writelines(lines)
-                result_rows += len(lines)
-
-                # Rotate the file when needed
-                file_rows += len(lines)
-                if result_rows >= file_limit:
-                    fd.close()
-                    file_count += 1
-                    file_rows = 0
-                    filename = "sub" + orig_filename.replace(
-                        ".csv", f"_{file_count:04}.csv"
-                    )
-                    file_path = os.path.join(csv_dir, filename)
-                    fd = open(file_path, "w")
-
-                min_grid = rows[-1].grid
     finally:
-        fd.close()
-
-    if not file_rows:
-        os.remove(file_path)
-        file_count -= 1
-
-    if file_count > 1:
-        # Rename first file to serial CSV format
-        filename = "sub" + orig_filename.replace(".csv", "_0001.csv")
-        file_path = os.path.join(csv_dir, filename)
-        os.rename(orig_file_path, file_path)
+        db.close()
 
-    db.close()
-    return result_rows, file_count
+    if not parts:
+        return result_rows, numpy.zeros(0, dtype=numpy.uint64)
+    return result_rows, numpy.unique(numpy.concatenate(parts))
 
 
-def csv_to_quadtree(name, csv_dir, quadtree_dir):
+def rows_to_keys(rows):
+    """Return the point keys for datamap rows with a grid and num."""
+    # Decode the grids like decode_datamap_grid, as pairs of big-endian
+    # unsigned 32 bit integers, for all rows at once
+    grids = numpy.frombuffer(b"".join(row.grid for row in rows), dtype=">u4").reshape(
+        -1, 2
+    )
+    lat = grids[:, 0].astype(numpy.int64) - 90000
+    lon = grids[:, 1].astype(numpy.int64) - 180000
+    num = numpy.fromiter((row.num for row in rows), dtype=numpy.int64, count=len(rows))
+    lats, lons = random_points_array(lat, lon, num)
+    return point_keys(lats, lons)
+
+
+def _spread_bits(values):
+    """Spread the lower 32 bits of each value to the even bits."""
+    values = values & numpy.uint64(0x00000000FFFFFFFF)
+    for shift, mask in (
+        (16, 0x0000FFFF0000FFFF),
+        (8, 0x00FF00FF00FF00FF),
+        (4, 0x0F0F0F0F0F0F0F0F),
+        (2, 0x3333333333333333),
+        (1, 0x5555555555555555),
+    ):
+        values = (values | (values << numpy.uint64(shift))) & numpy.uint64(mask)
+    return values
+
+
+def _compact_bits(values):
+    """Compact the even bits of each value into the lower 32 bits."""
+    values = values & numpy.uint64(0x5555555555555555)
+    for shift, mask in (
+        (1, 0x3333333333333333),
+        (2, 0x0F0F0F0F0F0F0F0F),
+        (4, 0x00FF00FF00FF00FF),
+        (8, 0x0000FFFF0000FFFF),
+        (16, 0x00000000FFFFFFFF),
+    ):
+        values = (values | (values >> numpy.uint64(shift))) & numpy.uint64(mask)
+    return values
+
+
+def point_keys(lat, lon):
     """
-    Convert a CSV file into a quadtree.
+    Return the point keys for arrays of latitudes and longitudes.
 
-    encode is from https://github.com/ericfischer/datamaps
+    The points are projected with Web Mercator, onto a square grid
+    with KEY_BITS bits per axis. The key interleaves the bits of the
+    y and x position, so the points of a tile at any zoom level share
+    a key prefix. Points outside of the projection are dropped.
     """
-    input_path = os.path.join(csv_dir, name)
-    with open(input_path, "rb") as csv_file:
-        csv = csv_file.read()
-
-    output_path = os.path.join(quadtree_dir, name.split(".")[0])
-    cmd = ["encode", "-z13", "-o", output_path]  # Allow a single pixel at zoom level 13
-    subprocess.run(cmd, input=csv, check=True, capture_output=True)
-
-
-def render_tiles_for_zoom_levels(
-    pool,
-    shapes_dir,
-    tiles_dir,
-    max_zoom,
-    tile_type="tile",
-    **render_keywords,
-):
-    """Render tiles concurrently across the zoom level."""
+    lat = numpy.asarray(lat, dtype=numpy.float64)
+    lon = numpy.asarray(lon, dtype=numpy.float64)
+    valid = (numpy.abs(lat) < MAX_LAT) & (lon >= -180.0) & (lon < 180.0)
+    lat = numpy.radians(lat[valid])
+    lon = lon[valid]
+
+    scale = float(1 << KEY_BITS)
+    limit = (1 << KEY_BITS) - 1
+    x = (lon + 180.0) / 360.0 * scale
+    y = (1.0 - numpy.log(numpy.tan(lat) + 1.0 / numpy.cos(lat)) / numpy.pi) / 2.0
+    y = y * scale
+    x = numpy.clip(x, 0, limit).astype(numpy.uint64)
+    y = numpy.clip(y, 0, limit).astype(numpy.uint64)
+    return (_spread_bits(y) << numpy.uint64(1)) | _spread_bits(x)
+
+
+def changed_points(old_keys_path, new_keys_path):
+    """
+    Return the sorted point keys which are only in one of two numpy
+    files of sorted and unique point keys.
+    """
+    return numpy.setxor1d(
+        numpy.load(old_keys_path), numpy.load(new_keys_path), assume_unique=True
+    )
 
-    # Get the tile enumeration parameters
-    tile_params = enumerate_tiles(shapes_dir, max_zoom)
 
-    total = len(tile_params)
-    LOG.debug(f"Rendering {total:,} {tile_type}{_s(tile_type)}...")
+def tile_prefixes(keys, zoom):
+    """
+    Return the sorted and unique key prefixes of the tiles at a zoom
+    level containing the point keys.
+    """
+    return numpy.unique(numpy.asarray(keys) >> numpy.uint64(2 * (KEY_BITS - zoom)))
 
-    # Create the directory structure
-    create_tile_subfolders(tile_params, tiles_dir)
 
-    # Create jobs to concurrently generate the tiles
-    jobs = []
-    keywords = {
-        "tiles_dir": tiles_dir,
-    }
-    keywords.update(render_keywords)
-    for params in tile_params:
-        jobs.append(pool.apply_async(generate_tile, params, keywords))
+def tile_positions(prefixes):
+    """Return a list of (tile x, tile y) tuples for tile key prefixes."""
+    tile_x = _compact_bits(prefixes)
+    tile_y = _compact_bits(prefixes >> numpy.uint64(1))
+    return list(zip(tile_x.tolist(), tile_y.tolist()))
 
-    # Watch render jobs to completion
-    def on_progress(rendered, percent):
-        nonlocal tile_type
-        LOG.debug(f"  Rendered {rendered:,} {tile_type}{_s(tile_type)} ({percent:.1%})")
-
-    watch_jobs(jobs, on_progress=on_progress)
-    return len(jobs)
 
+def enumerate_tiles(keys, zoom, only=None):
+    """
+    Return a list of (tile x, tile y, first, last) tuples for the tiles
+    with points at a zoom level, where the points of the tile are
+    keys[first:last].
 
-def enumerate_tiles(shapes_dir, zoom):
-    """Enumerate the zoom and tile positions combinations in the shapes quadtree."""
-    cmd = [
-        "enumerate",
-        "-z",  # Zoom level...
-        str(zoom),  # from 0 to this level, inclusive
-        shapes_dir,  # the directory with the input quadtree
+    If an array of tile key prefixes is given as only, the other tiles
+    are skipped.
+    """
+    if not len(keys):
+        return []
+    prefixes = numpy.asarray(keys) >> numpy.uint64(2 * (KEY_BITS - zoom))
+    starts = numpy.concatenate(([0], numpy.flatnonzero(numpy.diff(prefixes)) + 1))
+    ends = numpy.append(starts[1:], len(prefixes))
+    found = prefixes[starts]
+    if only is not None:
+        wanted = numpy.isin(found, only, assume_unique=True)
+        starts, ends, found = starts[wanted], ends[wanted], found[wanted]
+    return [
+        (tile_x, tile_y, first, last)
+        for (tile_x, tile_y), first, last in zip(
+            tile_positions(found), starts.tolist(), ends.tolist()
+        )
     ]
-    complete = subprocess.run(cmd, check=True, capture_output=True)
 
-    # Process into a tuple of 4-element tuples (shape_dir, zoom, tile x, tile y)
-    output = []
-    for line in complete.stdout.decode("utf8").splitlines():
-        out = line.split()
-        if out:
-            assert len(out) == 4
-            output.append(tuple(out))
-    return tuple(output)
 
+def tile_alpha(keys, zoom, tile_size=TILE_SIZE):
+    """
+    Return a tile_size by tile_size array of opacities, from 0 to 255,
+    for the point keys of one tile.
+    """
+    pixel_bits = tile_size.bit_length() - 1
+    shift = numpy.uint64(KEY_BITS - zoom - pixel_bits)
+    mask = numpy.uint64(tile_size - 1)
+    keys = numpy.asarray(keys)
+    x = (_compact_bits(keys) >> shift) & mask
+    y = (_compact_bits(keys >> numpy.uint64(1)) >> shift) & mask
+    counts = numpy.bincount(
+        (y * numpy.uint64(tile_size) + x).astype(numpy.intp),
+        minlength=tile_size * tile_size,
+    ).reshape(tile_size, tile_size)
+
+    # Larger tiles have smaller pixels, shade them like a higher zoom level.
+    effective_zoom = zoom + pixel_bits - (TILE_SIZE.bit_length() - 1)
+    brightness = BRIGHTNESS * RAMP ** (BASE_ZOOM - effective_zoom)
+    alpha = 1.0 - numpy.power(1.0 - brightness, counts)
+    alpha = numpy.power(alpha, GAMMA)
+    return numpy.round(alpha * 255).astype(numpy.uint8)
+
+
+def _png_chunk(tag, data):
+    return (
+        struct.pack(">I", len(data))
+        + tag
+        + data
+        + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+    )
 
-def create_tile_subfolders(tile_params, tiles_dir):
-    """Create tile output subfolders if they do not exist."""
-
-    folder_parts = set()
-    for source_dir, zoom, tile_x, tile_y in tile_params:
-        folder_parts.add((zoom, tile_x))
 
-    for zoom, tile_x in folder_parts:
-        folder = os.path.join(tiles_dir, zoom, tile_x)
-        os.makedirs(folder, exist_ok=True)
+def write_png(path, alpha):
+    """
+    Write a tile as a palette PNG, in the single tile color with the
+    given opacities.
+    """
+    height, width = alpha.shape
+    # Each row starts with a filter type byte of 0 (none)
+    raw = numpy.zeros((height, width + 1), dtype=numpy.uint8)
+    raw[:, 1:] = alpha
+    png = b"".join(
+        (
+            b"\x89PNG\r\n\x1a\n",
+            _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 3, 0, 0, 0)),
+            _png_chunk(b"PLTE", bytes(COLOR) * 256),
+            _png_chunk(b"tRNS", bytes(range(256))),
+            _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), 9)),
+            _png_chunk(b"IEND", b""),
+        )
+    )
+    with open(path, "wb") as fd:
+        fd.write(png)
 
 
-def generate_tile(
-    source_dir, zoom, tile_x, tile_y, tiles_dir, extra_args=None, suffix=""
+def render_tile_range(
+    keys_path, zoom, tiles, tiles_dir, tile_size=TILE_SIZE, suffix=""
 ):
-    """Generate a space-optimized tile at a given zoom level and position."""
-    render_cmd = [
-        "render",
-        "-B",  # Set basic display parameters...
-        "12:0.0379:0.874",  # base zoom (default), brightness, ramp (less than defaults)
-        "-c0088FF",  # fully saturated color, blue
-        "-t0",  # Fully transparent with no data
-        "-O",  # Tune for distance between points...
-        "16:1600:1.5",  # Defaults for base, distance, ramp
-        "-G",  # Gamma curve...
-        "0.5",  # Default of square root
-    ]
-    if extra_args:
-        render_cmd.extend(extra_args)
-    render_cmd.extend((source_dir, zoom, tile_x, tile_y))
-
-    pngquant_cmd = [
-        "pngquant",
-        "--speed",
-        "3",  # Default speed
-        "--quality",
-        "65-95",  # JPEG-style quality, no compress if below 65%, aim for 95%
-        "32",  # Output a 32-bit png
-    ]
-
-    # Emulate the shell command render | pngquant > out.png
-    output_path = os.path.join(tiles_dir, zoom, tile_x, f"{tile_y}{suffix}.png")
-    with open(output_path, "wb") as png:
-        render = subprocess.Popen(
-            render_cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
-        )
-        pngquant = subprocess.Popen(
-            pngquant_cmd,
-            stdin=render.stdout,
-            stdout=png,
-            stderr=subprocess.DEVNULL,
+    """
+    Render a range of tiles at a zoom level.
+
+    :param keys_path: The numpy file of sorted point keys
+    :param zoom: The zoom level
+    :param tiles: A list of (tile x, tile y, first, last) tuples
+    :param tiles_dir: The base directory of the tiles
+    :param tile_size: The pixels per side of a tile
+    :param suffix: The suffix of the tile file names
+    :return: The number of rendered tiles
+    """
+    keys = numpy.load(keys_path, mmap_mode="r")
+    for tile_x, tile_y, first, last in tiles:
+        folder = os.path.join(tiles_dir, str(zoom), str(tile_x))
+        os.makedirs(folder, exist_ok=True)
+        write_png(
+            os.path.join(folder, f"{tile_y}{suffix}.png"),
+            tile_alpha(keys[first:last], zoom, tile_size=tile_size),
         )
-        render.stdout.close()
-        pngquant.wait()
+    return len(tiles)
 
 
 def s3_client():
@@ -737,18 +907,57 @@ def reset_s3_client():
     S3_CLIENT = None
 
 
-def get_current_objects(bucket_name, bucket_prefix):
-    """Get names, sizes, and MD5 signatures of objects in the bucket."""
+def listing_prefixes(bucket_prefix, max_zoom):
+    """
+    Return the disjoint key prefixes of the tiles in the bucket, by zoom
+    level and the first digit of the tile x position.
+    """
+    return [
+        f"{bucket_prefix}{zoom}/{digit}"
+        for zoom in range(max_zoom + 1)
+        for digit in range(10)
+    ]
+
+
+def list_current_objects(bucket_name, bucket_prefix, max_zoom, concurrency):
+    """
+    Get names, sizes, and MD5 signatures of the tiles in the bucket,
+    listing the zoom level prefixes concurrently.
+    """
+    objects = {}
+    s3_client()  # Create the shared client before starting the threads
+    with ThreadPool(processes=concurrency) as pool:
+        jobs = [
+            pool.apply_async(
+                get_current_objects, (bucket_name, bucket_prefix, list_prefix)
+            )
+            for list_prefix in listing_prefixes(bucket_prefix, max_zoom)
+        ]
+
+        def on_progress(jobs_complete, percent):
+            LOG.debug(f"  Listed {len(objects):,} tiles ({percent:.1%})")
+
+        watch_jobs(jobs, on_success=objects.update, on_progress=on_progress)
+    return objects
+
+
+def get_current_objects(bucket_name, bucket_prefix, list_prefix=None):
+    """
+    Get names, sizes, and MD5 signatures of objects in the bucket.
+
+    The names are relative to the bucket_prefix. If given, only the
+    objects starting with the list_prefix are listed.
+    """
 
     objects = {}
     more_to_fetch = True
     next_kwargs = {}
     while more_to_fetch:
         response = s3_client().list_objects_v2(
-            Bucket=bucket_name, Prefix=bucket_prefix, **next_kwargs
+            Bucket=bucket_name, Prefix=list_prefix or bucket_prefix, **next_kwargs
         )
-        # Process the objects
-        for metadata in response["Contents"]:
+        # Process the objects, empty results have no contents
+        for metadata in response.get("Contents", []):
             key = metadata["Key"]
             if key.endswith(".png"):
                 name = key[len(bucket_prefix) :]
@@ -804,19 +1013,25 @@ def get_sync_actions(tiles_dir, objects):
 
 
 def upload_file(path, bucket_name, bucket_prefix, tiles_dir):
-    send_file(path, bucket_name, bucket_prefix, tiles_dir)
-    return "tile_new", 1
+    return "tile_new", [send_file(path, bucket_name, bucket_prefix, tiles_dir)]
 
 
 def update_file(path, bucket_name, bucket_prefix, tiles_dir):
-    send_file(path, bucket_name, bucket_prefix, tiles_dir)
-    return "tile_changed", 1
+    return "tile_changed", [send_file(path, bucket_name, bucket_prefix, tiles_dir)]
 
 
 def send_file(path, bucket_name, bucket_prefix, tiles_dir):
-    """Send the local file to the S3 bucket."""
+    """
+    Send the local file to the S3 bucket.
+
+    Returns a (path, size, MD5) tuple for the manifest. Tiles are
+    uploaded in one part, so the MD5 matches the S3 ETag.
+    """
+    filename = os.path.join(tiles_dir, path)
+    with open(filename, "rb") as fd:
+        content = fd.read()
     s3_client().upload_file(
-        Filename=os.path.join(tiles_dir, path),
+        Filename=filename,
         Bucket=bucket_name,
         Key=bucket_prefix + path,
         ExtraArgs={
@@ -824,6 +1039,7 @@ def send_file(path, bucket_name, bucket_prefix, tiles_dir):
             "ContentType": "image/png",
         },
     )
+    return path, len(content), hashlib.md5(content).hexdigest()
 
 
 def delete_files(paths, bucket_name, bucket_prefix):
@@ -835,7 +1051,7 @@ def delete_files(paths, bucket_name, bucket_prefix):
     resp = s3_client().delete_objects(Bucket=bucket_name, Delete=delete_request)
     if resp.get("Errors"):
         raise RuntimeError(f"Error deleting: {resp['Errors']}")
-    return "tile_deleted", len(paths)
+    return "tile_deleted", paths
 
 
 def get_png_entries(top):
@@ -875,6 +1091,24 @@ def get_parser():
     )
     parser.add_argument("--create", action="store_true", help="Create tiles")
     parser.add_argument("--upload", action="store_true", help="Upload tiles to S3")
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help=(
+            "Render all tiles, instead of only the tiles changed since the"
+            " previous run with the same --output directory"
+        ),
+    )
+    parser.add_argument(
+        "--reconcile-days",
+        type=int,
+        default=7,
+        help=(
+            "How many days to trust the manifest of uploaded tiles in the"
+            " --output directory, before listing the S3 bucket again"
+            " (default 7)"
+        ),
+    )
     parser.add_argument(
         "--concurrency",
         type=int,
@@ -950,6 +1184,8 @@ def main(_argv=None, _raven_client=None, _bucket_name=None):
     args = parser.parse_args(_argv)
     create = args.create
     upload = args.upload
+    full = args.full
+    reconcile_days = args.reconcile_days
     concurrency = args.concurrency
     verbose = args.verbose
 
@@ -1030,6 +1266,8 @@ def main(_argv=None, _raven_client=None, _bucket_name=None):
                     create=create,
                     upload=upload,
                     concurrency=concurrency,
+                    full=full,
+                    reconcile_days=reconcile_days,
                 )
             else:
                 with util.selfdestruct_tempdir() as temp_dir:
@@ -1040,6 +1278,8 @@ def main(_argv=None, _raven_client=None, _bucket_name=None):
                         create=create,
                         upload=upload,
                         concurrency=concurrency,
+                        full=full,
+                        reconcile_days=reconcile_days,
                     )
     except KeyboardInterrupt:
         interrupted = True
@@ -1069,6 +1309,7 @@ def main(_argv=None, _raven_client=None, _bucket_name=None):
             script_name="ichnaea.scripts.datamap",
             create=create,
             upload=upload,
+            full=full,
             concurrency=concurrency,
             bucket_name=bucket_name,
             **result,
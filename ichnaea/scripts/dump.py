@@ -2,6 +2,9 @@
 Dump/export our own data to a local file.
 
 Script is installed as `location_dump`.
+
+Data is written either as a gzipped CSV file, or as a Parquet file with
+typed columns.
 """
 
 import argparse
@@ -10,62 +13,235 @@ import os
 import os.path
 import sys
 
+import pyarrow as pa
+import pyarrow.parquet as pq
 from sqlalchemy import text
 
 from ichnaea.db import configure_db, db_worker_session
 from geocalc import bbox
 from ichnaea.log import configure_logging
-from ichnaea.models import BlueShard, CellShard, WifiShard
+from ichnaea.models import BlueShard, CellShard, WifiShard, grid_ranges
 from ichnaea import util
 
 
 LOGGER = logging.getLogger(__name__)
 
 
+def _area_bbox(lat, lon, radius):
+    if lat is None or lon is None or radius is None:
+        return None
+    return tuple(round(value, 5) for value in bbox(lat, lon, radius))
+
+
 def where_area(lat, lon, radius):
     # Construct a where clause based on a bounding box around the given
     # center point.
-    if lat is None or lon is None or radius is None:
+    area = _area_bbox(lat, lon, radius)
+    if area is None:
         return None
-    max_lat, min_lat, max_lon, min_lon = bbox(lat, lon, radius)
+    return "`lat` <= %s and `lat` >= %s and `lon` <= %s and `lon` >= %s" % area
 
-    return "`lat` <= %s and `lat` >= %s and `lon` <= %s and `lon` >= %s" % (
-        round(max_lat, 5),
-        round(min_lat, 5),
-        round(max_lon, 5),
-        round(min_lon, 5),
+
+def grid_area(lat, lon, radius):
+    """
+    Return the key ranges of the spatial grid cells covering the bounding
+    box around the given center point, see
+    :func:`ichnaea.models.station.grid_ranges`.
+    """
+    area = _area_bbox(lat, lon, radius)
+    if area is None:
+        return None
+    return grid_ranges(*area)
+
+
+def table_queries(table_name, where=None, ranges=None):
+    """
+    Return a list of (index, where clause) pairs, which together select
+    the stations of one table.
+
+    With grid ranges, each query is limited to one range of grid keys,
+    and forced to scan it in the grid index.
+    """
+    if not ranges:
+        return [(None, where)]
+    index = "%s_grid_idx" % table_name
+    return [
+        (index, "`grid` BETWEEN %s AND %s AND %s" % (first, last, where))
+        for first, last in ranges
+    ]
+
+
+def _grid_keyset(key):
+    """
+    Return the condition paging through a grid index range by the
+    (grid, key) keyset. The grid index includes the primary key, so the
+    rows are read in index order, without sorting the range for each page.
+    """
+    return (
+        "(`grid` > :export_grid OR (`grid` = :export_grid AND `%s` > :export_key))"
+        % key
     )
 
 
-def dump_model(shard_model, session, fd, where=None):
+def dump_model(shard_model, session, fd, where=None, ranges=None):
     fd.write(shard_model.export_header() + "\n")
     for model in shard_model.shards().values():
-        LOGGER.info("Exporting table: %s", model.__tablename__)
-        stmt = model.export_stmt()
-        if where:
-            stmt = stmt.replace(" WHERE ", " WHERE %s AND " % where)
-        stmt = text(stmt)
-        min_key = ""
-        limit = 25000
-        while True:
-            rows = session.execute(
-                stmt.bindparams(export_key=min_key, limit=limit)
-            ).fetchall()
-            if rows:
-                buf = "\n".join([row.export_value for row in rows])
-                if buf:
-                    buf += "\n"
-                fd.write(buf)
-                min_key = rows[-1].export_key
-            else:
-                break
-
-
-def dump_file(datatype, session, filename, lat=None, lon=None, radius=None):
+        table_name = model.__tablename__
+        key = list(model.__table__.primary_key.columns)[0].name
+        LOGGER.info("Exporting table: %s", table_name)
+        for index, condition in table_queries(table_name, where, ranges):
+            stmt = model.export_stmt()
+            if index:
+                stmt = (
+                    stmt.replace("SELECT ", "SELECT `grid` AS `export_grid`, ", 1)
+                    .replace(
+                        " FROM %s " % table_name,
+                        " FROM %s FORCE INDEX (%s) " % (table_name, index),
+                    )
+                    .replace(" `%s` > :export_key " % key, " %s " % _grid_keyset(key))
+                    .replace(" ORDER BY `%s` " % key, " ORDER BY `grid`, `%s` " % key)
+                )
+            if condition:
+                stmt = stmt.replace(" WHERE ", " WHERE %s AND " % condition)
+            stmt = text(stmt)
+            params = {"export_key": "", "export_grid": -1, "limit": 25000}
+            while True:
+                rows = session.execute(stmt, params).fetchall()
+                if rows:
+                    buf = "\n".join([row.export_value for row in rows])
+                    if buf:
+                        buf += "\n"
+                    fd.write(buf)
+                    params["export_key"] = rows[-1].export_key
+                    if index:
+                        params["export_grid"] = rows[-1].export_grid
+                else:
+                    break
+
+
+# Station columns shared by all station types, and their Parquet types.
+_PARQUET_STATION_COLUMNS = (
+    ("lat", "float64"),
+    ("lon", "float64"),
+    ("max_lat", "float64"),
+    ("min_lat", "float64"),
+    ("max_lon", "float64"),
+    ("min_lon", "float64"),
+    ("radius", "int32"),
+    ("region", "string"),
+    ("samples", "int64"),
+    ("source", "int8"),
+    ("weight", "float64"),
+    ("created", "timestamp"),
+    ("modified", "timestamp"),
+    ("last_seen", "date32"),
+    ("block_first", "date32"),
+    ("block_last", "date32"),
+    ("block_count", "int32"),
+)
+
+# The packed key column and the key parts, per station type.
+_PARQUET_KEY_COLUMNS = {
+    "blue": (("mac", "mac"),),
+    "cell": (
+        ("cellid", "cellid"),
+        ("radio", "int8"),
+        ("mcc", "int16"),
+        ("mnc", "int16"),
+        ("lac", "int32"),
+        ("cid", "int64"),
+        ("psc", "int16"),
+    ),
+    "wifi": (("mac", "mac"),),
+}
+
+
+def parquet_schema(datatype):
+    """Return the pyarrow schema of the Parquet export for a station type."""
+    types = {
+        "mac": pa.binary(6),
+        "cellid": pa.binary(11),
+        "float64": pa.float64(),
+        "int8": pa.int8(),
+        "int16": pa.int16(),
+        "int32": pa.int32(),
+        "int64": pa.int64(),
+        "string": pa.string(),
+        "timestamp": pa.timestamp("s", tz="UTC"),
+        "date32": pa.date32(),
+    }
+    columns = _PARQUET_KEY_COLUMNS[datatype] + _PARQUET_STATION_COLUMNS
+    return pa.schema([(name, types[type_]) for name, type_ in columns])
+
+
+def iter_batches(table_name, session, columns, where=None, limit=25000, index=None):
+    """
+    Yield batches of raw rows from one station table, ordered by the
+    first column, which has to be the primary key. If a grid index is
+    given, the query is forced to use it, and the rows are ordered by
+    their grid first.
+
+    The raw column values are selected, so the MAC address or cell id
+    is kept in its packed binary form, and timestamps are naive UTC.
+    """
+    key = columns[0]
+    names = ", ".join("`%s`" % name for name in columns)
+    condition = "`%s` > :export_key" % key
+    order = "`%s`" % key
+    if index:
+        names += ", `grid`"
+        condition = _grid_keyset(key)
+        order = "`grid`, " + order
+        table_name = "%s FORCE INDEX (%s)" % (table_name, index)
+    if where:
+        condition = "%s AND %s" % (where, condition)
+    stmt = text(
+        "SELECT %s FROM %s WHERE %s ORDER BY %s LIMIT :limit"
+        % (names, table_name, condition, order)
+    )
+    params = {"export_key": b"", "export_grid": -1, "limit": limit}
+    while True:
+        rows = session.execute(stmt, params).fetchall()
+        if not rows:
+            break
+        params["export_key"] = rows[-1][0]
+        if index:
+            params["export_grid"] = rows[-1][-1]
+            rows = [row[:-1] for row in rows]
+        yield rows
+
+
+def dump_model_parquet(shard_model, session, writer, where=None, ranges=None):
+    """Write all stations to the Parquet writer, one row group per batch."""
+    schema = writer.schema
+    for model in shard_model.shards().values():
+        table_name = model.__tablename__
+        LOGGER.info("Exporting table: %s", table_name)
+        for index, condition in table_queries(table_name, where, ranges):
+            for rows in iter_batches(
+                table_name, session, schema.names, where=condition, index=index
+            ):
+                arrays = [
+                    pa.array(values, type=field.type)
+                    for values, field in zip(zip(*rows), schema)
+                ]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+
+
+def dump_file(
+    datatype, session, filename, lat=None, lon=None, radius=None, file_format="csv"
+):
     model = {"blue": BlueShard, "cell": CellShard, "wifi": WifiShard}
     where = where_area(lat, lon, radius)
-    with util.gzip_open(filename, "w") as fd:
-        dump_model(model[datatype], session, fd, where=where)
+    ranges = grid_area(lat, lon, radius)
+    if file_format == "parquet":
+        with pq.ParquetWriter(filename, parquet_schema(datatype)) as writer:
+            dump_model_parquet(
+                model[datatype], session, writer, where=where, ranges=ranges
+            )
+    else:
+        with util.gzip_open(filename, "w") as fd:
+            dump_model(model[datatype], session, fd, where=where, ranges=ranges)
     return 0
 
 
@@ -75,7 +251,13 @@ def main(argv, _db=None, _dump_file=dump_file):
         "--datatype", required=True, help="Type of the data file, blue, cell or wifi"
     )
     parser.add_argument(
-        "--filename", required=True, help="Path to the csv.gz export file."
+        "--filename", required=True, help="Path to the csv.gz or parquet export file."
+    )
+    parser.add_argument(
+        "--format",
+        default="csv",
+        choices=("csv", "parquet"),
+        help="Format of the export file, csv or parquet.",
     )
     parser.add_argument(
         "--lat", default=None, help="The center latitude of the desired area."
@@ -113,7 +295,13 @@ def main(argv, _db=None, _dump_file=dump_file):
     db = configure_db("ro", _db=_db, pool=False)
     with db_worker_session(db, commit=False) as session:
         exit_code = _dump_file(
-            datatype, session, filename, lat=lat, lon=lon, radius=radius
+            datatype,
+            session,
+            filename,
+            lat=lat,
+            lon=lon,
+            radius=radius,
+            file_format=args.format,
         )
     return exit_code
 
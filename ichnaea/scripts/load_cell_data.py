@@ -8,10 +8,14 @@ This has been tested with a differential cell export (~400kB compressed).
 A full cell export (~370,000kB) contains unexpected data that will
 require code changes to handle gracefully, and may require adjusting
 the resources of the development environment.
+
+Use --bulk for full cell exports. It parses the CSV in chunks, optionally
+in several processes, and writes each chunk with one query per cell table.
 """
 
 import argparse
 import logging
+from multiprocessing import Pool
 import os
 import os.path
 import sys
@@ -19,7 +23,7 @@ import sys
 from ichnaea.conf import settings
 from ichnaea.db import db_worker_session
 from ichnaea.log import configure_logging
-from ichnaea.data.public import read_stations_from_csv
+from ichnaea.data.public import load_stations_from_csv, read_stations_from_csv
 from ichnaea.taskapp.config import init_worker
 from ichnaea.util import gzip_open
 
@@ -50,6 +54,17 @@ def main(argv, _db=None):
         ),
     )
     parser.add_argument("filename", help="Path to the csv.gz import file.")
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help="Parse and write the stations in chunks, for full cell exports.",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="How many processes parse the CSV in bulk mode? (default 1)",
+    )
 
     args = parser.parse_args(argv[1:])
 
@@ -70,9 +85,23 @@ def main(argv, _db=None):
 
     with db_worker_session(celery_app.db, commit=False) as session:
         with gzip_open(filename, "r") as file_handle:
-            read_stations_from_csv(
-                session, file_handle, celery_app.redis_client, cellarea_queue
-            )
+            if not args.bulk:
+                read_stations_from_csv(
+                    session, file_handle, celery_app.redis_client, cellarea_queue
+                )
+            elif args.processes > 1:
+                with Pool(processes=args.processes) as pool:
+                    load_stations_from_csv(
+                        session,
+                        file_handle,
+                        celery_app.redis_client,
+                        cellarea_queue,
+                        pool=pool,
+                    )
+            else:
+                load_stations_from_csv(
+                    session, file_handle, celery_app.redis_client, cellarea_queue
+                )
     return 0
 
 
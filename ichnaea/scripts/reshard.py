@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+Copy the Bluetooth or WiFi station rows into the next shard layout.
+
+Re-sharding happens online, in these steps:
+
+1. Run this script with ``--create-tables``, and ``WIFI_SHARDS_NEXT``
+   (or ``BLUE_SHARDS_NEXT``) set to the new layout in its environment.
+   This creates the new shard tables, before anything writes to them.
+2. Set ``WIFI_SHARDS_NEXT`` to the new layout and deploy. Station
+   updates are now also written to the new shards.
+3. Run this script, which copies the existing rows into the new shards,
+   in batches ordered by MAC address.
+4. Swap the values of ``WIFI_SHARDS`` and ``WIFI_SHARDS_NEXT`` and
+   deploy. Reads now use the new shards, while updates are still
+   written to the old shards for processes running the old layout.
+5. Remove ``WIFI_SHARDS_NEXT``, deploy, and drop the old shard tables.
+"""
+
+import argparse
+from collections import defaultdict
+import logging
+import sys
+
+from sqlalchemy import select
+
+from ichnaea.db import configure_db, db_worker_session
+from ichnaea.log import configure_logging
+from ichnaea.models import BlueShard, WifiShard
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def copy_shard(db, shard_model, shard, batch=1000):
+    """
+    Copy the rows of one shard into the next shard layout, and return
+    the number of copied rows.
+
+    Rows are read in batches ordered by MAC address, and each batch is
+    committed on its own. Rows which already exist in the next layout
+    were written by a station update during the copy, and are newer,
+    so they are left alone.
+    """
+    table = shard.__table__
+    copied = 0
+    min_mac = None
+    while True:
+        with db_worker_session(db) as session:
+            query = select([table]).order_by(table.c.mac).limit(batch)
+            if min_mac is not None:
+                query = query.where(table.c.mac > min_mac)
+            rows = session.execute(query).fetchall()
+            if not rows:
+                break
+
+            next_rows = defaultdict(list)
+            for row in rows:
+                next_shard = shard_model.next_shard_model(row.mac)
+                next_rows[next_shard].append(dict(row))
+            for next_shard, values in sorted(
+                next_rows.items(), key=lambda item: item[0].__tablename__
+            ):
+                session.execute(
+                    next_shard.__table__.insert()
+                    .values(values)
+                    .prefix_with("IGNORE", dialect="mysql")
+                )
+
+        copied += len(rows)
+        min_mac = rows[-1].mac
+        LOGGER.info("Copied %s rows from %s", copied, table.name)
+    return copied
+
+
+def create_tables(db, shard_model):
+    """Create the tables of the next shard layout, if they don't exist."""
+    for next_shard in shard_model.next_shards().values():
+        next_shard.__table__.create(db.engine, checkfirst=True)
+
+
+def reshard(db, shard_model, batch=1000):
+    """
+    Copy all rows of the changed shards into the next shard layout.
+    Return the number of copied rows.
+
+    The tables of the next layout are created if needed, but they
+    must exist before station updates start writing to them.
+    """
+    next_shards = shard_model.next_shards()
+    create_tables(db, shard_model)
+
+    copied = 0
+    for shard_id, shard in sorted(shard_model.shards().items()):
+        if shard_id in next_shards:
+            # Unchanged shards keep their table.
+            continue
+        copied += copy_shard(db, shard_model, shard, batch=batch)
+    return copied
+
+
+def main(argv, _db=None):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description="Copy station rows into the next shard layout."
+    )
+    parser.add_argument("datatype", help="Type of the stations, blue or wifi")
+    parser.add_argument(
+        "--batch", type=int, default=1000, help="Number of rows copied per batch."
+    )
+    parser.add_argument(
+        "--create-tables",
+        action="store_true",
+        help="Only create the tables of the next shard layout.",
+    )
+
+    args = parser.parse_args(argv[1:])
+    models = {"blue": BlueShard, "wifi": WifiShard}
+    if args.datatype not in models:
+        print("Unknown data type.")
+        return 1
+
+    shard_model = models[args.datatype]
+    if not shard_model.next_shards():
+        print("No next shard layout, set %s_SHARDS_NEXT." % args.datatype.upper())
+        return 1
+
+    configure_logging()
+
+    db = configure_db("rw", _db=_db, pool=False)
+    if args.create_tables:
+        create_tables(db, shard_model)
+        print("Created the tables of the next shard layout.")
+        return 0
+
+    copied = reshard(db, shard_model, batch=args.batch)
+    print("Copied %s rows into the next shard layout." % copied)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
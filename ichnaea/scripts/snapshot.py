@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+Build a read-optimized snapshot of the station tables for the locate
+path, see :mod:`ichnaea.api.locate.snapshot`.
+
+Run it periodically on each web host, and point ``LOCATE_SNAPSHOT_PATH``
+at the same directory.
+"""
+
+import argparse
+import logging
+import os
+import os.path
+import sys
+
+from ichnaea.api.locate.snapshot import snapshot_tables, write_table
+from ichnaea.db import configure_db, db_worker_session
+from ichnaea.log import configure_logging
+from ichnaea.scripts.dump import iter_batches
+
+
+LOGGER = logging.getLogger(__name__)
+
+
+def build_snapshot(session, path, batch=25000):
+    """
+    Write a snapshot file for each station table into the directory,
+    and return a dict of table names to the number of records.
+    """
+    os.makedirs(path, exist_ok=True)
+    counts = {}
+    for table_name, snapshot_type in sorted(snapshot_tables().items()):
+        batches = iter_batches(
+            table_name,
+            session,
+            snapshot_type.columns,
+            where="`lat` IS NOT NULL AND `lon` IS NOT NULL",
+            limit=batch,
+        )
+        counts[table_name] = write_table(path, table_name, snapshot_type, batches)
+        LOGGER.info("Wrote %s records for %s", counts[table_name], table_name)
+    return counts
+
+
+def main(argv, _db=None):
+    parser = argparse.ArgumentParser(
+        prog=argv[0], description="Build a station snapshot for the locate path."
+    )
+    parser.add_argument("path", help="Directory of the snapshot files.")
+    parser.add_argument(
+        "--batch", type=int, default=25000, help="Number of rows read per batch."
+    )
+
+    args = parser.parse_args(argv[1:])
+    path = os.path.abspath(os.path.expanduser(args.path))
+
+    configure_logging()
+
+    db = configure_db("ro", _db=_db, pool=False)
+    with db_worker_session(db, commit=False) as session:
+        counts = build_snapshot(session, path, batch=args.batch)
+    print("Wrote %s records." % sum(counts.values()))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,7 @@
+from ichnaea.scripts.consumer import main
+
+
+def test_no_matching_queue(celery, capsys):
+    """The consumer exits if no data queue matches."""
+    assert main(["consumer", "--queue", "update_unknown_*"], _app=celery) == 1
+    assert "No data queues match update_unknown_*." in capsys.readouterr().out
@@ -1,21 +1,32 @@
+import hashlib
 import os
 import os.path
 import re
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from unittest.mock import patch, MagicMock, Mock
 
+import numpy
 import pytest
 
 from ichnaea.models.content import DataMap, encode_datamap_grid
 from ichnaea.scripts import datamap
 from ichnaea.scripts.datamap import (
-    csv_to_quadtree,
-    csv_to_quadtrees,
-    export_to_csv,
+    TileManifest,
+    changed_points,
+    enumerate_tiles,
+    export_points,
+    export_table_keys,
     generate,
+    get_sync_plan,
+    listing_prefixes,
     main,
-    merge_quadtrees,
+    point_keys,
     render_tiles,
+    rows_to_keys,
+    sync_tiles,
+    tile_alpha,
+    tile_prefixes,
 )
 from ichnaea import util
 
@@ -39,10 +50,10 @@ def mock_main_fixtures():
 @pytest.fixture
 def mock_db_worker_session():
     """
-    Mock the db_worker_session used in export_to_csv()
+    Mock the db_worker_session used in export_table_keys()
 
     Other tests use the database test fixtures, but they can't be used in
-    export_to_csv when called from export_to_csvs, because the test
+    export_table_keys when called from export_points, because the test
     fixtures can't be pickled. This complicated mock works around that
     limitation by patching db_worker_session directly.
     """
@@ -54,7 +65,7 @@ def mock_db_worker_session():
             self.grid = encode_datamap_grid(*DataMap.scale(lat, lon))
             self.num = 0
 
-    # Test data, by database table
+    # Test data, by database table, in batches of rows
     test_data = {
         "datamap_ne": [],
         "datamap_nw": [],
@@ -65,31 +76,29 @@ def mock_db_worker_session():
         "datamap_sw": [[FakeQueryItem(lat=-10.000, lon=-11.000)]],
     }
 
-    # The expected SQL statement, with binding placeholders
+    # The expected SQL statement
     re_stmt = re.compile(
         r"SELECT `grid`,"
-        r" CAST\(ROUND\(DATEDIFF\(CURDATE\(\), `modified`\) / 30\) AS UNSIGNED\) as `num`"
-        r" FROM (?P<tablename>datamap_[ns][ew])"
-        r" WHERE `grid` > :grid ORDER BY `grid` LIMIT :limit "
+        r" CAST\(ROUND\(DATEDIFF\(CURDATE\(\), MAX\(`modified`\)\) / 30\)"
+        r" AS UNSIGNED\) as `num`"
+        r" FROM (?P<tablename>datamap_[ns][ew]) GROUP BY `grid` $"
     )
 
     def get_test_data(statement):
         """
-        Validate the SQL call and return test data.
+        Validate the SQL call and return a streaming result.
 
-        The tablename is extracted from the SQL statement.
-        On the first call, the test data, if any, is returned.
-        On the second call, an empty list is returned.
+        The tablename is extracted from the SQL statement. Each fetch
+        returns the next batch of test data, then an empty list.
         """
         match = re_stmt.match(statement.text)
         assert match
+        assert statement.get_execution_options()["stream_results"]
         tablename = match.group("tablename")
-        result = Mock(spec_set=("fetchall", "close"))
-        try:
-            data = test_data[tablename].pop(0)
-        except IndexError:
-            data = []  # No more data, end DB read loop
-        result.fetchall.return_value = data
+        result = Mock(spec_set=("fetchmany", "close"))
+        result.fetchmany.side_effect = lambda size: (
+            test_data[tablename].pop(0) if test_data[tablename] else []
+        )
         return result
 
     # db_worker_session() returns a context manager
@@ -99,7 +108,7 @@ def mock_db_worker_session():
     mock_session = Mock(spec_set=["execute"])
     mock_context.__enter__.return_value = mock_session
 
-    # session.execute(SQL_STATEMENT) returns rows of data
+    # session.execute(SQL_STATEMENT) returns a result to fetch rows from
     mock_session.execute.side_effect = get_test_data
 
     with patch("ichnaea.scripts.datamap.db_worker_session") as mock_db_worker_session:
@@ -108,99 +117,103 @@ def mock_db_worker_session():
 
 
 class TestMap(object):
-    def _check_quadtree(self, path):
-        assert os.path.isdir(path)
-        for name in ("1,0", "meta"):
-            assert os.path.isfile(os.path.join(path, name))
-
     def test_files(self, temp_dir, mock_db_worker_session):
-        lines = []
-        rows = 0
-
-        csvdir = os.path.join(temp_dir, "csv")
-        os.mkdir(csvdir)
-        quaddir = os.path.join(temp_dir, "quadtrees")
-        os.mkdir(quaddir)
-        shapes = os.path.join(temp_dir, "shapes")
+        keys_path = os.path.join(temp_dir, "points.npy")
         tiles = os.path.join(temp_dir, "tiles")
 
-        expected = {"ne": (0, 0), "nw": (0, 0), "se": (12, 1), "sw": (6, 1)}
-        for shard_id, shard in DataMap.shards().items():
-            filename = f"map_{shard_id}.csv"
-            filepath = os.path.join(csvdir, filename)
-            row_count, file_count = export_to_csv(filename, csvdir, shard.__tablename__)
-            assert row_count == expected[shard_id][0]
-            assert file_count == expected[shard_id][1]
-
-            if not row_count:
-                assert not os.path.isfile(filepath)
-                continue
-
-            rows += row_count
-            with open(filepath, "r") as fd:
-                written = fd.read()
-            lines.extend([line.split(",") for line in written.split()])
-
-            csv_to_quadtree(filename, csvdir, quaddir)
-
-            quadfolder = os.path.join(quaddir, "map_" + shard_id)
-            assert os.path.isdir(quadfolder)
-            self._check_quadtree(quadfolder)
-
-        assert rows
-        merge_quadtrees(quaddir, shapes)
-        self._check_quadtree(shapes)
-
         with Pool() as pool:
-            render_tiles(pool, shapes, tiles, max_zoom=2)
+            assert export_points(pool, keys_path) == (3, 18)
+            render_tiles(pool, keys_path, tiles, max_zoom=2)
+
+        keys = numpy.load(keys_path)
+        assert (numpy.diff(keys.astype(numpy.float64)) > 0).all()
         assert sorted(os.listdir(tiles)) == ["0", "1", "2"]
         assert sorted(os.listdir(os.path.join(tiles, "0", "0"))) == [
             "0.png",
             "0@2x.png",
         ]
+        with open(os.path.join(tiles, "0", "0", "0.png"), "rb") as fd:
+            assert fd.read(8) == b"\x89PNG\r\n\x1a\n"
 
-        assert rows == 18
-        assert len(lines) == 18
-        lats = [round(float(line[0]), 2) for line in lines]
-        longs = [round(float(line[1]), 2) for line in lines]
-        assert set(lats) == set([-10.0, 0.0, 12.35])
-        assert set(longs) == set([-11.0, 12.35])
+    def test_export_table_keys(self, mock_db_worker_session):
+        expected = {"ne": (0, 0), "nw": (0, 0), "se": (2, 12), "sw": (1, 6)}
+        for shard_id, shard in DataMap.shards().items():
+            row_count, keys = export_table_keys(shard.__tablename__, batch_size=1)
+            assert (row_count, len(keys)) == expected[shard_id]
+            assert keys.dtype == numpy.uint64
+
+    def test_rows_to_keys(self):
+        row = Mock(grid=encode_datamap_grid(*DataMap.scale(51.5, -0.1)), num=0)
+        old_row = Mock(grid=encode_datamap_grid(*DataMap.scale(51.5, -0.1)), num=12)
+        keys = rows_to_keys([row, old_row])
+        assert len(keys) == 6
+        assert [tile[:2] for tile in enumerate_tiles(numpy.unique(keys), 11)] == [
+            (1023, 681)
+        ]
 
-    def test_multiple_csv(self, temp_dir, raven, mock_db_worker_session):
-        """export_to_csv creates multiple CSVs at the file_limit."""
+    def test_enumerate_tiles(self):
+        lat = numpy.array([51.5, 0.0, -33.9, 85.1, 51.5])
+        lon = numpy.array([-0.12, 0.0, 151.2, 0.0, -0.12])
+        keys = numpy.unique(point_keys(lat, lon))
+        # The point outside of the projection is dropped.
+        assert len(keys) == 3
+        assert enumerate_tiles(keys, 0) == [(0, 0, 0, 3)]
+        assert [tile[:2] for tile in enumerate_tiles(keys, 11)] == [
+            (1023, 681),
+            (1024, 1024),
+            (1884, 1229),
+        ]
+        assert enumerate_tiles(keys[:0], 0) == []
 
-        expected = {"ne": (0, 0), "nw": (0, 0), "se": (12, 2), "sw": (6, 1)}
-        csv_dir = os.path.join(temp_dir, "csv")
-        os.mkdir(csv_dir)
+    def test_render_changed(self, temp_dir):
+        old_path = os.path.join(temp_dir, "old.npy")
+        new_path = os.path.join(temp_dir, "new.npy")
+        tiles = os.path.join(temp_dir, "tiles")
+        # London and Sydney stay, New York is replaced by a second Sydney point
+        numpy.save(
+            old_path,
+            numpy.unique(point_keys([51.5, -33.9, 40.0], [-0.1, 151.2, -74.0])),
+        )
+        numpy.save(
+            new_path,
+            numpy.unique(point_keys([51.5, -33.9, -33.8], [-0.1, 151.2, 151.1])),
+        )
 
-        for shard_id, shard in DataMap.shards().items():
-            filename = f"map_{shard_id}.csv"
-            filepath = os.path.join(csv_dir, filename)
-            row_count, file_count = export_to_csv(
-                filename, csv_dir, shard.__tablename__, file_limit=1
-            )
-            assert row_count == expected[shard_id][0]
-            assert file_count == expected[shard_id][1]
-
-            if not row_count:
-                assert not os.path.isfile(filepath)
-            elif file_count == 1:
-                assert os.path.isfile(filepath)
-            else:
-                assert not os.path.isfile(filepath)
-                for num in range(1, file_count + 1):
-                    filename_n = f"submap_{shard_id}_{num:04}.csv"
-                    filepath_n = os.path.join(csv_dir, filename_n)
-                    assert os.path.isfile(filepath_n)
-
-        quad_dir = os.path.join(temp_dir, "quadtrees")
-        os.mkdir(quad_dir)
-        with Pool() as pool:
-            result = csv_to_quadtrees(pool, csv_dir, quad_dir)
-            csv_count, intermediate_quad_count, final_quad_count = result
-            assert csv_count == 3
-            assert intermediate_quad_count == 2
-            assert final_quad_count == 2
+        with Pool(processes=1) as pool:
+            assert render_tiles(pool, old_path, tiles, max_zoom=4) == 12
+            london = os.path.join(tiles, "4", "7", "5.png")
+            os.utime(london, (0, 0))
+            changed = changed_points(old_path, new_path)
+            assert len(changed) == 2
+            assert render_tiles(pool, new_path, tiles, max_zoom=4, changed=changed) == 8
+
+        # The unchanged tile isn't rendered again, New York tiles are removed.
+        assert os.stat(london).st_mtime == 0
+        assert not os.path.exists(os.path.join(tiles, "3", "2", "3.png"))
+        assert not os.path.exists(os.path.join(tiles, "4", "4", "6.png"))
+        assert os.path.isfile(os.path.join(tiles, "4", "14", "9.png"))
+
+    def test_tile_prefixes(self):
+        keys = numpy.unique(point_keys([51.5, 51.6, -33.9], [-0.1, -0.1, 151.2]))
+        assert tile_prefixes(keys, 0).tolist() == [0]
+        assert len(tile_prefixes(keys, 11)) == 3
+        assert [tile[:2] for tile in enumerate_tiles(keys, 11)] == [
+            (1023, 680),
+            (1023, 681),
+            (1884, 1229),
+        ]
+        # Only the tiles with the given prefixes are enumerated
+        only = tile_prefixes(keys[2:], 11)
+        assert enumerate_tiles(keys, 11, only=only) == [(1884, 1229, 2, 3)]
+
+    def test_tile_alpha(self):
+        keys = point_keys(numpy.array([0.0, 0.0, 40.0]), numpy.array([0.0, 0.0, 0.0]))
+        alpha = tile_alpha(keys, 0)
+        assert alpha.shape == (256, 256)
+        assert alpha.dtype == numpy.uint8
+        assert alpha[128, 128] > 0
+        assert (alpha > 0).sum() == 2
+        assert tile_alpha(keys, 0, tile_size=512).shape == (512, 512)
 
     def test_generate(self, temp_dir, raven, mock_db_worker_session):
         """generate() calls the steps for tile generation."""
@@ -214,23 +227,20 @@ class TestMap(object):
             max_zoom=2,
         )
         assert set(result.keys()) == {
-            "csv_count",
-            "csv_converted_count",
+            "changed_point_count",
             "export_duration_s",
-            "intermediate_quadtree_count",
-            "merge_duration_s",
-            "quadtree_count",
-            "quadtree_duration_s",
+            "incremental",
+            "point_count",
             "render_duration_s",
             "row_count",
             "tile_count",
         }
-        assert result["quadtree_count"] == 2
-        assert result["row_count"] == 18
+        assert result["row_count"] == 3
+        assert result["point_count"] == 18
         assert result["tile_count"] == 6
-        assert result["csv_count"] == 2
-        assert result["csv_converted_count"] == 2
-        assert result["intermediate_quadtree_count"] == 0
+        assert not result["incremental"]
+        assert result["changed_point_count"] == 18
+        assert os.path.isfile(os.path.join(temp_dir, "points.npy"))
 
     def test_main(self, raven, temp_dir, mock_main_fixtures):
         """main() calls generate with passed arguments"""
@@ -246,7 +256,13 @@ class TestMap(object):
         assert len(mock_generate.mock_calls) == 1
         args, kw = mock_generate.call_args
         assert args == (temp_dir, "bucket", raven)
-        assert kw == {"concurrency": 1, "create": True, "upload": True}
+        assert kw == {
+            "concurrency": 1,
+            "create": True,
+            "upload": True,
+            "full": False,
+            "reconcile_days": 7,
+        }
 
         mock_check_bucket.assert_called_once_with("bucket")
 
@@ -259,7 +275,30 @@ class TestMap(object):
         assert len(mock_generate.mock_calls) == 1
         args, kw = mock_generate.call_args
         assert args == (temp_dir, "bucket", raven)
-        assert kw == {"concurrency": 1, "create": True, "upload": False}
+        assert kw == {
+            "concurrency": 1,
+            "create": True,
+            "upload": False,
+            "full": False,
+            "reconcile_days": 7,
+        }
+
+        assert not mock_check_bucket.mock_calls
+
+    def test_main_full(self, raven, temp_dir, mock_main_fixtures):
+        """main() can render all tiles again."""
+        mock_generate, mock_check_bucket = mock_main_fixtures
+        argv = ["--create", "--full", "--concurrency=1", f"--output={temp_dir}"]
+        main(argv, _raven_client=raven, _bucket_name="bucket")
+
+        args, kw = mock_generate.call_args
+        assert kw == {
+            "concurrency": 1,
+            "create": True,
+            "upload": False,
+            "full": True,
+            "reconcile_days": 7,
+        }
 
         assert not mock_check_bucket.mock_calls
 
@@ -280,7 +319,13 @@ class TestMap(object):
         assert len(mock_generate.mock_calls) == 1
         args, kw = mock_generate.call_args
         assert args == (temp_dir, "bucket", raven)
-        assert kw == {"concurrency": 1, "create": False, "upload": True}
+        assert kw == {
+            "concurrency": 1,
+            "create": False,
+            "upload": True,
+            "full": False,
+            "reconcile_days": 7,
+        }
 
         mock_check_bucket.assert_called_once_with("bucket")
 
@@ -298,7 +343,13 @@ class TestMap(object):
         assert not os.path.exists(args[0])
         assert args[1:] == ("bucket", raven)
         affinity = len(os.sched_getaffinity(0))
-        assert kw == {"concurrency": affinity, "create": True, "upload": True}
+        assert kw == {
+            "concurrency": affinity,
+            "create": True,
+            "upload": True,
+            "full": False,
+            "reconcile_days": 7,
+        }
 
         mock_check_bucket.assert_called_once_with("bucket")
 
@@ -326,3 +377,117 @@ class TestMap(object):
 
         assert not mock_generate.mock_calls
         assert not mock_check_bucket.mock_calls
+
+
+class TestSync(object):
+    def _tiles(self, temp_dir, names):
+        tiles_dir = os.path.join(temp_dir, "tiles")
+        for name in names:
+            path = os.path.join(tiles_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fd:
+                fd.write(name.encode())
+        return tiles_dir
+
+    def _md5(self, name):
+        return hashlib.md5(name.encode()).hexdigest()
+
+    def test_manifest(self, temp_dir):
+        path = os.path.join(temp_dir, "manifest.sqlite")
+        manifest = TileManifest(path, "bucket")
+        assert manifest.needs_reconcile()
+        manifest.replace({"0/0/0.png": (10, "a"), "1/0/0.png": (20, "b")})
+        assert not manifest.needs_reconcile()
+        assert not manifest.needs_reconcile(reconcile_days=1)
+        assert manifest.needs_reconcile(reconcile_days=0)
+
+        manifest.update([("0/0/0.png", 11, "c"), ("1/1/0.png", 30, "d")])
+        manifest.remove(["1/0/0.png"])
+        manifest.close()
+
+        manifest = TileManifest(path, "bucket")
+        assert manifest.objects() == {"0/0/0.png": (11, "c"), "1/1/0.png": (30, "d")}
+        manifest.close()
+        # A manifest of another bucket isn't used
+        assert TileManifest(path, "other").needs_reconcile()
+
+    def test_listing_prefixes(self):
+        prefixes = listing_prefixes("tiles/", 1)
+        assert len(prefixes) == 20
+        assert prefixes[:2] == ["tiles/0/0", "tiles/0/1"]
+        assert prefixes[-1] == "tiles/1/9"
+
+    def test_sync_plan_listed(self, temp_dir):
+        tiles_dir = self._tiles(temp_dir, ["0/0/0.png", "1/0/0.png", "1/1/1.png"])
+        objects = {
+            "tiles/0/0": [("tiles/0/0/0.png", "0/0/0.png")],
+            "tiles/1/1": [("tiles/1/1/1.png", "old"), ("tiles/1/1/0.png", "gone")],
+        }
+
+        def list_objects_v2(Bucket, Prefix):
+            contents = [
+                {"Key": key, "ETag": f'"{self._md5(body)}"', "Size": len(body)}
+                for key, body in objects.get(Prefix, [])
+            ]
+            response = {"IsTruncated": False}
+            if contents:
+                response["Contents"] = contents
+            return response
+
+        client = Mock(spec_set=["list_objects_v2"])
+        client.list_objects_v2.side_effect = list_objects_v2
+        manifest = TileManifest(os.path.join(temp_dir, "manifest.sqlite"), "bucket")
+        with patch.object(datamap, "s3_client", return_value=client):
+            plan, unchanged, listed = get_sync_plan(
+                "bucket", tiles_dir, manifest=manifest, max_zoom=1, concurrency=2
+            )
+        assert listed
+        assert client.list_objects_v2.call_count == 20
+        assert plan == {
+            "upload": ["1/0/0.png"],
+            "update": ["1/1/1.png"],
+            "delete": ["1/1/0.png"],
+        }
+        assert unchanged == 1
+        assert set(manifest.objects()) == {"0/0/0.png", "1/1/1.png", "1/1/0.png"}
+        manifest.close()
+
+    def test_sync_plan_manifest(self, temp_dir):
+        tiles_dir = self._tiles(temp_dir, ["0/0/0.png", "1/0/0.png"])
+        manifest = TileManifest(os.path.join(temp_dir, "manifest.sqlite"), "bucket")
+        manifest.replace(
+            {
+                "0/0/0.png": (9, self._md5("0/0/0.png")),
+                "1/1/1.png": (9, self._md5("1/1/1.png")),
+            }
+        )
+
+        client = Mock(spec_set=[])
+        with patch.object(datamap, "s3_client", return_value=client):
+            plan, unchanged, listed = get_sync_plan(
+                "bucket", tiles_dir, manifest=manifest, reconcile_days=1
+            )
+        assert not listed
+        assert plan == {"upload": ["1/0/0.png"], "update": [], "delete": ["1/1/1.png"]}
+        assert unchanged == 1
+
+        # The synced tiles are recorded in the manifest
+        client = Mock(spec_set=["upload_file", "delete_objects"])
+        client.delete_objects.return_value = {}
+        with patch.object(datamap, "s3_client", return_value=client), ThreadPool(
+            processes=1
+        ) as pool:
+            result = sync_tiles(
+                pool, plan, "bucket", tiles_dir, 1, None, manifest=manifest
+            )
+        assert result == {
+            "tile_new": 1,
+            "tile_changed": 0,
+            "tile_deleted": 1,
+            "tile_failed": 0,
+        }
+        assert manifest.objects() == {
+            "0/0/0.png": (9, self._md5("0/0/0.png")),
+            "1/0/0.png": (9, self._md5("1/0/0.png")),
+        }
+        manifest.close()
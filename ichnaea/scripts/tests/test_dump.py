@@ -1,12 +1,18 @@
+from datetime import timedelta
 import os.path
 
+import pyarrow.parquet as pq
+
 from ichnaea.conftest import GB_LAT, GB_LON
+from ichnaea.models import station_grid
 from ichnaea.scripts import dump
 from ichnaea.tests.factories import BlueShardFactory, CellShardFactory, WifiShardFactory
 from ichnaea import util
 
 
-def _dump_nothing(datatype, session, filename, lat=None, lon=None, radius=None):
+def _dump_nothing(
+    datatype, session, filename, lat=None, lon=None, radius=None, file_format="csv"
+):
     return 0
 
 
@@ -37,6 +43,23 @@ class TestDump(object):
             "`lon` <= 0.26002 and `lon` >= -0.46002"
         )
 
+    def test_grid_area(self):
+        assert dump.grid_area(GB_LAT, GB_LON, None) is None
+        ranges = dump.grid_area(GB_LAT, GB_LON, 25000)
+        # The box spans 0.45 degrees of latitude, over six rows of grid cells.
+        assert len(ranges) == 6
+        key = station_grid(GB_LAT, GB_LON)
+        assert [first <= key <= last for first, last in ranges].count(True) == 1
+
+    def test_table_queries(self):
+        where = dump.where_area(GB_LAT, GB_LON, 25000)
+        assert dump.table_queries("wifi_shard_0", where) == [(None, where)]
+        queries = dump.table_queries("wifi_shard_0", where, [(1, 2), (5, 6)])
+        assert queries == [
+            ("wifi_shard_0_grid_idx", "`grid` BETWEEN 1 AND 2 AND " + where),
+            ("wifi_shard_0_grid_idx", "`grid` BETWEEN 5 AND 6 AND " + where),
+        ]
+
     def _export(self, session, datatype, expected_keys, restrict=False):
         with util.selfdestruct_tempdir() as temp_dir:
             path = os.path.join(temp_dir, datatype + ".tar.gz")
@@ -79,7 +102,106 @@ class TestDump(object):
         session.flush()
         self._export(session, "cell", self._cell_keys(cells))
 
+    def test_cell_area(self, session):
+        cells = CellShardFactory.create_batch(2)
+        CellShardFactory(lat=46.5743, lon=6.3532, region="FR")
+        session.flush()
+        self._export(session, "cell", self._cell_keys(cells), restrict=True)
+
     def test_wifi(self, session):
         wifis = WifiShardFactory.create_batch(5)
         session.flush()
         self._export(session, "wifi", self._mac_keys(wifis))
+
+    def _export_parquet(self, session, datatype, restrict=False):
+        with util.selfdestruct_tempdir() as temp_dir:
+            path = os.path.join(temp_dir, datatype + ".parquet")
+            if restrict:
+                dump.dump_file(
+                    datatype,
+                    session,
+                    path,
+                    lat=GB_LAT,
+                    lon=GB_LON,
+                    radius=25000,
+                    file_format="parquet",
+                )
+            else:
+                dump.dump_file(datatype, session, path, file_format="parquet")
+            table = pq.read_table(path)
+        assert table.schema == dump.parquet_schema(datatype)
+        return table.to_pylist()
+
+    def test_parquet_blue(self, session):
+        BlueShardFactory(lat=46.5743, lon=6.3532, region="FR")
+        blues = BlueShardFactory.create_batch(2)
+        session.flush()
+        rows = self._export_parquet(session, "blue", restrict=True)
+        assert set(row["mac"] for row in rows) == set(
+            bytes.fromhex(blue.mac) for blue in blues
+        )
+
+    def test_parquet_cell(self, session):
+        cell = CellShardFactory(lat=46.5743, lon=6.3532, region="FR", samples=3)
+        session.flush()
+        rows = self._export_parquet(session, "cell")
+        assert len(rows) == 1
+        row = rows[0]
+        assert (row["radio"], row["mcc"], row["mnc"], row["lac"], row["cid"]) == (
+            int(cell.radio),
+            cell.mcc,
+            cell.mnc,
+            cell.lac,
+            cell.cid,
+        )
+        assert row["lat"] == cell.lat
+        assert row["region"] == "FR"
+        assert row["samples"] == 3
+        assert abs(row["created"] - cell.created) < timedelta(seconds=1)
+
+    def test_parquet_wifi(self, session):
+        wifis = WifiShardFactory.create_batch(5)
+        session.flush()
+        rows = self._export_parquet(session, "wifi")
+        assert len(rows) == 5
+        assert set(row["mac"] for row in rows) == set(
+            bytes.fromhex(wifi.mac) for wifi in wifis
+        )
+
+    def test_iter_batches_grid(self, session):
+        # Spread the networks over several grids, with a few per grid.
+        wifis = []
+        for i in range(4):
+            wifis.extend(
+                WifiShardFactory.create_batch(
+                    3, lat=GB_LAT + i * 0.01, lon=GB_LON - i * 0.01
+                )
+            )
+        session.flush()
+        table_name = wifis[0].__tablename__
+        where = dump.where_area(GB_LAT, GB_LON, 25000)
+        ranges = dump.grid_area(GB_LAT, GB_LON, 25000)
+        keys = []
+        for index, condition in dump.table_queries(table_name, where, ranges):
+            batches = list(
+                dump.iter_batches(
+                    table_name,
+                    session,
+                    ["mac", "lat", "lon"],
+                    where=condition,
+                    limit=2,
+                    index=index,
+                )
+            )
+            assert all(len(batch) <= 2 for batch in batches)
+            range_keys = [
+                (station_grid(lat, lon), mac)
+                for batch in batches
+                for mac, lat, lon in batch
+            ]
+            # Each range is paged in the (grid, mac) order of the index.
+            assert range_keys == sorted(set(range_keys))
+            keys.extend(range_keys)
+        assert sorted(mac for grid, mac in keys) == sorted(
+            bytes.fromhex(wifi.mac) for wifi in wifis
+        )
@@ -0,0 +1,39 @@
+from unittest import mock
+
+from ichnaea.models import WifiShard
+from ichnaea.models.wifi import WifiShard0, WifiShard1
+from ichnaea.scripts import reshard
+from ichnaea.tests.factories import WifiShardFactory
+
+
+class TestReshard(object):
+    def test_no_next_layout(self):
+        assert reshard.main(["reshard", "wifi"]) == 1
+
+    def test_unknown_datatype(self):
+        assert reshard.main(["reshard", "cell"]) == 1
+
+    def test_create_tables(self, clean_db):
+        next_shards = {"1": WifiShard1}
+        with mock.patch.object(WifiShard, "next_shards", return_value=next_shards):
+            with mock.patch.object(reshard, "copy_shard") as copy_shard:
+                args = ["reshard", "wifi", "--create-tables"]
+                assert reshard.main(args, _db=clean_db) == 0
+        assert not copy_shard.called
+
+    def test_copy_shard(self, clean_db, session):
+        wifis = [WifiShardFactory(mac="1111%02x123456" % i) for i in range(5)]
+        existing = WifiShard1(mac=wifis[0].mac, lat=1.0, lon=1.0, samples=99)
+        session.add(existing)
+        session.commit()
+        assert session.query(WifiShard0).count() == 5
+
+        with mock.patch.object(WifiShard, "next_shard_model", return_value=WifiShard1):
+            copied = reshard.copy_shard(clean_db, WifiShard, WifiShard0, batch=2)
+        assert copied == 5
+
+        session.expire_all()
+        rows = {row.mac: row for row in session.query(WifiShard1).all()}
+        assert set(rows) == set(wifi.mac for wifi in wifis)
+        # Rows written during the copy are left alone.
+        assert rows[wifis[0].mac].samples == 99
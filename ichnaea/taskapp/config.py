@@ -9,7 +9,7 @@ from ichnaea.db import configure_db
 from ichnaea.geoip import configure_geoip
 from ichnaea.log import configure_raven, configure_stats
 from ichnaea.models import BlueShard, CellShard, DataMap, WifiShard
-from ichnaea.queue import DataQueue
+from ichnaea.queue import DataQueue, SetDataQueue
 
 TASK_QUEUES = (
     Queue("celery_blue", routing_key="celery_blue"),
@@ -49,18 +49,18 @@ def configure_data(redis_client):
         data_queues[key] = DataQueue(
             key, redis_client, "cellarea", batch=100, json=False
         )
-    for shard_id in BlueShard.shards().keys():
+    for key in ("update_cellarea_delta",):
+        data_queues[key] = DataQueue(key, redis_client, "cellarea", batch=500)
+    for shard_id in BlueShard.queue_shards().keys():
         key = "update_blue_" + shard_id
         data_queues[key] = DataQueue(key, redis_client, "bluetooth", batch=500)
     for shard_id in DataMap.shards().keys():
         key = "update_datamap_" + shard_id
-        data_queues[key] = DataQueue(
-            key, redis_client, "datamap", batch=500, json=False
-        )
+        data_queues[key] = SetDataQueue(key, redis_client, "datamap", batch=500)
     for shard_id in CellShard.shards().keys():
         key = "update_cell_" + shard_id
         data_queues[key] = DataQueue(key, redis_client, "cell", batch=500)
-    for shard_id in WifiShard.shards().keys():
+    for shard_id in WifiShard.queue_shards().keys():
         key = "update_wifi_" + shard_id
         data_queues[key] = DataQueue(key, redis_client, "wifi", batch=500)
     return data_queues
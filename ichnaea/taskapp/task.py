@@ -2,9 +2,13 @@
 Contains a Celery base task.
 """
 
+from contextlib import contextmanager
+import threading
+
 from celery import Task
 from kombu.serialization import dumps as kombu_dumps, loads as kombu_loads
 import markus
+from redis.exceptions import LockError
 
 from ichnaea.cache import redis_pipeline
 from ichnaea.conf import settings
@@ -22,6 +26,13 @@ class BaseTask(Task):
     _schedule = None
     _shard_model = None
 
+    # Tasks with a shard model hold a per-shard lease while running, so
+    # only one task runs for each shard at a time. Duplicate tasks exit
+    # and, if _lease_chain is set, ask the running task to start another
+    # run once it is done.
+    _lease_chain = True
+    _lease_timeout = 60
+
     _auto_retry = True
     _shortname = None
 
@@ -51,7 +62,7 @@ class BaseTask(Task):
             return {cls.shortname(): {"task": cls.name, "schedule": cls._schedule}}
 
         result = {}
-        for shard_id in cls._shard_model.shards().keys():
+        for shard_id in cls._shard_model.queue_shards().keys():
             result[cls.shortname() + "_" + shard_id] = {
                 "task": cls.name,
                 "schedule": cls._schedule,
@@ -76,7 +87,10 @@ class BaseTask(Task):
         """
         with METRICS.timer("task", tags=["task:" + self.shortname()]):
             try:
-                result = super(BaseTask, self).__call__(*args, **kw)
+                if self._shard_model is not None and self._lease_timeout:
+                    result = self._call_with_lease(*args, **kw)
+                else:
+                    result = super(BaseTask, self).__call__(*args, **kw)
             except Exception as exc:
                 self.raven_client.captureException()
                 if self._auto_retry and not settings("testing"):
@@ -84,6 +98,76 @@ class BaseTask(Task):
                 raise
         return result
 
+    def lease_key(self, shard_id):
+        return "lease:%s:%s" % (self.shortname(), shard_id)
+
+    def _call_with_lease(self, *args, **kw):
+        shard_id = kw.get("shard_id", args[0] if args else None)
+        rerun_key = self.lease_key(shard_id) + ":rerun"
+
+        ran = False
+        try:
+            with self.shard_lease(shard_id) as acquired:
+                if not acquired:
+                    METRICS.incr(
+                        "task.duplicate",
+                        tags=["task:" + self.shortname(), "shard:%s" % shard_id],
+                    )
+                    if self._lease_chain:
+                        self.redis_client.set(rerun_key, 1, ex=self._lease_timeout)
+                    return None
+                ran = True
+                return super(BaseTask, self).__call__(*args, **kw)
+        finally:
+            # Release the lease first, a duplicate arriving in between
+            # runs itself and at worst causes one extra run.
+            if ran and self._lease_chain and self.redis_client.delete(rerun_key):
+                self.apply_countdown(kwargs={"shard_id": shard_id})
+
+    @contextmanager
+    def shard_lease(self, shard_id):
+        """
+        Hold the per-shard lease of the task while the block runs.
+
+        Yields True if the lease was acquired, or False without waiting
+        if another run of the shard holds it.
+        """
+        lease = self.redis_client.lock(
+            self.lease_key(shard_id),
+            timeout=self._lease_timeout,
+            blocking=False,
+            thread_local=False,
+        )
+        if not lease.acquire():
+            yield False
+            return
+
+        stopped = threading.Event()
+        extender = threading.Thread(
+            target=self._extend_lease, args=(lease, stopped), daemon=True
+        )
+        extender.start()
+        try:
+            yield True
+        finally:
+            stopped.set()
+            extender.join()
+            try:
+                lease.release()
+            except LockError:
+                # The lease expired, another task might hold it now.
+                pass
+
+    def _extend_lease(self, lease, stopped):
+        # Reset the lease timeout a couple of times per period, for as
+        # long as the task is running.
+        while not stopped.wait(self._lease_timeout / 3.0):
+            try:
+                lease.reacquire()
+            except LockError:
+                METRICS.incr("task.lease.lost", tags=["task:" + self.shortname()])
+                break
+
     def apply(self, *args, **kw):
         """
         This method is only used when calling tasks directly and blocking
@@ -1,4 +1,5 @@
 from inspect import getmembers
+from unittest import mock
 
 from celery import signals
 
@@ -98,3 +99,64 @@ class TestWorkerConfig(object):
     def test_config(self, celery):
         assert celery.conf["task_always_eager"]
         assert "redis" in celery.conf["result_backend"]
+
+
+class TestLease(object):
+    def test_single(self, celery, redis):
+        from ichnaea.data.tasks import update_wifi
+
+        key = update_wifi.lease_key("0")
+        with mock.patch("ichnaea.data.station.WifiUpdater.__call__") as run:
+            run.side_effect = lambda: assert_held(redis, key)
+            update_wifi.delay(shard_id="0")
+        assert run.call_count == 1
+        assert not redis.exists(key)
+
+    def test_duplicate(self, celery, redis, metricsmock):
+        from ichnaea.data.tasks import update_wifi
+
+        key = update_wifi.lease_key("a")
+        lease = redis.lock(key, timeout=10)
+        assert lease.acquire(blocking=False)
+        with mock.patch("ichnaea.data.station.WifiUpdater.__call__") as run:
+            update_wifi.delay(shard_id="a")
+        assert not run.called
+        assert redis.exists(key + ":rerun")
+        metricsmock.assert_incr_once(
+            "task.duplicate", tags=["task:data.update_wifi", "shard:a"]
+        )
+
+    def test_chain(self, celery, redis, metricsmock):
+        from ichnaea.data.tasks import update_wifi
+
+        calls = []
+
+        def run():
+            calls.append(1)
+            if len(calls) == 1:
+                # A duplicate arriving while the first task runs.
+                update_wifi.delay(shard_id="b")
+
+        with mock.patch("ichnaea.data.station.WifiUpdater.__call__") as updater:
+            updater.side_effect = run
+            update_wifi.delay(shard_id="b")
+        assert len(calls) == 2
+        assert not redis.exists(update_wifi.lease_key("b") + ":rerun")
+        metricsmock.assert_incr_once(
+            "task.duplicate", tags=["task:data.update_wifi", "shard:b"]
+        )
+
+    def test_no_chain(self, celery, redis):
+        from ichnaea.data.tasks import cleanup_datamap
+
+        key = cleanup_datamap.lease_key("ne")
+        lease = redis.lock(key, timeout=10)
+        assert lease.acquire(blocking=False)
+        with mock.patch("ichnaea.data.datamap.DataMapCleaner.__call__") as run:
+            cleanup_datamap.delay(shard_id="ne")
+        assert not run.called
+        assert not redis.exists(key + ":rerun")
+
+
+def assert_held(redis, key):
+    assert redis.exists(key)
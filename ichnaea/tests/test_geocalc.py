@@ -1,14 +1,22 @@
+import numpy
 import pytest
 
 from geocalc import (
     bbox,
+    bbox_array,
+    circle_radius,
+    circle_radius_array,
     destination,
     distance,
+    distance_array,
+    grouped_max_distance,
     haversine_distance,
     vincenty_distance,
     latitude_add,
     longitude_add,
+    max_distance,
     random_points,
+    random_points_array,
 )
 from ichnaea import constants
 
@@ -203,3 +211,114 @@ class TestRandomPoints(object):
     def test_large(self):
         random_points(90000, 180000, 1)
         random_points(-90000, -180000, 1)
+
+
+class TestRandomPointsArray(object):
+    def test_empty(self):
+        lats, lons = random_points_array([], [], [])
+        assert len(lats) == len(lons) == 0
+
+    def test_same_points(self):
+        rows = [(10123, -170234, 1), (10124, -170234, 9), (1, -2, 12), (0, 0, -1)]
+        rows += [(90000, 180000, 1), (-90000, -180000, 1)]
+        lat, lon, num = zip(*rows)
+        lats, lons = random_points_array(
+            numpy.array(lat), numpy.array(lon), numpy.array(num)
+        )
+        expected = [
+            tuple(float(value) for value in point.split(","))
+            for row in rows
+            for point in random_points(*row)
+        ]
+        assert len(lats) == len(expected) == 26
+        # The scalar points are formatted with 6 decimal places
+        points = numpy.column_stack((lats, lons))
+        assert numpy.allclose(points, expected, rtol=0.0, atol=1e-6)
+
+    def test_length_mismatch(self):
+        with pytest.raises(ValueError):
+            random_points_array([1, 2], [1], [1, 2])
+
+
+LATS = numpy.array([51.5, 51.6, -33.9, 0.0])
+LONS = numpy.array([-0.1, -0.2, 151.2, 179.9])
+
+
+class TestDistanceArray(object):
+    def test_one_to_many(self):
+        result = distance_array(51.5, -0.1, LATS, LONS)
+        assert result.shape == (4,)
+        assert list(result) == [
+            distance(51.5, -0.1, lat, lon) for lat, lon in zip(LATS, LONS)
+        ]
+
+    def test_pairwise(self):
+        result = distance_array(LATS, LONS, LATS[::-1], LONS[::-1])
+        assert list(result) == [
+            distance(*values) for values in zip(LATS, LONS, LATS[::-1], LONS[::-1])
+        ]
+
+    def test_matrix(self):
+        result = distance_array(LATS[:3, None], LONS[:3, None], LATS[:2], LONS[:2])
+        assert result.shape == (3, 2)
+        for i in range(3):
+            for j in range(2):
+                assert result[i, j] == distance(LATS[i], LONS[i], LATS[j], LONS[j])
+
+    def test_empty(self):
+        assert distance_array(1.0, 1.0, [], []).shape == (0,)
+
+    def test_shape_mismatch(self):
+        with pytest.raises(ValueError):
+            distance_array([1.0, 2.0], [1.0, 2.0], [1.0, 2.0, 3.0], [1.0, 2.0, 3.0])
+
+
+class TestBboxArray(object):
+    def test_same_as_bbox(self):
+        meters = numpy.array([0.0, 1000.0, 50000.0, 10000000.0])
+        result = bbox_array(LATS, LONS, meters)
+        assert len(result) == 4
+        expected = [bbox(*values) for values in zip(LATS, LONS, meters)]
+        assert list(zip(*result)) == expected
+
+
+class TestCircleRadiusArray(object):
+    def test_same_as_circle_radius(self):
+        max_lat, min_lat = LATS + 0.01, LATS - 0.02
+        max_lon, min_lon = LONS + 0.03, LONS - 0.01
+        result = circle_radius_array(LATS, LONS, max_lat, max_lon, min_lat, min_lon)
+        assert result.dtype == numpy.int64
+        assert list(result) == [
+            circle_radius(*values)
+            for values in zip(LATS, LONS, max_lat, max_lon, min_lat, min_lon)
+        ]
+
+    def test_null(self):
+        assert list(circle_radius_array(LATS, LONS, LATS, LONS, LATS, LONS)) == [0] * 4
+
+
+class TestGroupedMaxDistance(object):
+    def test_same_as_max_distance(self):
+        points = numpy.column_stack((LATS, LONS))
+        starts = [0, 2, 2]
+        result = grouped_max_distance(
+            LATS[:3], LONS[:3], points[:, 0], points[:, 1], starts
+        )
+        assert list(result) == [
+            max_distance(LATS[0], LONS[0], points[:2]),
+            0.0,
+            max_distance(LATS[2], LONS[2], points[2:]),
+        ]
+
+    def test_no_groups(self):
+        assert grouped_max_distance([], [], [1.0], [1.0], []).shape == (0,)
+
+    def test_mismatch(self):
+        with pytest.raises(ValueError):
+            grouped_max_distance([1.0], [1.0, 2.0], [1.0], [1.0], [0])
+        with pytest.raises(ValueError):
+            grouped_max_distance([1.0], [1.0], [1.0, 2.0], [1.0], [0])
+        with pytest.raises(ValueError):
+            grouped_max_distance([1.0, 2.0], [1.0, 2.0], [1.0], [1.0], [1, 0])
+        with pytest.raises(ValueError):
+            grouped_max_distance([1.0], [1.0], [1.0], [1.0], [2])
@@ -1,6 +1,12 @@
 from uuid import uuid4
 
-from ichnaea.queue import DataQueue
+from ichnaea.queue import (
+    BATCH_CONTROLLER_BATCH,
+    BATCH_CONTROLLER_STATS,
+    DataQueue,
+    ready_queues,
+    SetDataQueue,
+)
 
 
 class TestDataQueue(object):
@@ -9,6 +15,11 @@ class TestDataQueue(object):
             uuid4().hex, redis, "data", batch=batch, compress=compress, json=json
         )
 
+    def test_data_type(self, redis):
+        queue = self._make_queue(redis)
+        assert queue.data_type == "data"
+        assert queue.tags["data_type"] == "data"
+
     def test_objects(self, redis):
         queue = self._make_queue(redis)
         items = [{"a": 1}, "b", 2]
@@ -72,3 +83,97 @@ class TestDataQueue(object):
         assert queue.size() == 2
         queue.dequeue()
         assert queue.size() == 0
+
+    def test_current_batch(self, redis):
+        queue = self._make_queue(redis, batch=4)
+        assert queue.current_batch() == 4
+        redis.hset(BATCH_CONTROLLER_BATCH, queue.key, 7)
+        assert queue.current_batch() == 7
+        redis.hset(BATCH_CONTROLLER_BATCH, queue.key, "invalid")
+        assert queue.current_batch() == 4
+
+    def test_record_batch(self, redis):
+        queue = self._make_queue(redis, batch=4)
+        queue.record_batch(4, 120.5, 0)
+        queue.record_batch(3, 80.0, 1)
+        stats = redis.hgetall(BATCH_CONTROLLER_STATS + queue.key)
+        assert stats == {
+            b"runs": b"2",
+            b"items": b"7",
+            b"duration": b"200",
+            b"lock_errors": b"1",
+        }
+
+
+class TestSetDataQueue(object):
+    def _make_queue(self, redis, batch=0):
+        return SetDataQueue(uuid4().hex, redis, "data", batch=batch)
+
+    def test_dedup(self, redis):
+        queue = self._make_queue(redis)
+        queue.enqueue([b"\x00ab", b"123", b"\x00ab"])
+        queue.enqueue([b"123"])
+        assert queue.size() == 2
+        assert sorted(queue.dequeue()) == [b"\x00ab", b"123"]
+        assert queue.size() == 0
+
+    def test_batch(self, redis):
+        queue = self._make_queue(redis, batch=3)
+        queue.enqueue([b"1", b"2", b"3", b"4", b"5"])
+        first = queue.dequeue()
+        assert len(first) == 3
+        second = queue.dequeue()
+        assert sorted(first + second) == [b"1", b"2", b"3", b"4", b"5"]
+        assert queue.dequeue() == []
+
+    def test_ready(self, redis):
+        queue = self._make_queue(redis, batch=2)
+        assert not queue.ready()
+        queue.enqueue([b"a", b"a"])
+        assert not queue.ready()
+        queue.enqueue([b"b"])
+        assert queue.ready()
+
+    def test_size_pipe(self, redis):
+        queue = self._make_queue(redis)
+        queue.enqueue([b"a", b"b"])
+        with redis.pipeline() as pipe:
+            queue.size(pipe=pipe)
+            assert pipe.execute() == [2]
+
+    def test_wait(self, redis):
+        queue = self._make_queue(redis)
+        queue.poll_interval = 0.01
+        assert not queue.wait(0.05)
+        queue.enqueue([b"a"])
+        assert queue.wait(0.05)
+        assert queue.size() == 1
+
+
+class TestReadyQueues(object):
+    def test_empty(self, redis):
+        assert ready_queues(redis, []) == ([], [])
+
+    def test_ready(self, redis):
+        full = DataQueue(uuid4().hex, redis, "data", batch=2)
+        full.enqueue(["a", "b"])
+        old = DataQueue(uuid4().hex, redis, "data", batch=2)
+        old.enqueue(["a"])
+        redis.expire(old.key, 70000)
+        partial = DataQueue(uuid4().hex, redis, "data", batch=2)
+        partial.enqueue(["a"])
+        unique = SetDataQueue(uuid4().hex, redis, "data", batch=2)
+        unique.enqueue([b"a", b"b"])
+        missing = DataQueue(uuid4().hex, redis, "data", batch=2)
+
+        queues = [full, old, partial, unique, missing]
+        ready, missing_queues = ready_queues(redis, queues)
+        assert ready == [full, old, unique]
+        assert missing_queues == [missing]
+        assert [queue.ready() for queue in queues] == [
+            True,
+            True,
+            False,
+            True,
+            False,
+        ]